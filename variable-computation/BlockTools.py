@@ -0,0 +1,173 @@
+import numpy as np
+
+
+class raster_grid:
+    """
+    Class to represent the grid (extent, cell size and projection) of a raster
+    """
+
+    def __init__(self, geotransform, projection, rows, cols):
+        """
+        Constructor for raster_grid
+        :param geotransform: GDAL geotransform tuple (x_min, cell_x, 0, y_max, 0, -cell_y)
+        :param projection: Projection of the grid as WKT
+        :param rows: Number of rows in the grid
+        :param cols: Number of columns in the grid
+        """
+        self.geotransform = tuple(geotransform)
+        self.projection = projection
+        self.rows = rows
+        self.cols = cols
+
+    def cell_size_x(self):
+        return abs(self.geotransform[1])
+
+    def cell_size_y(self):
+        return abs(self.geotransform[5])
+
+
+class raster_window:
+    """
+    Class to represent a rectangular window of a raster, in cells
+    """
+
+    def __init__(self, row_off, col_off, rows, cols):
+        """
+        Constructor for raster_window
+        :param row_off: First row of the window
+        :param col_off: First column of the window
+        :param rows: Number of rows in the window
+        :param cols: Number of columns in the window
+        """
+        self.row_off = row_off
+        self.col_off = col_off
+        self.rows = rows
+        self.cols = cols
+
+    def grow(self, halo, max_rows, max_cols):
+        """
+        Grow the window by halo cells on each side, clipped to the raster
+        :param halo: Number of cells to add on each side
+        :param max_rows: Number of rows in the raster
+        :param max_cols: Number of columns in the raster
+        :return: New, grown raster_window
+        """
+        row_off = max(self.row_off - halo, 0)
+        col_off = max(self.col_off - halo, 0)
+        row_end = min(self.row_off + self.rows + halo, max_rows)
+        col_end = min(self.col_off + self.cols + halo, max_cols)
+        return raster_window(row_off, col_off, row_end - row_off, col_end - col_off)
+
+
+class array_source:
+    """
+    Block source reading from a NumPy array or a numpy.memmap of a raster
+    """
+
+    def __init__(self, array, nodata=None):
+        """
+        Constructor for array_source
+        :param array: 2D array or numpy.memmap
+        :param nodata: Value to treat as nodata, or None
+        """
+        self.array = array
+        self.nodata = nodata
+        self.rows = array.shape[0]
+        self.cols = array.shape[1]
+
+    def read_block(self, row_off, col_off, rows, cols):
+        block = np.array(self.array[row_off:row_off + rows, col_off:col_off + cols], dtype=np.float64)
+        if self.nodata is not None:
+            block[block == self.nodata] = np.nan
+        return block
+
+
+class array_sink:
+    """
+    Block sink writing to a NumPy array or a numpy.memmap
+    """
+
+    def __init__(self, array):
+        self.array = array
+
+    def write_block(self, window, block):
+        self.array[window.row_off:window.row_off + window.rows, window.col_off:window.col_off + window.cols] = block
+
+
+def generate_windows(rows, cols, tile_size):
+    """
+    Split a raster to tiles of at most tile_size x tile_size cells, row by row
+    :param rows: Number of rows in the raster
+    :param cols: Number of columns in the raster
+    :param tile_size: Size of the tile side in cells
+    :return: Generator of raster_window instances
+    """
+    for row_off in range(0, rows, tile_size):
+        for col_off in range(0, cols, tile_size):
+            yield raster_window(row_off, col_off, min(tile_size, rows - row_off), min(tile_size, cols - col_off))
+
+
+def value_range(source, tile_size):
+    """
+    Minimum and maximum of a raster, read block by block. Unlike a mean, they do not depend on the tile size.
+    :param source: Block source of the raster
+    :param tile_size: Size of the tile side in cells
+    :return: Tuple of (minimum, maximum), (nan, nan) if the raster has no data
+    """
+    minimum = np.inf
+    maximum = -np.inf
+    for window in generate_windows(source.rows, source.cols, tile_size):
+        block = source.read_block(window.row_off, window.col_off, window.rows, window.cols)
+        values = block[~np.isnan(block)]
+        if values.size > 0:
+            minimum = min(minimum, float(values.min()))
+            maximum = max(maximum, float(values.max()))
+    if minimum > maximum:
+        return np.nan, np.nan
+    return minimum, maximum
+
+
+def read_padded_window(source, window, halo):
+    """
+    Read a window with halo cells on each side. Halo cells outside the raster are set to NaN, which gives exactly the
+    same input for the operator as padding the whole raster does.
+    :param source: Block source (array_source, RasterTools.gdal_band_source)
+    :param window: Instance of raster_window
+    :param halo: Number of halo cells on each side
+    :return: float64 array of shape (window.rows + 2 * halo, window.cols + 2 * halo)
+    """
+    padded = np.full((window.rows + 2 * halo, window.cols + 2 * halo), np.nan)
+    grown = window.grow(halo, source.rows, source.cols)
+    block = source.read_block(grown.row_off, grown.col_off, grown.rows, grown.cols)
+    row_start = grown.row_off - (window.row_off - halo)
+    col_start = grown.col_off - (window.col_off - halo)
+    padded[row_start:row_start + grown.rows, col_start:col_start + grown.cols] = block
+    return padded
+
+
+def process_in_blocks(source, sinks, block_function, halo, tile_size):
+    """
+    Run a neighbourhood operator tile by tile, so that peak memory depends on the tile size instead of the raster
+    size. The output is identical to running block_function on the whole, padded raster.
+    :param source: Block source of the input raster
+    :param sinks: Dictionary of output name -> block sink
+    :param block_function: Function taking a padded window and returning a dictionary of output name -> array
+    :param halo: Number of cells the operator needs around each computed cell
+    :param tile_size: Size of the tile side in cells
+    """
+    process_windows(source, sinks, block_function, halo, generate_windows(source.rows, source.cols, tile_size))
+
+
+def process_windows(source, sinks, block_function, halo, windows):
+    """
+    Run a neighbourhood operator on the given windows only, e.g. the windows of a raster that changed
+    :param source: Block source of the input raster
+    :param sinks: Dictionary of output name -> block sink
+    :param block_function: Function taking a padded window and returning a dictionary of output name -> array
+    :param halo: Number of cells the operator needs around each computed cell
+    :param windows: Iterable of raster_window instances
+    """
+    for window in windows:
+        results = block_function(read_padded_window(source, window, halo))
+        for name in sinks:
+            sinks[name].write_block(window, results[name])
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+import TraceTools
+
+_file_hashes = {}
+
+
+def hash_file(file_path, block_size=1024 * 1024):
+    """
+    Compute a SHA-1 hash of the file content. The hash is remembered as long as the size and modification time of the
+    file stay the same, so a DEM used by several tools is only read once.
+    :param file_path: Path to the file
+    :param block_size: Number of bytes to read at a time
+    :return: Hex digest of the file content
+    """
+    stat = os.stat(file_path)
+    memo_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime)
+    if memo_key not in _file_hashes:
+        sha = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            block = f.read(block_size)
+            while block:
+                sha.update(block)
+                block = f.read(block_size)
+        _file_hashes[memo_key] = sha.hexdigest()
+    return _file_hashes[memo_key]
+
+
+class raster_cache:
+    """
+    Content-addressed cache of derived rasters. Entries are keyed on the hash of the input rasters plus the tool and
+    its parameters, and the least recently used entries are evicted when the cache grows over its maximum size.
+    """
+
+    def __init__(self, cache_directory, max_size=None):
+        """
+        Constructor for raster_cache
+        :param cache_directory: Directory where to store the cached files (Will be created)
+        :param max_size: Maximum size of the cache in bytes, None for no limit
+        """
+        self.cache_directory = cache_directory
+        self.max_size = max_size
+        self.index_path = os.path.join(cache_directory, "index.json")
+        if not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+
+    def make_key(self, tool, input_paths, parameters):
+        """
+        Construct the cache key of a processing step
+        :param tool: Name of the tool, e.g. saga:catchmentarea
+        :param input_paths: List of input files of the step
+        :param parameters: JSON serializable parameters of the step (without input and output paths)
+        :return: Cache key as string
+        """
+        description = {"tool": tool,
+                       "inputs": [hash_file(path) for path in input_paths],
+                       "parameters": parameters}
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def fetch(self, key, output_paths):
+        """
+        Copy the cached outputs of a step to the output paths
+        :param key: Cache key of the step
+        :param output_paths: List of paths where the outputs are expected
+        :return: True if the entry was found and copied, False otherwise
+        """
+        entry = self.index.get(key)
+        if entry is None or len(entry["files"]) != len(output_paths):
+            return False
+        cached_paths = [os.path.join(self.cache_directory, key, name) for name in entry["files"]]
+        if not all(os.path.exists(path) for path in cached_paths):
+            self.remove(key)
+            return False
+
+        for cached_path, output_path in zip(cached_paths, output_paths):
+            shutil.copyfile(cached_path, output_path)
+        entry["last_access"] = time.time()
+        entry["hits"] += 1
+        self._write_index()
+        return True
+
+    def store(self, key, output_paths, tool, parameters):
+        """
+        Store the outputs of a step to the cache and evict old entries if the cache became too large
+        :param key: Cache key of the step
+        :param output_paths: List of output files of the step
+        :param tool: Name of the tool
+        :param parameters: Parameters of the step, stored for inspecting the cache
+        """
+        entry_directory = os.path.join(self.cache_directory, key)
+        if not os.path.exists(entry_directory):
+            os.makedirs(entry_directory)
+
+        files = []
+        size = 0
+        for i, output_path in enumerate(output_paths):
+            name = str(i) + "_" + os.path.basename(output_path)
+            shutil.copyfile(output_path, os.path.join(entry_directory, name))
+            files.append(name)
+            size += os.path.getsize(output_path)
+
+        now = time.time()
+        self.index[key] = {"tool": tool,
+                           "parameters": parameters,
+                           "files": files,
+                           "size": size,
+                           "created": now,
+                           "last_access": now,
+                           "hits": 0}
+        self.evict()
+        self._write_index()
+
+    def remove(self, key):
+        """
+        Remove an entry from the cache
+        :param key: Cache key of the entry
+        """
+        entry_directory = os.path.join(self.cache_directory, key)
+        if os.path.exists(entry_directory):
+            shutil.rmtree(entry_directory)
+        self.index.pop(key, None)
+        self._write_index()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits to its maximum size
+        """
+        if self.max_size is None:
+            return
+        by_last_access = sorted(self.index, key=lambda k: self.index[k]["last_access"])
+        while by_last_access and self.total_size() > self.max_size:
+            self.remove(by_last_access.pop(0))
+
+    def total_size(self):
+        return sum(entry["size"] for entry in self.index.values())
+
+    def entries(self):
+        """
+        List the cache entries, most recently used first
+        :return: List of (key, entry dictionary) tuples
+        """
+        return sorted(self.index.items(), key=lambda item: item[1]["last_access"], reverse=True)
+
+    def print_summary(self):
+        """
+        Print the content of the cache
+        """
+        print("Cache: " + self.cache_directory)
+        print("Entries: " + str(len(self.index)) + ", size: " + str(self.total_size()) + " bytes")
+        for key, entry in self.entries():
+            print(key[:12] + "  " + entry["tool"] + "  " + str(entry["size"]) + " bytes  " + str(entry["hits"]) +
+                  " hits  last used " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["last_access"])))
+
+    def _write_index(self):
+        temporary_path = self.index_path + ".tmp"
+        with open(temporary_path, 'w') as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        os.rename(temporary_path, self.index_path)
+
+
+def run_cached(cache, tool, input_paths, parameters, output_paths, compute):
+    """
+    Run a processing step through the cache and trace it. On a hit the stored outputs are copied and compute is not
+    called.
+    :param cache: Instance of raster_cache, or None to always compute
+    :param tool: Name of the tool
+    :param input_paths: List of input files of the step
+    :param parameters: JSON serializable parameters of the step (without input and output paths)
+    :param output_paths: List of output files of the step
+    :param compute: Function without arguments that creates the output files
+    :return: True if the outputs came from the cache, False otherwise
+    """
+    with TraceTools.span(tool, "tool", inputs=[os.path.basename(path) for path in input_paths]) as span:
+        if cache is None:
+            compute()
+            return False
+
+        key = cache.make_key(tool, input_paths, parameters)
+        span.arguments["cached"] = cache.fetch(key, output_paths)
+        if span.arguments["cached"]:
+            return True
+        compute()
+        cache.store(key, output_paths, tool, parameters)
+        return False
+
+
+if __name__ == "__main__":
+    # Inspect a cache: python CacheTools.py <cache_directory>
+    if len(sys.argv) != 2:
+        sys.exit("Usage: python CacheTools.py <cache_directory>")
+    raster_cache(sys.argv[1]).print_summary()
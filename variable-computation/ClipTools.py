@@ -0,0 +1,222 @@
+import numpy as np
+
+import LasTools
+
+
+class plot_lookup:
+    """
+    Plot centres bucketed on a grid with the cell size of the largest radius, so the plots a point can fall in are
+    found in the 3 x 3 cells around the point
+    """
+
+    def __init__(self, plot_x, plot_y, cell_size):
+        """
+        Constructor for plot_lookup
+        :param plot_x: x coordinates of the plot centres
+        :param plot_y: y coordinates of the plot centres
+        :param cell_size: Cell size, at least the largest radius
+        """
+        self.plot_x = np.asarray(plot_x, dtype=np.float64)
+        self.plot_y = np.asarray(plot_y, dtype=np.float64)
+        self.cell_size = cell_size
+        # Two empty cells on each side, so the neighbours of every cell next to a plot cell are on the grid
+        self.x_min = self.plot_x.min() - 2 * cell_size
+        self.y_min = self.plot_y.min() - 2 * cell_size
+        self.cols = int(np.floor((self.plot_x.max() - self.x_min) / cell_size)) + 3
+        self.rows = int(np.floor((self.plot_y.max() - self.y_min) / cell_size)) + 3
+        cells = self._cells(self.plot_x, self.plot_y)
+        self.order = np.argsort(cells, kind="mergesort")
+        self.starts = np.zeros(self.rows * self.cols + 1, dtype=np.int64)
+        self.starts[1:] = np.cumsum(np.bincount(cells, minlength=self.rows * self.cols))
+
+    def _cells(self, x, y):
+        return (np.floor((y - self.y_min) / self.cell_size).astype(np.int64) * self.cols +
+                np.floor((x - self.x_min) / self.cell_size).astype(np.int64))
+
+    def candidate_pairs(self, x, y):
+        """
+        :param x: x coordinates of the points
+        :param y: y coordinates of the points
+        :return: Tuple of (point number, plot number) arrays of the plots near each point
+        """
+        col = np.floor((x - self.x_min) / self.cell_size).astype(np.int64)
+        row = np.floor((y - self.y_min) / self.cell_size).astype(np.int64)
+        inside = np.nonzero((col >= 1) & (col < self.cols - 1) & (row >= 1) & (row < self.rows - 1))[0]
+        points = []
+        plots = []
+        for row_offset in (-1, 0, 1):
+            for col_offset in (-1, 0, 1):
+                cells = (row[inside] + row_offset) * self.cols + col[inside] + col_offset
+                counts = self.starts[cells + 1] - self.starts[cells]
+                if counts.sum() == 0:
+                    continue
+                point_numbers = np.repeat(inside, counts)
+                # Position of every pair within the plots of its cell
+                within = np.arange(len(point_numbers)) - np.repeat(np.cumsum(counts) - counts, counts)
+                points.append(point_numbers)
+                plots.append(self.order[np.repeat(self.starts[cells], counts) + within])
+        if not points:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(points), np.concatenate(plots)
+
+    def near(self, bounds, distance):
+        """
+        :param bounds: Tuple of (x min, y min, x max, y max), e.g. of a LAS file
+        :param distance: Distance from the bounds, e.g. the largest radius
+        :return: True if any plot centre is within the distance of the bounds
+        """
+        min_x, min_y, max_x, max_y = bounds
+        return bool(((self.plot_x >= min_x - distance) & (self.plot_x <= max_x + distance) &
+                     (self.plot_y >= min_y - distance) & (self.plot_y <= max_y + distance)).any())
+
+    def members(self, chunk, radius, classes=None):
+        """
+        Find the points of a chunk within the radius of the plot centres
+        :param chunk: Instance of LasTools.point_chunk
+        :param radius: Largest distance from the plot centre
+        :param classes: List of classifications to keep, or None for all points
+        :return: Tuple of (point number, plot number, distance) arrays, a point can be in several plots
+        """
+        point_numbers, plot_numbers = self.candidate_pairs(chunk.x, chunk.y)
+        if classes is not None and len(point_numbers) > 0:
+            keep = np.isin(chunk.classification[point_numbers], classes)
+            point_numbers = point_numbers[keep]
+            plot_numbers = plot_numbers[keep]
+        distance = np.hypot(chunk.x[point_numbers] - self.plot_x[plot_numbers],
+                            chunk.y[point_numbers] - self.plot_y[plot_numbers])
+        inside = distance <= radius
+        return point_numbers[inside], plot_numbers[inside], distance[inside]
+
+
+class plot_clip:
+    """
+    Points of concentric circular plots clipped from LAS files. The points within the largest radius are stored once
+    per plot, sorted by distance from the centre, so the points of every smaller radius are a prefix of the same list
+    (like ZonalTools.nested_zone_index).
+    """
+
+    def __init__(self, las_files, files, points, plots, distances, plot_count, radii):
+        """
+        Constructor for plot_clip
+        :param las_files: List of LasTools.las_file the points come from
+        :param files: File number of each point
+        :param points: Point number of each point in its file
+        :param plots: Plot number of each point
+        :param distances: Distance of each point from the plot centre
+        :param plot_count: Number of plots
+        :param radii: List of radii
+        """
+        order = np.lexsort((points, files, distances, plots))
+        self.las_files = las_files
+        self.files = files[order]
+        self.points = points[order]
+        self.plots = plots[order]
+        self.radii = sorted(radii)
+        self.plot_count = plot_count
+
+        # Start of each plot in the point list, and the end of each radius within the plot
+        self.starts = np.searchsorted(self.plots, np.arange(plot_count))
+        plot_ends = np.searchsorted(self.plots, np.arange(plot_count), side="right")
+        self.distances = distances[order]
+        self.ends = {}
+        for radius in self.radii:
+            inside = np.concatenate([[0], np.cumsum(self.distances <= radius)])
+            self.ends[radius] = self.starts + (inside[plot_ends] - inside[self.starts])
+
+    def point_count(self, plot, radius):
+        return int(self.ends[radius][plot] - self.starts[plot])
+
+    def with_ground(self, ground):
+        """
+        :param ground: Instance of GroundTools.ground_model
+        :return: New plot_clip without the points whose ground elevation is unknown (NaN heights in gaps of the DTM),
+        which FUSION clipdata /height leaves out too
+        """
+        known = np.ones(len(self.points), dtype=bool)
+        for file_number in np.unique(self.files):
+            selected = np.nonzero(self.files == file_number)[0]
+            x, y, z = self.las_files[file_number].coordinates(self.points[selected])
+            known[selected] = ~np.isnan(ground.heights(x, y, z))
+        return plot_clip(self.las_files, self.files[known], self.points[known], self.plots[known],
+                         self.distances[known], self.plot_count, self.radii)
+
+    def records(self, plot, radius, header=None, ground=None):
+        """
+        Gather the point records of one plot and radius from the LAS files
+        :param plot: Plot number
+        :param radius: Radius, one of the radii of the clip
+        :param header: Instance of LasTools.las_header of the records, the header of the first file by default.
+        Coordinates are converted to its scale and offset.
+        :param ground: Instance of GroundTools.ground_model to replace the elevation with the height above ground
+        (FUSION clipdata /height), or None. Points without a ground elevation must have been left out with
+        with_ground.
+        :return: Structured array of point records
+        """
+        if header is None:
+            header = self.las_files[0].header
+        start = self.starts[plot]
+        end = self.ends[radius][plot]
+        records = np.zeros(end - start, dtype=header.dtype())
+        files = self.files[start:end]
+        points = self.points[start:end]
+        for file_number in np.unique(files):
+            las = self.las_files[file_number]
+            if las.header.dtype() != header.dtype():
+                raise ValueError("Point format of " + las.path + " differs from the other files")
+            selected = np.nonzero(files == file_number)[0]
+            file_records = las.points[points[selected]]
+            same_scale = las.header.scale == header.scale and las.header.offset == header.offset
+            if ground is not None or not same_scale:
+                x, y, z = las.coordinates(points[selected])
+                if ground is not None:
+                    z = ground.heights(x, y, z)
+                for name, values, i in [("X", x, 0), ("Y", y, 1), ("Z", z, 2)]:
+                    file_records[name] = np.round((values - header.offset[i]) / header.scale[i]).astype(np.int32)
+            records[selected] = file_records
+        return records
+
+    def write(self, paths, ground=None):
+        """
+        Write the points of every plot and radius to LAS files
+        :param paths: Dictionary of (plot number, radius) -> output path
+        :param ground: Instance of GroundTools.ground_model to write heights above ground, or None
+        """
+        header = self.las_files[0].header
+        clip = self if ground is None else self.with_ground(ground)
+        for plot, radius in sorted(paths):
+            LasTools.write_las(paths[(plot, radius)], header, clip.records(plot, radius, header, ground))
+
+
+def clip_plots(las_files, plot_x, plot_y, radii, classes=None):
+    """
+    Clip the points of all plots and radii at once, instead of one clipdata.exe call per plot and radius. The points
+    of each plot are read through the grid indices of the LAS files (built and saved on first use), so only the index
+    cells around the plots are read.
+    :param las_files: List of LasTools.las_file
+    :param plot_x: x coordinates of the plot centres
+    :param plot_y: y coordinates of the plot centres
+    :param radii: List of plot radii in map units
+    :param classes: List of classifications to keep, or None for all points
+    :return: Instance of plot_clip
+    """
+    max_radius = max(radii)
+    plot_x = np.asarray(plot_x, dtype=np.float64)
+    plot_y = np.asarray(plot_y, dtype=np.float64)
+    file_numbers = dict((id(las), file_number) for file_number, las in enumerate(las_files))
+    files = [np.zeros(0, dtype=np.int32)]
+    points = [np.zeros(0, dtype=np.int64)]
+    plots = [np.zeros(0, dtype=np.int64)]
+    distances = [np.zeros(0)]
+    for plot, (x, y) in enumerate(zip(plot_x, plot_y)):
+        for las, indices in LasTools.query_files(las_files, x - max_radius, y - max_radius, x + max_radius,
+                                                 y + max_radius, classes):
+            point_x, point_y, _ = las.coordinates(indices)
+            distance = np.hypot(point_x - x, point_y - y)
+            inside = distance <= max_radius
+            files.append(np.full(np.count_nonzero(inside), file_numbers[id(las)], dtype=np.int32))
+            points.append(indices[inside].astype(np.int64))
+            plots.append(np.full(np.count_nonzero(inside), plot, dtype=np.int64))
+            distances.append(distance[inside])
+
+    return plot_clip(las_files, np.concatenate(files), np.concatenate(points), np.concatenate(plots),
+                     np.concatenate(distances), len(plot_x), radii)
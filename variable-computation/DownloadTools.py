@@ -0,0 +1,248 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    from httplib import IncompleteRead
+    from urllib2 import HTTPError, Request, urlopen
+except ImportError:
+    from http.client import IncompleteRead
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+
+import TraceTools
+
+DEFAULT_WCS_URL = "http://webservices.isric.org/geoserver/ows"
+CACHE_FILE = "download-cache.json"
+PART_SUFFIX = ".part"
+BLOCK_SIZE = 1024 * 1024
+# Byte order marks of TIFF and BigTIFF files, a WCS error is an XML document instead
+TIFF_SIGNATURES = [b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+"]
+# HTTP status codes worth retrying, other client errors fail at once
+RETRY_STATUS = [408, 429]
+
+
+class coverage_request:
+    """
+    One WCS 2.0.1 GetCoverage request and the file it is saved to
+    """
+
+    def __init__(self, coverage_id, subsets, output_path):
+        """
+        Constructor for coverage_request
+        :param coverage_id: Coverage id in the WCS service, e.g. geonode:orcdrc_m_sl1_250m
+        :param subsets: List of (axis, low, high) tuples, e.g. [("Long", 38.28, 38.37), ("Lat", -3.45, -3.35)]
+        :param output_path: Path to the output GeoTIFF
+        """
+        self.coverage_id = coverage_id
+        self.subsets = list(subsets)
+        self.output_path = output_path
+
+    def key(self):
+        """
+        :return: Cache key of the coverage id and the subset, independent of the server and the output path
+        """
+        return self.coverage_id + "".join("|" + axis + "({0!r},{1!r})".format(float(low), float(high))
+                                          for axis, low, high in self.subsets)
+
+    def url(self, base_url):
+        """
+        :param base_url: URL of the OWS endpoint, e.g. DEFAULT_WCS_URL or a local stand-in server
+        :return: GetCoverage URL
+        """
+        return base_url + "?service=WCS&version=2.0.1&request=GetCoverage&CoverageId=" + self.coverage_id + \
+            "".join("&subset=" + axis + "({0!r},{1!r})".format(float(low), float(high))
+                    for axis, low, high in self.subsets)
+
+
+def file_digest(path):
+    """
+    :return: SHA-256 hex digest of a file, read in blocks
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class download_cache:
+    """
+    Downloaded files keyed by coverage id and subset, with the size and checksum of every file. A file is only
+    reused if it still has its recorded content, so edited or truncated files are fetched again.
+    """
+
+    def __init__(self, directory):
+        """
+        Constructor for download_cache
+        :param directory: Directory of the cache file
+        """
+        self.path = os.path.join(directory, CACHE_FILE)
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)
+        self.lock = threading.Lock()
+
+    def verified_path(self, key):
+        """
+        :param key: Cache key, see coverage_request.key
+        :return: Path to the cached file, or None if it is not cached or its content changed
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or not os.path.exists(entry["path"]):
+            return None
+        if os.path.getsize(entry["path"]) != entry["size"] or file_digest(entry["path"]) != entry["sha256"]:
+            return None
+        return entry["path"]
+
+    def store(self, key, path):
+        """
+        Record a downloaded file and write the cache file
+        :param key: Cache key, see coverage_request.key
+        :param path: Path to the file
+        """
+        entry = {"path": path, "size": os.path.getsize(path), "sha256": file_digest(path)}
+        with self.lock:
+            self.entries[key] = entry
+            temporary_path = self.path + ".tmp"
+            with open(temporary_path, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(temporary_path, self.path)
+
+
+def _check_coverage(path):
+    # A failed GetCoverage is often answered with status 200 and an XML exception report
+    with open(path, 'rb') as f:
+        start = f.read(512)
+    if start[:4] not in TIFF_SIGNATURES:
+        raise ValueError("Response is not a GeoTIFF: " + start[:200].decode("utf-8", "replace"))
+
+
+class downloader:
+    """
+    Downloads coverages in a bounded pool of worker threads. Failed requests are retried with exponential backoff,
+    interrupted downloads are resumed with HTTP Range requests from the partial file, and coverages in the cache are
+    not downloaded again.
+    """
+
+    def __init__(self, cache, base_url=DEFAULT_WCS_URL, workers=4, retries=3, retry_delay=1.0, timeout=60):
+        """
+        Constructor for downloader
+        :param cache: Instance of download_cache
+        :param base_url: URL of the OWS endpoint
+        :param workers: Number of downloads at the same time
+        :param retries: Number of times a failed download is tried again
+        :param retry_delay: Seconds to wait before the first retry, doubled for every further retry
+        :param timeout: Socket timeout in seconds
+        """
+        self.cache = cache
+        self.base_url = base_url
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+
+    def _download(self, url, part_path):
+        # Download to the partial file, continuing after the bytes it already has
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        request = Request(url)
+        if offset > 0:
+            request.add_header("Range", "bytes=" + str(offset) + "-")
+        try:
+            response = urlopen(request, timeout=self.timeout)
+        except HTTPError as e:
+            if e.code == 416 and offset > 0:
+                # Nothing after the offset, the partial file is complete
+                return
+            raise
+        try:
+            resumed = offset > 0 and response.getcode() == 206
+            expected = response.info().get("Content-Length")
+            written = 0
+            with open(part_path, 'ab' if resumed else 'wb') as f:
+                for block in iter(lambda: response.read(BLOCK_SIZE), b""):
+                    f.write(block)
+                    written += len(block)
+        finally:
+            response.close()
+        if expected is not None and written != int(expected):
+            raise IOError("Connection closed after " + str(written) + " of " + expected + " bytes")
+
+    def fetch(self, request):
+        """
+        Download one coverage, unless it is in the cache
+        :param request: Instance of coverage_request
+        :return: Tuple of (cache key, None on success or the error message)
+        """
+        key = request.key()
+        cached = self.cache.verified_path(key)
+        if cached is not None:
+            if os.path.abspath(cached) != os.path.abspath(request.output_path):
+                shutil.copyfile(cached, request.output_path)
+                self.cache.store(key, request.output_path)
+            return key, None
+
+        url = request.url(self.base_url)
+        part_path = request.output_path + PART_SUFFIX
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+                logging.warning("Retrying " + request.coverage_id + " (attempt " + str(attempt + 1) + "): " + error)
+            with TraceTools.span(request.coverage_id, "download", url=url, attempt=attempt):
+                try:
+                    self._download(url, part_path)
+                    _check_coverage(part_path)
+                except HTTPError as e:
+                    error = "HTTP " + str(e.code) + ": " + url
+                    if e.code < 500 and e.code not in RETRY_STATUS:
+                        break
+                    continue
+                except ValueError as e:
+                    # The server answered, but not with a coverage: retrying does not help
+                    error = str(e)
+                    os.remove(part_path)
+                    break
+                except (IOError, socket.error, IncompleteRead) as e:
+                    error = str(e) or e.__class__.__name__
+                    continue
+            if os.path.exists(request.output_path):
+                os.remove(request.output_path)
+            os.rename(part_path, request.output_path)
+            self.cache.store(key, request.output_path)
+            return key, None
+        return key, error
+
+    def run(self, requests):
+        """
+        Download coverages in parallel
+        :param requests: List of coverage_request instances
+        :return: Dictionary of coverage id -> error message of the downloads that failed after all retries
+        """
+        if not requests:
+            return {}
+        for request in requests:
+            folder = os.path.dirname(request.output_path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+        pool = ThreadPool(min(self.workers, len(requests)))
+        try:
+            results = pool.map(self.fetch, requests, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        failures = dict((request.coverage_id, error) for request, (_, error) in zip(requests, results)
+                        if error is not None)
+        for name in sorted(failures):
+            logging.error("Download of " + name + " failed: " + failures[name])
+        return failures
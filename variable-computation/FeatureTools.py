@@ -0,0 +1,268 @@
+import json
+import os
+
+import numpy as np
+
+import BlockTools
+
+CUBE_FILE = "cube.dat"
+INDEX_FILE = "index.json"
+COLUMNS_FILE = "columns.json"
+
+# Key columns of the plot tables
+PLOT_KEYS = ["Cluster", "Plot"]
+# Key columns of the metrics tables, one row per plot, radius and height break
+METRIC_KEYS = PLOT_KEYS + ["Radius", "Above"]
+
+
+def _write_json(path, content):
+    temporary_path = path + ".tmp"
+    with open(temporary_path, 'w') as f:
+        json.dump(content, f, indent=1, sort_keys=True)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(temporary_path, path)
+
+
+def _column_file(name):
+    # Column names like "(All returns above 2.00) / (Total first returns) * 100" escaped to a file name
+    return "".join(character if character.isalnum() or character in " ._-()" else "%{0:02X}".format(ord(character))
+                   for character in name) + ".npy"
+
+
+class predictor_cube:
+    """
+    All predictor bands sharing one grid, stored as a single band-interleaved float32 array of shape
+    (bands, rows, cols) that is memory-mapped from disk. The index next to the array holds the grid and the metadata
+    of every band, so one predictor or one window of all predictors can be sliced without copying.
+    """
+
+    def __init__(self, directory, mode="r"):
+        """
+        Constructor for predictor_cube. Opens an existing cube (see create_cube).
+        :param directory: Directory of the cube
+        :param mode: numpy.memmap mode, "r" for reading and "r+" for updating
+        :throws: Throws a ValueError if the directory does not contain a cube
+        """
+        index_path = os.path.join(directory, INDEX_FILE)
+        if not os.path.exists(index_path):
+            raise ValueError("Not a predictor cube: " + directory)
+        with open(index_path, 'r') as f:
+            self.index = json.load(f)
+        self.directory = directory
+        self.grid = BlockTools.raster_grid(self.index["geotransform"], self.index["projection"], self.index["rows"],
+                                           self.index["cols"])
+        self.bands = self.index["bands"]
+        self.array = np.memmap(os.path.join(directory, CUBE_FILE), dtype=np.float32, mode=mode,
+                               shape=(len(self.bands), self.grid.rows, self.grid.cols))
+        self._positions = dict((band["short_name"], i) for i, band in enumerate(self.bands))
+
+    def short_names(self):
+        return [band["short_name"] for band in self.bands]
+
+    def band_number(self, short_name):
+        """
+        :param short_name: Short name of the predictor (resolution prefix included, e.g. T5SLO)
+        :return: Position of the predictor in the cube
+        :throws: Throws a KeyError if the cube does not have the predictor
+        """
+        return self._positions[short_name]
+
+    def band(self, short_name):
+        """
+        :param short_name: Short name of the predictor
+        :return: Memory-mapped view of the predictor, shape (rows, cols)
+        """
+        return self.array[self.band_number(short_name)]
+
+    def window(self, row_off, col_off, rows, cols):
+        """
+        :return: Memory-mapped view of a window of all predictors, shape (bands, rows, cols)
+        """
+        return self.array[:, row_off:row_off + rows, col_off:col_off + cols]
+
+    def write_band(self, short_name, array, row_off=0):
+        """
+        Write rows of a predictor to the cube
+        :param short_name: Short name of the predictor
+        :param array: Rows to write, NaN for nodata
+        :param row_off: First row to write
+        """
+        self.array[self.band_number(short_name), row_off:row_off + array.shape[0]] = array
+
+    def flush(self):
+        self.array.flush()
+
+
+def create_cube(directory, grid, bands):
+    """
+    Create an empty predictor cube filled with nodata
+    :param directory: Directory of the cube (Will be created)
+    :param grid: Instance of RasterTools.raster_grid shared by all bands
+    :param bands: List of band metadata dictionaries, each with at least a unique short_name
+    :return: Instance of predictor_cube opened for updating
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    array = np.memmap(os.path.join(directory, CUBE_FILE), dtype=np.float32, mode="w+",
+                      shape=(len(bands), grid.rows, grid.cols))
+    array[:] = np.nan
+    array.flush()
+    del array
+    _write_json(os.path.join(directory, INDEX_FILE), {"geotransform": list(grid.geotransform),
+                                                      "projection": grid.projection,
+                                                      "rows": grid.rows,
+                                                      "cols": grid.cols,
+                                                      "bands": bands})
+    return predictor_cube(directory, "r+")
+
+
+def fill_cube(cube, sources, strip_rows=256):
+    """
+    Copy raster bands to a cube strip by strip
+    :param cube: Instance of predictor_cube opened for updating
+    :param sources: Dictionary of short name -> block source on the grid of the cube
+    :param strip_rows: Number of rows to copy at a time
+    """
+    for short_name in sources:
+        source = sources[short_name]
+        for row_off in range(0, cube.grid.rows, strip_rows):
+            rows = min(strip_rows, cube.grid.rows - row_off)
+            cube.write_band(short_name, source.read_block(row_off, 0, rows, cube.grid.cols), row_off)
+    cube.flush()
+
+
+class plot_table:
+    """
+    Columnar table of plot level features. Every column is its own .npy file, memory-mapped on read, and rows are
+    keyed by Cluster and Plot.
+    """
+
+    def __init__(self, directory):
+        """
+        Constructor for plot_table. Opens an existing table (see write_plot_table).
+        :param directory: Directory of the table
+        :throws: Throws a ValueError if the directory does not contain a table
+        """
+        columns_path = os.path.join(directory, COLUMNS_FILE)
+        if not os.path.exists(columns_path):
+            raise ValueError("Not a plot table: " + directory)
+        with open(columns_path, 'r') as f:
+            self.metadata = json.load(f)
+        self.directory = directory
+        self.names = self.metadata["columns"]
+        self.row_count = self.metadata["rows"]
+        self._rows = None
+
+    def column(self, name):
+        """
+        :param name: Column name
+        :return: Memory-mapped array of the column
+        :throws: Throws a KeyError if the table does not have the column
+        """
+        if name not in self.names:
+            raise KeyError("No column " + name + " in " + self.directory)
+        return np.load(os.path.join(self.directory, _column_file(name)), mmap_mode="r")
+
+    def row(self, cluster, plot):
+        """
+        :return: Row number of a plot
+        :throws: Throws a KeyError if the table does not have the plot
+        """
+        if self._rows is None:
+            keys = zip(*[self.column(name).tolist() for name in PLOT_KEYS])
+            self._rows = dict((key, i) for i, key in enumerate(keys))
+        return self._rows[(cluster, plot)]
+
+    def matrix(self, names):
+        """
+        :param names: List of column names
+        :return: float64 array of shape (rows, len(names))
+        """
+        return np.column_stack([self.column(name) for name in names]).astype(np.float64)
+
+
+class metrics_table(plot_table):
+    """
+    Columnar table of the cloudmetrics of all plots, radii and height breaks, one row per Cluster, Plot, Radius and
+    Above (see write_metrics_table). The cover columns of the height breaks share one column each, with the break in
+    the name replaced by a label.
+    """
+
+    def wide_matrix(self, radius):
+        """
+        Join the rows of all height breaks of one radius to one row per plot, like the merges of
+        combine-computed-variables.R: the columns that do not depend on the break are taken from the lowest break and
+        the cover columns of every break are added with the break in their name. Plots missing from any break are
+        left out.
+        :param radius: Plot radius
+        :return: Tuple of (dictionary of key column name (see PLOT_KEYS) -> array per row, list of column names,
+        float64 array of shape (rows, columns))
+        """
+        selected = np.nonzero(np.isclose(np.asarray(self.column("Radius")), radius))[0]
+        aboves = np.asarray(self.column("Above"))[selected]
+        breaks = np.unique(aboves)
+        break_numbers = np.searchsorted(breaks, aboves)
+        clusters = np.asarray(self.column("Cluster"))[selected]
+        plots = np.asarray(self.column("Plot"))[selected]
+        combined = np.char.add(np.char.add(clusters.astype(str), "\n"), plots.astype(str))
+        plot_keys, plot_numbers = np.unique(combined, return_inverse=True)
+        # Position of the first row of every plot, for its keys
+        first_rows = np.full(len(plot_keys), len(selected))
+        np.minimum.at(first_rows, plot_numbers, np.arange(len(selected)))
+
+        label = self.metadata["break_label"]
+        break_columns = self.metadata["break_columns"]
+        shared_columns = [name for name in self.names if name not in METRIC_KEYS and name not in break_columns]
+        names = list(shared_columns)
+        for above in breaks:
+            names += [name.replace(label, "{0:.2f}".format(above)) for name in break_columns]
+
+        matrix = np.full((len(plot_keys), len(names)), np.nan)
+        lowest = np.nonzero(break_numbers == 0)[0]
+        for position, name in enumerate(shared_columns):
+            matrix[plot_numbers[lowest], position] = np.asarray(self.column(name))[selected[lowest]]
+        for position, name in enumerate(break_columns):
+            columns = len(shared_columns) + break_numbers * len(break_columns) + position
+            matrix[plot_numbers, columns] = np.asarray(self.column(name))[selected]
+
+        complete = np.bincount(plot_numbers, minlength=len(plot_keys)) == len(breaks)
+        keys = {"Cluster": clusters[first_rows[complete]], "Plot": plots[first_rows[complete]]}
+        return keys, names, matrix[complete]
+
+
+def write_plot_table(directory, keys, columns, metadata=None):
+    """
+    Write a plot table
+    :param directory: Directory of the table (Will be created)
+    :param keys: Dictionary of key column name (see PLOT_KEYS) -> list of values, one per plot
+    :param columns: List of (column name, array of values), in the same plot order as keys
+    :param metadata: Dictionary of further entries of the column index, or None
+    :return: Instance of plot_table
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    names = []
+    for name, values in [(key, keys[key]) for key in PLOT_KEYS] + list(columns):
+        np.save(os.path.join(directory, _column_file(name)), np.asarray(values))
+        names.append(name)
+    content = dict(metadata or {})
+    content.update({"columns": names, "rows": len(keys[PLOT_KEYS[0]])})
+    _write_json(os.path.join(directory, COLUMNS_FILE), content)
+    return plot_table(directory)
+
+
+def write_metrics_table(directory, keys, columns, break_columns, break_label):
+    """
+    Write a metrics table
+    :param directory: Directory of the table (Will be created)
+    :param keys: Dictionary of key column name (see METRIC_KEYS) -> list of values, one per row
+    :param columns: List of (column name, array of values), in the same row order as keys
+    :param break_columns: Names of the columns that depend on the height break
+    :param break_label: Placeholder of the height break in the names of the break columns
+    :return: Instance of metrics_table
+    """
+    key_columns = [(key, keys[key]) for key in METRIC_KEYS if key not in PLOT_KEYS]
+    write_plot_table(directory, keys, key_columns + list(columns),
+                     {"break_columns": list(break_columns), "break_label": break_label})
+    return metrics_table(directory)
@@ -0,0 +1,359 @@
+import array
+import math
+from collections import deque
+
+import numpy as np
+
+# Row and column offsets of the eight neighbours, and the distance to them in cells
+NEIGHBOUR_OFFSETS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+NEIGHBOUR_DISTANCES = [math.sqrt(2), 1.0, math.sqrt(2), 1.0, 1.0, math.sqrt(2), 1.0, math.sqrt(2)]
+
+# Flow partition exponent of the multiple flow direction method (Freeman 1991), as used by SAGA
+MFD_EXPONENT = 1.1
+
+# Smallest tangent of slope used for TWI, as in SAGA
+MINIMUM_SLOPE_TANGENT = 0.001
+
+
+# Direction code of a D8 cell without a lower neighbour
+NO_FLOW = 255
+
+# States of the cells in fill_depressions
+_OPEN = 0
+_CLOSED = 1
+_QUEUED = 2
+
+
+def _raise_above(value):
+    # Smallest practical increment above value, so that filled flats still drain towards their outlet
+    return value + max(abs(value), 1.0) * 1e-12
+
+
+def _compact_array(typecode, values):
+    # Copy of a NumPy array as array.array, which gives Python scalars much faster than indexing the NumPy array
+    result = array.array(typecode)
+    data = np.ascontiguousarray(values, dtype=np.dtype(typecode))
+    if hasattr(result, "frombytes"):
+        result.frombytes(memoryview(data).cast("B"))
+    else:
+        result.fromstring(data.tobytes())
+    return result
+
+
+def fill_depressions(dem):
+    """
+    Fill the depressions of a DEM with the Priority-Flood+Epsilon algorithm (Barnes et al. 2014). Cells on the raster
+    edge and next to nodata are the outlets. Filled flats get a tiny gradient towards their outlet, so every cell that
+    is not an outlet has a strictly lower neighbour.
+    A cell enters the priority queue with its original elevation, which is always higher than the elevation of the
+    cell that adds it. The queue therefore releases the cells in the order of their original elevation, so one stable
+    sort of the cell indices replaces the heap and every cell is visited once in O(n) after the O(n log n) sort.
+    :param dem: DEM as 2D array, NaN for nodata
+    :return: Filled DEM as float64 array
+    """
+    rows, cols = dem.shape
+    padded_cols = cols + 2
+    filled = np.pad(dem.astype(np.float64), 1, mode="constant", constant_values=np.nan).ravel()
+    nodata = np.isnan(filled)
+    offsets = [dr * padded_cols + dc for dr, dc in NEIGHBOUR_OFFSETS]
+
+    # Seed the queue with the valid cells that touch the raster edge or nodata
+    open_cells = ~nodata.reshape(rows + 2, cols + 2)
+    surrounded = np.ones((rows, cols), dtype=bool)
+    for dr, dc in NEIGHBOUR_OFFSETS:
+        surrounded &= open_cells[1 + dr:rows + 1 + dr, 1 + dc:cols + 1 + dc]
+    seeds = np.zeros((rows + 2, cols + 2), dtype=bool)
+    seeds[1:-1, 1:-1] = open_cells[1:-1, 1:-1] & ~surrounded
+    states = np.where(nodata, _CLOSED, _OPEN).astype(np.uint8)
+    states[seeds.ravel()] = _QUEUED
+
+    # Cells in the order the priority queue would release them: by elevation, ties by position. NaN sorts last.
+    order = np.argsort(filled, kind="mergesort")[:int((~nodata).sum())]
+    # int32 indices while they fit, C long (64 bits on most platforms) beyond
+    order = _compact_array("i" if filled.size < 2 ** 31 else "l", order)
+    state = bytearray(states.tobytes())
+    del states, nodata
+    values = _compact_array("d", filled)
+    del filled
+
+    pits = deque()
+    for cell in order:
+        if state[cell] != _QUEUED:
+            continue
+        pits.append(cell)
+        while pits:
+            current = pits.popleft()
+            raised = _raise_above(values[current])
+            for offset in offsets:
+                neighbour = current + offset
+                if state[neighbour]:
+                    continue
+                if values[neighbour] <= raised:
+                    values[neighbour] = raised
+                    state[neighbour] = _CLOSED
+                    pits.append(neighbour)
+                else:
+                    state[neighbour] = _QUEUED
+
+    filled = np.frombuffer(values, dtype=np.float64).reshape(rows + 2, cols + 2)
+    return filled[1:-1, 1:-1].copy()
+
+
+def _neighbour_drop(padded, k, cell_size):
+    # Gradient towards neighbour k, NaN where the neighbour is nodata or outside the raster
+    rows = padded.shape[0] - 2
+    cols = padded.shape[1] - 2
+    dr, dc = NEIGHBOUR_OFFSETS[k]
+    neighbour = padded[1 + dr:rows + 1 + dr, 1 + dc:cols + 1 + dc]
+    with np.errstate(invalid="ignore"):
+        return (padded[1:-1, 1:-1] - neighbour) / (NEIGHBOUR_DISTANCES[k] * cell_size)
+
+
+def d8_flow_directions(filled, cell_size):
+    """
+    Compute the deterministic eight neighbour (D8) flow directions. All flow goes to the steepest lower neighbour.
+    :param filled: Depression filled DEM, NaN for nodata
+    :param cell_size: Cell size in map units
+    :return: uint8 array of the index of the receiving neighbour in NEIGHBOUR_OFFSETS, NO_FLOW for none
+    """
+    padded = np.pad(filled, 1, mode="constant", constant_values=np.nan)
+    steepest = np.zeros(filled.shape)
+    codes = np.full(filled.shape, NO_FLOW, dtype=np.uint8)
+    for k in range(8):
+        drop = _neighbour_drop(padded, k, cell_size)
+        with np.errstate(invalid="ignore"):
+            steeper = drop > steepest
+        steepest[steeper] = drop[steeper]
+        codes[steeper] = k
+    return codes
+
+
+def _mfd_share(drop, exponent):
+    with np.errstate(invalid="ignore"):
+        lower = drop > 0
+    return np.where(lower, np.power(np.where(lower, drop, 0.0), exponent), 0.0)
+
+
+def mfd_flow_weights(filled, cell_size, exponent=MFD_EXPONENT):
+    """
+    Compute the multiple flow directions (Freeman 1991). Flow is split between all lower neighbours in proportion to
+    the gradient raised to the exponent. The gradients are computed one neighbour at a time, twice, instead of keeping
+    eight float64 arrays for the normalization.
+    :param filled: Depression filled DEM, NaN for nodata
+    :param cell_size: Cell size in map units
+    :param exponent: Flow partition exponent
+    :return: float32 array of shape (8, rows, cols) with the fraction of flow going to each neighbour
+    """
+    padded = np.pad(filled, 1, mode="constant", constant_values=np.nan)
+    total = np.zeros(filled.shape)
+    for k in range(8):
+        total += _mfd_share(_neighbour_drop(padded, k, cell_size), exponent)
+    weights = np.empty((8,) + filled.shape, dtype=np.float32)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for k in range(8):
+            weights[k] = np.where(total > 0, _mfd_share(_neighbour_drop(padded, k, cell_size), exponent) / total, 0.0)
+    return weights
+
+
+class flow_routing:
+    """
+    Flow directions of a filled DEM: D8 as one direction code per cell, MFD as float32 fractions of the flow going
+    to each neighbour
+    """
+
+    def __init__(self, codes=None, weights=None):
+        """
+        Constructor for flow_routing, from either of
+        :param codes: D8 directions from d8_flow_directions
+        :param weights: MFD fractions from mfd_flow_weights
+        """
+        self.codes = codes
+        self.weights = weights
+        self.shape = codes.shape if codes is not None else weights.shape[1:]
+
+    def gives(self, k):
+        """
+        :return: Boolean array of the cells passing flow to neighbour k
+        """
+        if self.codes is not None:
+            return self.codes == k
+        return self.weights[k] > 0
+
+    def fractions(self, k, cells):
+        """
+        :param k: Index of the neighbour in NEIGHBOUR_OFFSETS
+        :param cells: Flat indices of cells
+        :return: float64 array of the fraction of the flow of the cells going to neighbour k
+        """
+        if self.codes is not None:
+            return (self.codes.ravel()[cells] == k).astype(np.float64)
+        return self.weights[k].ravel()[cells].astype(np.float64)
+
+    def changed(self, other):
+        """
+        :param other: Instance of flow_routing of the same method and shape
+        :return: Boolean array of the cells whose flow is split differently
+        """
+        if self.codes is not None:
+            return self.codes != other.codes
+        changed = np.zeros(self.shape, dtype=bool)
+        for k in range(8):
+            changed |= self.weights[k] != other.weights[k]
+        return changed
+
+
+def route_flow(filled, cell_size, method="D8"):
+    """
+    :param filled: Depression filled DEM, NaN for nodata
+    :param cell_size: Cell size in map units
+    :param method: D8 for deterministic eight neighbour or MFD for multiple flow direction routing
+    :return: Instance of flow_routing
+    """
+    if method == "D8":
+        return flow_routing(codes=d8_flow_directions(filled, cell_size))
+    elif method == "MFD":
+        return flow_routing(weights=mfd_flow_weights(filled, cell_size))
+    raise ValueError("Unknown flow routing method: " + str(method))
+
+
+def _unpadded(cells, cols):
+    # Flat index in the raster of flat indices in the raster padded with one cell
+    return (cells // (cols + 2) - 1) * cols + cells % (cols + 2) - 1
+
+
+def downstream_cells(routing, start):
+    """
+    Find the cells reachable downstream from the start cells, the start cells included
+    :param routing: Instance of flow_routing
+    :param start: Boolean array of the start cells
+    :return: Boolean array of the reached cells
+    """
+    rows, cols = start.shape
+    offsets = [dr * (cols + 2) + dc for dr, dc in NEIGHBOUR_OFFSETS]
+    reached = np.pad(start, 1, mode="constant").ravel()
+    frontier = np.nonzero(reached)[0]
+    while len(frontier) > 0:
+        cells = _unpadded(frontier, cols)
+        receivers = np.concatenate([frontier[routing.fractions(k, cells) > 0] + offsets[k] for k in range(8)])
+        receivers = np.unique(receivers[~reached[receivers]])
+        reached[receivers] = True
+        frontier = receivers
+    return reached.reshape(rows + 2, cols + 2)[1:-1, 1:-1]
+
+
+def accumulate_flow(routing, cell_values, previous=None, affected=None):
+    """
+    Accumulate flow downstream. Cells are processed in waves: a cell is passed on once all of its upstream neighbours
+    have been processed, so each wave is one vectorized operation and every cell is visited once.
+    With previous and affected, only the affected cells are accumulated again. The affected cells have to contain
+    every cell downstream of a cell whose flow changed; the other cells keep their previous value and pass it on to
+    the affected cells they drain to.
+    :param routing: Instance of flow_routing
+    :param cell_values: Flow generated by each cell (e.g. cell area), NaN for nodata
+    :param previous: Previously accumulated flow, or None
+    :param affected: Boolean array of the cells to accumulate again, or None for all cells
+    :return: Accumulated flow, NaN for nodata
+    """
+    rows, cols = cell_values.shape
+    padded_cols = cols + 2
+    size = (rows + 2) * padded_cols
+    offsets = [dr * padded_cols + dc for dr, dc in NEIGHBOUR_OFFSETS]
+
+    nodata = np.isnan(cell_values)
+    accumulated = np.pad(np.where(nodata, 0.0, cell_values), 1, mode="constant").ravel()
+    active = np.pad(~nodata, 1, mode="constant").ravel()
+
+    if previous is not None and affected is not None:
+        # Cells outside the affected area keep their previous flow and pass it to the affected cells
+        active &= np.pad(affected, 1, mode="constant").ravel()
+        kept = np.pad(np.nan_to_num(previous), 1, mode="constant").ravel()
+        accumulated = np.where(active, accumulated, kept)
+        for k in range(8):
+            giving = np.nonzero(np.pad(routing.gives(k), 1, mode="constant").ravel() & ~active)[0]
+            giving = giving[active[giving + offsets[k]]]
+            # A neighbour offset maps distinct cells to distinct receivers, so the receivers are unique
+            accumulated[giving + offsets[k]] += kept[giving] * routing.fractions(k, _unpadded(giving, cols))
+
+    # Number of upstream neighbours that still have to pass their flow to each cell, at most eight
+    donors = np.zeros(size, dtype=np.int8)
+    for k in range(8):
+        giving = np.nonzero(np.pad(routing.gives(k), 1, mode="constant").ravel() & active)[0]
+        donors[giving + offsets[k]] += 1
+
+    wave = np.nonzero(active & (donors == 0))[0]
+    while len(wave) > 0:
+        cells = _unpadded(wave, cols)
+        received = []
+        for k in range(8):
+            fractions = routing.fractions(k, cells)
+            giving = fractions > 0
+            if not giving.any():
+                continue
+            receivers = wave[giving] + offsets[k]
+            # No cell of a wave receives from the wave, so the flow of the wave is final
+            accumulated[receivers] += accumulated[wave[giving]] * fractions[giving]
+            donors[receivers] -= 1
+            received.append(receivers)
+        if not received:
+            break
+        receivers = np.unique(np.concatenate(received))
+        wave = receivers[active[receivers] & (donors[receivers] == 0)]
+
+    accumulated = accumulated.reshape(rows + 2, cols + 2)[1:-1, 1:-1]
+    accumulated[nodata] = np.nan
+    return accumulated
+
+
+def compute_catchment_area(dem, cell_size, method="D8", filled=None):
+    """
+    Compute the catchment area of each cell, like saga:catchmentarea
+    :param dem: DEM as 2D array, NaN for nodata
+    :param cell_size: Cell size in map units
+    :param method: D8 for deterministic eight neighbour or MFD for multiple flow direction routing
+    :param filled: Depression filled DEM if already computed (see fill_depressions), or None
+    :return: Catchment area in square map units, NaN for nodata
+    """
+    if filled is None:
+        filled = fill_depressions(dem)
+    routing = route_flow(filled, cell_size, method)
+    cell_area = np.where(np.isnan(dem), np.nan, cell_size * cell_size)
+    return accumulate_flow(routing, cell_area)
+
+
+def update_catchment_area(dem, cell_size, method, previous_filled, previous_area, full_fraction=0.5):
+    """
+    Compute the catchment area of a changed DEM, accumulating flow only downstream of the cells whose flow
+    directions changed. Depressions are filled again for the whole DEM, as a change can move the spill level of a
+    depression anywhere in it.
+    :param dem: Changed DEM as 2D array, NaN for nodata
+    :param cell_size: Cell size in map units
+    :param method: D8 or MFD, the method of the previous catchment area
+    :param previous_filled: Filled DEM of the previous version (see fill_depressions)
+    :param previous_area: Catchment area of the previous version
+    :param full_fraction: Fraction of affected cells above which the flow is accumulated for the whole DEM
+    :return: Tuple of (catchment area, filled DEM, number of cells accumulated again)
+    """
+    filled = fill_depressions(dem)
+    routing = route_flow(filled, cell_size, method)
+    previous_routing = route_flow(previous_filled, cell_size, method)
+    changed = routing.changed(previous_routing) | (np.isnan(filled) != np.isnan(previous_filled))
+    affected = downstream_cells(routing, changed) | downstream_cells(previous_routing, changed)
+
+    cell_area = np.where(np.isnan(dem), np.nan, cell_size * cell_size)
+    if affected.sum() > full_fraction * affected.size:
+        return accumulate_flow(routing, cell_area), filled, affected.size
+    return accumulate_flow(routing, cell_area, previous_area, affected), filled, int(affected.sum())
+
+
+def compute_twi(catchment_area, slope, cell_size):
+    """
+    Compute the topographic wetness index ln(a / tan(b)), like saga:topographicwetnessindextwi with the specific
+    catchment area a approximated as catchment area / cell size
+    :param catchment_area: Catchment area in square map units
+    :param slope: Slope in degrees
+    :param cell_size: Cell size in map units
+    :return: Topographic wetness index, NaN for nodata
+    """
+    slope_tangent = np.maximum(np.tan(np.radians(slope)), MINIMUM_SLOPE_TANGENT)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.log(catchment_area / cell_size / slope_tangent)
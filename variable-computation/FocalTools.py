@@ -0,0 +1,129 @@
+import numpy as np
+
+# Names of the focal statistics computed for each window radius
+FOCAL_STATISTICS = ["mean", "stdev", "tpi"]
+# Bound of the window sums of squared fixed-point values, which have to fit in int64
+FIXED_POINT_LIMIT = 2.0 ** 62
+# Finest fixed-point step is 1 / MAX_SCALE map units
+MAX_SCALE = 2.0 ** 20
+
+
+def radius_in_cells(radius, cell_size):
+    """
+    :param radius: Window radius in map units
+    :param cell_size: Cell size in map units
+    :return: Window radius in cells, at least one
+    """
+    return max(int(round(float(radius) / cell_size)), 1)
+
+
+def summed_area_table(values):
+    """
+    Compute the summed-area table (integral image) of an array. The sum of any rectangle of the array can be read from
+    the table with four lookups.
+    :param values: 2D array without NaN
+    :return: Array of the type of values one row and one column larger than values, table[r, c] = values[:r, :c].sum()
+    """
+    table = np.zeros((values.shape[0] + 1, values.shape[1] + 1), dtype=values.dtype)
+    np.cumsum(values, axis=0, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+def window_sums(table, halo, radius, rows, cols):
+    """
+    Sum of the square window of size 2 * radius + 1 around every cell, read from a summed-area table
+    :param table: Summed-area table of an array padded with halo cells on each side
+    :param halo: Number of halo cells of the padded array
+    :param radius: Window radius in cells, not larger than halo
+    :param rows: Number of rows of the unpadded array
+    :param cols: Number of columns of the unpadded array
+    :return: Array of shape (rows, cols)
+    """
+    low = halo - radius
+    high = halo + radius + 1
+    return (table[high:high + rows, high:high + cols] - table[low:low + rows, high:high + cols] -
+            table[high:high + rows, low:low + cols] + table[low:low + rows, low:low + cols])
+
+
+def fixed_point(minimum, maximum, radius):
+    """
+    Fixed-point representation of a raster for exact window sums: values are centred on the middle of the value range
+    and scaled by the largest power of two for which the window sums of the squared values fit in int64. The tables
+    of int64 values wrap around, but the window sums read from them are exact, so every window gets the same sums
+    wherever its table starts, and tiled output is identical to whole-raster output.
+    :param minimum: Minimum value of the whole raster
+    :param maximum: Maximum value of the whole raster
+    :param radius: Largest window radius in cells
+    :return: Tuple of (offset, scale), the fixed-point value is round((value - offset) * scale)
+    """
+    cells = float(2 * radius + 1) ** 2
+    span = (maximum - minimum) / 2.0
+    scale = MAX_SCALE
+    while (span * scale + 1) ** 2 * cells >= FIXED_POINT_LIMIT:
+        scale /= 2
+    return float(np.round((minimum + maximum) / 2.0 * scale) / scale), scale
+
+
+def focal_statistics_from_padded(padded, radii, halo, complete_radii=(), centring=None):
+    """
+    Compute the focal mean, standard deviation and topographic position index for several square windows from one set
+    of summed-area tables, so the cost per cell does not depend on the window size. Nodata cells in the window are
+    left out; windows of the radii in complete_radii get nodata if any cell of the window is nodata, which is how
+    gdalogr:tpitopographicpositionindex treats the 3x3 window.
+    TPI is the difference between the cell and the mean of the other cells of the window.
+    :param padded: Array padded with halo cells on each side, NaN for nodata
+    :param radii: List of window radii in cells, none larger than halo
+    :param halo: Number of halo cells of the padded array
+    :param complete_radii: Radii for which the whole window has to be valid
+    :param centring: Tuple of (offset, scale) of the whole raster from fixed_point, so that all blocks of a raster
+    are computed alike. None takes them from the padded array.
+    :return: Dictionary of radius -> dictionary of statistic name (see FOCAL_STATISTICS) -> array, each the size of the
+    unpadded array
+    """
+    rows = padded.shape[0] - 2 * halo
+    cols = padded.shape[1] - 2 * halo
+    valid = ~np.isnan(padded)
+
+    if centring is None:
+        centring = fixed_point(np.nanmin(padded), np.nanmax(padded), max(radii)) if valid.any() else (0.0, 1.0)
+    offset, scale = centring
+    fixed = np.where(valid, np.round((padded - offset) * scale), 0.0).astype(np.int64)
+    sums = summed_area_table(fixed)
+    squares = summed_area_table(fixed * fixed)
+    counts = summed_area_table(valid.astype(np.int64))
+
+    centre = fixed[halo:halo + rows, halo:halo + cols].astype(np.float64)
+    centre_valid = valid[halo:halo + rows, halo:halo + cols]
+
+    statistics = {}
+    for radius in radii:
+        total = window_sums(sums, halo, radius, rows, cols).astype(np.float64)
+        squared = window_sums(squares, halo, radius, rows, cols).astype(np.float64)
+        count = window_sums(counts, halo, radius, rows, cols).astype(np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = total / count
+            stdev = np.sqrt(np.maximum(squared / count - mean * mean, 0.0)) / scale
+            tpi = (centre - (total - centre) / (count - 1)) / scale
+
+        missing = ~centre_valid | (count < 2)
+        if radius in complete_radii:
+            missing |= count < (2 * radius + 1) ** 2
+        mean = mean / scale + offset
+        for array in (mean, stdev, tpi):
+            array[missing] = np.nan
+        statistics[radius] = {"mean": mean, "stdev": stdev, "tpi": tpi}
+    return statistics
+
+
+def compute_focal_statistics(array, radii, complete_radii=()):
+    """
+    Compute the focal statistics of a whole raster (see focal_statistics_from_padded)
+    :param array: 2D array, NaN for nodata
+    :param radii: List of window radii in cells
+    :param complete_radii: Radii for which the whole window has to be valid
+    :return: Dictionary of radius -> dictionary of statistic name -> array
+    """
+    halo = max(radii)
+    padded = np.pad(array.astype(np.float64), halo, mode="constant", constant_values=np.nan)
+    return focal_statistics_from_padded(padded, radii, halo, complete_radii)
@@ -1,11 +1,13 @@
 import os
 from qgis.core import QgsRasterLayer, QgsVectorLayer
+import TraceTools
 
 
 def create_folder_if_not_exists(folder_path):
     if not os.path.exists(folder_path):
         os.makedirs(folder_path)
 
+@TraceTools.traced("io", path_argument=0)
 def load_raster(raster_path):
     """
     Method for loading raster to QGIS. Returns it as QgsRasterLayer
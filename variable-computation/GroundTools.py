@@ -0,0 +1,239 @@
+import json
+import os
+
+import numpy as np
+
+import LasTools
+
+GROUND_CLASSES = [2]
+
+
+class ground_model:
+    """
+    Ground elevation grid (DTM) for normalizing point heights. The grid is kept in memory, or memory-mapped, and
+    sampled for many points at once.
+    """
+
+    def __init__(self, elevations, x_min, y_max, cell_size):
+        """
+        Constructor for ground_model
+        :param elevations: 2D array of ground elevations, first row at the top, NaN for nodata
+        :param x_min: x of the left edge of the grid
+        :param y_max: y of the top edge of the grid
+        :param cell_size: Cell size in map units
+        """
+        self.elevations = elevations
+        self.x_min = x_min
+        self.y_max = y_max
+        self.cell_size = cell_size
+
+    def elevation(self, x, y):
+        """
+        Interpolate the ground elevation bilinearly between the cell centres. Nodata cells are left out of the
+        interpolation and points beyond the outermost cell centres take the value of the edge.
+        :param x: x coordinates of the points
+        :param y: y coordinates of the points
+        :return: Ground elevation at each point, NaN where all surrounding cells are nodata
+        """
+        rows, cols = self.elevations.shape
+        col_position = np.clip((np.asarray(x, dtype=np.float64) - self.x_min) / self.cell_size - 0.5, 0, cols - 1)
+        row_position = np.clip((self.y_max - np.asarray(y, dtype=np.float64)) / self.cell_size - 0.5, 0, rows - 1)
+        col_lower = np.floor(col_position).astype(np.int64)
+        row_lower = np.floor(row_position).astype(np.int64)
+        col_upper = np.minimum(col_lower + 1, cols - 1)
+        row_upper = np.minimum(row_lower + 1, rows - 1)
+        col_weight = col_position - col_lower
+        row_weight = row_position - row_lower
+
+        total = np.zeros(col_position.shape)
+        weights = np.zeros(col_position.shape)
+        for row, row_factor in ((row_lower, 1 - row_weight), (row_upper, row_weight)):
+            for col, col_factor in ((col_lower, 1 - col_weight), (col_upper, col_weight)):
+                values = np.asarray(self.elevations[row, col], dtype=np.float64)
+                weight = np.where(np.isnan(values), 0.0, row_factor * col_factor)
+                total += weight * np.nan_to_num(values)
+                weights += weight
+        with np.errstate(divide="ignore", invalid="ignore"):
+            elevation = total / weights
+        elevation[weights == 0] = np.nan
+        return elevation
+
+    def heights(self, x, y, z):
+        """
+        :return: Height of the points above the ground, like FUSION clipdata /height
+        """
+        return np.asarray(z, dtype=np.float64) - self.elevation(x, y)
+
+
+def read_ascii_grid(grid_path):
+    """
+    Read an ESRI ASCII grid, e.g. a FUSION DTM converted with DTM2ASCII.exe
+    :param grid_path: Path to the .asc file
+    :return: Instance of ground_model
+    """
+    header = {}
+    with open(grid_path, 'r') as f:
+        for _ in range(6):
+            position = f.tell()
+            line = f.readline().split()
+            if not line or not line[0][0].isalpha():
+                f.seek(position)
+                break
+            header[line[0].lower()] = float(line[1])
+        elevations = np.loadtxt(f, dtype=np.float64, ndmin=2)
+
+    cell_size = header["cellsize"]
+    rows = int(header["nrows"])
+    if "xllcenter" in header:
+        x_min = header["xllcenter"] - cell_size / 2.0
+        y_min = header["yllcenter"] - cell_size / 2.0
+    else:
+        x_min = header["xllcorner"]
+        y_min = header["yllcorner"]
+    if "nodata_value" in header:
+        elevations[elevations == header["nodata_value"]] = np.nan
+    return ground_model(elevations, x_min, y_min + rows * cell_size, cell_size)
+
+
+def grid_bounds(headers, cell_size):
+    """
+    :param headers: List of LasTools.las_header
+    :param cell_size: Cell size in map units
+    :return: Tuple of (x min, y max, rows, cols) of a grid covering all files, snapped to the cell size
+    """
+    x_min = min(header.min_x for header in headers)
+    y_min = min(header.min_y for header in headers)
+    x_max = max(header.max_x for header in headers)
+    y_max = max(header.max_y for header in headers)
+    x_min = np.floor(x_min / cell_size) * cell_size
+    y_max = np.ceil(y_max / cell_size) * cell_size
+    cols = int(np.floor((x_max - x_min) / cell_size)) + 1
+    rows = int(np.floor((y_max - y_min) / cell_size)) + 1
+    return x_min, y_max, rows, cols
+
+
+def grid_points(chunks, sums, counts, x_min, y_max, cell_size, classes=GROUND_CLASSES):
+    """
+    Add the elevations of the points of the given classes to per cell sums and counts, one chunk at a time
+    :param chunks: Iterable of LasTools.point_chunk, e.g. from LasTools.read_chunks
+    :param sums: 2D array (or numpy.memmap) of elevation sums, updated in place
+    :param counts: 2D array (or numpy.memmap) of point counts, updated in place
+    :param x_min: x of the left edge of the grid
+    :param y_max: y of the top edge of the grid
+    :param cell_size: Cell size in map units
+    :param classes: List of classifications of the ground points
+    """
+    rows, cols = sums.shape
+    flat_sums = sums.reshape(-1)
+    flat_counts = counts.reshape(-1)
+    for chunk in chunks:
+        ground = np.nonzero(np.isin(chunk.classification, classes))[0]
+        if len(ground) == 0:
+            continue
+        col = np.clip(np.floor((chunk.x[ground] - x_min) / cell_size).astype(np.int64), 0, cols - 1)
+        row = np.clip(np.floor((y_max - chunk.y[ground]) / cell_size).astype(np.int64), 0, rows - 1)
+        cells, inverse = np.unique(row * cols + col, return_inverse=True)
+        flat_sums[cells] += np.bincount(inverse, chunk.z[ground])
+        flat_counts[cells] += np.bincount(inverse)
+
+
+def fill_gaps(elevations, iterations):
+    """
+    Fill nodata cells from their neighbours, one ring of cells per iteration: every nodata cell next to a cell with
+    a value gets the mean of its valid neighbours
+    :param elevations: 2D array, NaN for nodata
+    :param iterations: Maximum number of iterations, gaps wider than twice this stay nodata
+    :return: Filled copy of the array
+    """
+    filled = np.array(elevations, dtype=np.float64)
+    rows, cols = filled.shape
+    for _ in range(iterations):
+        missing = np.isnan(filled)
+        if not missing.any():
+            break
+        padded = np.pad(filled, 1, mode="constant", constant_values=np.nan)
+        total = np.zeros(filled.shape)
+        count = np.zeros(filled.shape)
+        for row_offset in (0, 1, 2):
+            for col_offset in (0, 1, 2):
+                if row_offset == 1 and col_offset == 1:
+                    continue
+                values = padded[row_offset:row_offset + rows, col_offset:col_offset + cols]
+                valid = ~np.isnan(values)
+                total += np.where(valid, values, 0.0)
+                count += valid
+        new = missing & (count > 0)
+        if not new.any():
+            break
+        filled[new] = total[new] / count[new]
+    return filled
+
+
+def position_path(model_path):
+    return os.path.splitext(model_path)[0] + ".json"
+
+
+def ground_model_exists(model_path):
+    """
+    :param model_path: Path to the .npy file of a DTM written by create_ground_model
+    :return: True if the DTM was written completely. The position file is written last, so an interrupted
+    create_ground_model is not mistaken for a complete one.
+    """
+    return os.path.exists(model_path) and os.path.exists(position_path(model_path))
+
+
+def create_ground_model(las_paths, output_path, cell_size=1.0, classes=GROUND_CLASSES, fill_iterations=32,
+                        strip_rows=1024, chunk_size=LasTools.DEFAULT_CHUNK_SIZE):
+    """
+    Grid the ground points of LAS files to a DTM like gridsurfacecreate.exe: the elevation of a cell is the mean of
+    its ground points and cells without points are filled from their neighbours. The grid is built in memory-mapped
+    files and the points are read in chunks, so memory use depends on neither the size of the area nor of the files.
+    :param las_paths: List of paths to LAS or LAZ files
+    :param output_path: Path to the output .npy file, with the grid position in a .json file next to it
+    :param cell_size: Cell size in map units
+    :param classes: List of classifications of the ground points
+    :param fill_iterations: Maximum number of gap filling iterations (see fill_gaps)
+    :param strip_rows: Number of rows filled at a time
+    :param chunk_size: Number of points read at a time
+    :return: Instance of ground_model, memory-mapped
+    """
+    if os.path.exists(position_path(output_path)):
+        os.remove(position_path(output_path))
+    x_min, y_max, rows, cols = grid_bounds([LasTools.read_header(path) for path in las_paths], cell_size)
+    sums_path = output_path + ".sums.tmp"
+    counts_path = output_path + ".counts.tmp"
+    sums = np.memmap(sums_path, dtype=np.float64, mode="w+", shape=(rows, cols))
+    counts = np.memmap(counts_path, dtype=np.int32, mode="w+", shape=(rows, cols))
+    for path in las_paths:
+        grid_points(LasTools.read_chunks(path, chunk_size), sums, counts, x_min, y_max, cell_size, classes)
+
+    # Fill strip by strip, with as many halo rows as there are iterations so that the strips match a whole fill
+    elevations = np.lib.format.open_memmap(output_path, mode="w+", dtype=np.float32, shape=(rows, cols))
+    for row_off in range(0, rows, strip_rows):
+        first = max(row_off - fill_iterations, 0)
+        last = min(row_off + strip_rows + fill_iterations, rows)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = np.where(counts[first:last] > 0, sums[first:last] / counts[first:last], np.nan)
+        filled = fill_gaps(means, fill_iterations)
+        elevations[row_off:min(row_off + strip_rows, rows)] = filled[row_off - first:row_off - first + strip_rows]
+    elevations.flush()
+    del sums, counts, elevations
+    os.remove(sums_path)
+    os.remove(counts_path)
+
+    # Written last, see ground_model_exists
+    with open(position_path(output_path), 'w') as f:
+        json.dump({"x_min": x_min, "y_max": y_max, "cell_size": cell_size}, f)
+    return load_ground_model(output_path)
+
+
+def load_ground_model(model_path):
+    """
+    Open a DTM written by create_ground_model, memory-mapped so that it is shared by all height normalizations
+    :param model_path: Path to the .npy file
+    :return: Instance of ground_model
+    """
+    with open(position_path(model_path), 'r') as f:
+        position = json.load(f)
+    return ground_model(np.load(model_path, mmap_mode="r"), position["x_min"], position["y_max"],
+                        position["cell_size"])
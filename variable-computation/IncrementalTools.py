@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import BlockTools
+
+DEFAULT_BLOCK_SIZE = 256
+
+
+def block_checksums(source, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Compute a checksum of every block of a raster. Nodata cells are hashed as one canonical NaN, so a raster written
+    again with another nodata value or file format has the same checksums.
+    :param source: Block source of the raster (RasterTools.gdal_band_source, BlockTools.array_source)
+    :param block_size: Size of the block side in cells
+    :return: Manifest dictionary with block_size, rows, cols and checksums ("row,col" of the block -> SHA-1)
+    """
+    checksums = {}
+    for window in BlockTools.generate_windows(source.rows, source.cols, block_size):
+        block = source.read_block(window.row_off, window.col_off, window.rows, window.cols)
+        block[np.isnan(block)] = np.nan
+        key = str(window.row_off // block_size) + "," + str(window.col_off // block_size)
+        checksums[key] = hashlib.sha1(np.ascontiguousarray(block).tobytes()).hexdigest()
+    manifest = {"block_size": block_size, "rows": source.rows, "cols": source.cols, "checksums": checksums}
+    if hasattr(source, "grid"):
+        manifest["geotransform"] = list(source.grid.geotransform)
+    return manifest
+
+
+def read_manifest(manifest_path):
+    """
+    :param manifest_path: Path to the manifest JSON file
+    :return: Manifest dictionary, or None if the file does not exist or cannot be read
+    """
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def write_manifest(manifest_path, manifest):
+    temporary_path = manifest_path + ".tmp"
+    with open(temporary_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    os.rename(temporary_path, manifest_path)
+
+
+def dirty_windows(previous, current):
+    """
+    Find the blocks whose checksum changed. Adjacent changed blocks on the same block row are merged to one window.
+    :param previous: Manifest of the previous version, or None
+    :param current: Manifest of the current version
+    :return: List of BlockTools.raster_window, or None if the versions cannot be compared (no previous manifest,
+    different size, grid or block size) and everything has to be computed
+    """
+    if previous is None:
+        return None
+    for key in ["block_size", "rows", "cols", "geotransform"]:
+        if previous.get(key) != current.get(key):
+            return None
+
+    block_size = current["block_size"]
+    windows = []
+    for row_off in range(0, current["rows"], block_size):
+        rows = min(block_size, current["rows"] - row_off)
+        start = None
+        for col_off in range(0, current["cols"] + block_size, block_size):
+            key = str(row_off // block_size) + "," + str(col_off // block_size)
+            changed = col_off < current["cols"] and previous["checksums"].get(key) != current["checksums"][key]
+            if changed and start is None:
+                start = col_off
+            elif not changed and start is not None:
+                windows.append(BlockTools.raster_window(row_off, start, rows, min(col_off, current["cols"]) - start))
+                start = None
+    return windows
+
+
+def grow_windows(windows, halo, rows, cols):
+    """
+    :param windows: List of BlockTools.raster_window
+    :param halo: Number of cells to add on each side, the footprint of the operator
+    :param rows: Number of rows in the raster
+    :param cols: Number of columns in the raster
+    :return: List of grown windows, clipped to the raster
+    """
+    return merge_windows([window.grow(halo, rows, cols) for window in windows])
+
+
+def merge_windows(windows):
+    """
+    Replace overlapping windows by their bounding window until no windows overlap, so no cell is computed twice
+    :param windows: List of BlockTools.raster_window
+    :return: List of non-overlapping windows covering all cells of the input windows
+    """
+    merged = list(windows)
+    i = 0
+    while i < len(merged):
+        for j in range(i + 1, len(merged)):
+            a, b = merged[i], merged[j]
+            if (a.row_off < b.row_off + b.rows and b.row_off < a.row_off + a.rows and
+                    a.col_off < b.col_off + b.cols and b.col_off < a.col_off + a.cols):
+                row_off = min(a.row_off, b.row_off)
+                col_off = min(a.col_off, b.col_off)
+                merged[i] = BlockTools.raster_window(row_off, col_off,
+                                                     max(a.row_off + a.rows, b.row_off + b.rows) - row_off,
+                                                     max(a.col_off + a.cols, b.col_off + b.cols) - col_off)
+                del merged[j]
+                i = -1
+                break
+        i += 1
+    return merged
+
+
+class dem_changes:
+    """
+    Changes of a DEM since the previous run, found by comparing block checksums to the manifest of the previous run.
+    The manifest also records the parameters every tool was last run with, so outputs computed with other parameters
+    are never updated in part.
+    """
+
+    def __init__(self, manifest_path, source, block_size=DEFAULT_BLOCK_SIZE):
+        """
+        Constructor for dem_changes
+        :param manifest_path: Path to the manifest JSON file next to the outputs
+        :param source: Block source of the current DEM
+        :param block_size: Size of the checksum block side in cells
+        """
+        self.manifest_path = manifest_path
+        self.rows = source.rows
+        self.cols = source.cols
+        self.previous = read_manifest(manifest_path)
+        # The manifest is written again only when all outputs are up to date, so an interrupted run computes
+        # everything on the next run instead of trusting outputs that were updated in part
+        if self.previous is not None:
+            os.remove(manifest_path)
+        self.current = block_checksums(source, block_size)
+        self.windows = dirty_windows(self.previous, self.current)
+
+    def can_update(self, tool, parameters, output_paths):
+        """
+        :param tool: Name of the tool
+        :param parameters: JSON serializable parameters of the tool
+        :param output_paths: List of output files of the tool
+        :return: True if the outputs of the previous run exist, were computed with the same parameters and can be
+        updated in the changed windows only
+        """
+        if self.windows is None:
+            return False
+        previous_parameters = self.previous.get("tools", {}).get(tool)
+        if previous_parameters != json.loads(json.dumps(parameters)):
+            return False
+        return all(os.path.exists(path) for path in output_paths)
+
+    def grown_windows(self, halo):
+        """
+        :param halo: Footprint of the operator in cells
+        :return: Windows of the outputs that the changes reach
+        """
+        return grow_windows(self.windows, halo, self.rows, self.cols)
+
+    def commit(self, parameters_by_tool):
+        """
+        Write the manifest of the current DEM, after all outputs have been brought up to date
+        :param parameters_by_tool: Dictionary of tool name -> parameters the outputs were computed with
+        """
+        manifest = dict(self.current)
+        manifest["tools"] = parameters_by_tool
+        write_manifest(self.manifest_path, manifest)
@@ -0,0 +1,171 @@
+import logging
+import os
+import subprocess
+import time
+from multiprocessing.pool import ThreadPool
+
+import TraceTools
+
+DONE_SUFFIX = ".done"
+
+
+class command_job:
+    """
+    One command line call producing one output file
+    """
+
+    def __init__(self, name, command, output_path):
+        """
+        Constructor for command_job
+        :param name: Unique name of the job, e.g. the plot, used to order the shards
+        :param command: Command line as string
+        :param output_path: File the command creates
+        """
+        self.name = name
+        self.command = command
+        self.output_path = output_path
+
+    def marker_path(self):
+        return self.output_path + DONE_SUFFIX
+
+    def is_done(self):
+        """
+        :return: True if an earlier run completed the job. The output of an interrupted job can exist without being
+        complete, so the marker written after a successful run is checked too.
+        """
+        return os.path.exists(self.marker_path()) and os.path.exists(self.output_path)
+
+
+def run_command(command, timeout=None, poll_interval=0.1):
+    """
+    Run a command and wait for it to finish
+    :param command: Command line as string
+    :param timeout: Maximum run time in seconds, None for no limit
+    :param poll_interval: Seconds between checks of a running command
+    :return: Exit code of the command
+    :throws: Throws a RuntimeError if the command did not finish in time (the process is killed)
+    """
+    process = subprocess.Popen(command)
+    TraceTools.watch_process(process.pid)
+    if timeout is None:
+        return process.wait()
+    deadline = time.time() + timeout
+    while process.poll() is None:
+        if time.time() > deadline:
+            process.kill()
+            process.wait()
+            raise RuntimeError("Timeout after " + str(timeout) + " s: " + command)
+        time.sleep(poll_interval)
+    return process.returncode
+
+
+class job_executor:
+    """
+    Runs command jobs in a bounded pool of worker threads, each waiting on its own subprocess. Failed jobs are retried
+    and completed jobs are marked, so a run can be interrupted and resumed.
+    """
+
+    def __init__(self, workers=4, retries=2, timeout=None, retry_delay=1.0):
+        """
+        Constructor for job_executor
+        :param workers: Number of jobs run at the same time
+        :param retries: Number of times a failed job is run again
+        :param timeout: Maximum run time of one job in seconds, None for no limit
+        :param retry_delay: Seconds to wait before the first retry, doubled for every further retry
+        """
+        self.workers = workers
+        self.retries = retries
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+
+    def run_job(self, job):
+        """
+        Run one job with retries
+        :param job: Instance of command_job
+        :return: Tuple of (job name, None on success or the error message)
+        """
+        if job.is_done():
+            return job.name, None
+
+        executable = os.path.basename(job.command.split(" ")[0])
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+                logging.warning("Retrying " + job.name + " (attempt " + str(attempt + 1) + "): " + error)
+            # cloudmetrics appends to an existing output, so the output of an earlier attempt or an interrupted run
+            # would give the shard a second header and duplicate rows
+            for path in (job.marker_path(), job.output_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            with TraceTools.span(executable, "subprocess", command=job.command, attempt=attempt):
+                try:
+                    exit_code = run_command(job.command, self.timeout)
+                except (RuntimeError, OSError) as e:
+                    error = str(e)
+                    continue
+            if exit_code != 0:
+                error = "Exit code " + str(exit_code) + ": " + job.command
+            elif not os.path.exists(job.output_path):
+                error = "No output " + job.output_path + ": " + job.command
+            else:
+                open(job.marker_path(), 'w').close()
+                return job.name, None
+        return job.name, error
+
+    def run(self, jobs):
+        """
+        Run jobs in parallel
+        :param jobs: List of command_job instances
+        :return: Dictionary of job name -> error message of the jobs that failed after all retries
+        """
+        if not jobs:
+            return {}
+        pool = ThreadPool(min(self.workers, len(jobs)))
+        try:
+            results = pool.map(self.run_job, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        failures = dict((name, error) for name, error in results if error is not None)
+        for name in sorted(failures):
+            logging.error("Job " + name + " failed: " + failures[name])
+        return failures
+
+
+def shard_path(output_path, name):
+    """
+    :param output_path: Path to the merged output file
+    :param name: Name of the job
+    :return: Path to the output shard of one job, in a folder next to the merged output
+    """
+    base, extension = os.path.splitext(output_path)
+    return os.path.join(base + "_shards", name + extension)
+
+
+def merge_shards(shard_paths, output_path, header_lines=1):
+    """
+    Merge CSV shards into one file in the given order, keeping the header of the first shard only. Missing shards
+    (failed jobs) are skipped.
+    :param shard_paths: List of shard paths, in the order of the rows in the output
+    :param output_path: Path to the merged output file
+    :param header_lines: Number of header lines in every shard
+    :return: Number of shards merged
+    """
+    merged = 0
+    temporary_path = output_path + ".tmp"
+    with open(temporary_path, 'w') as output:
+        for path in shard_paths:
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r') as shard:
+                lines = shard.readlines()
+            if merged > 0:
+                lines = lines[header_lines:]
+            for line in lines:
+                output.write(line if line.endswith("\n") else line + "\n")
+            merged += 1
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    os.rename(temporary_path, output_path)
+    return merged
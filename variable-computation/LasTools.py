@@ -0,0 +1,532 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+try:
+    import laspy
+except ImportError:
+    laspy = None
+
+# Fields of the public header block shared by all LAS versions: (name, struct format, byte offset)
+HEADER_FIELDS = [("file_source_id", "<H", 4),
+                 ("global_encoding", "<H", 6),
+                 ("version_major", "<B", 24),
+                 ("version_minor", "<B", 25),
+                 ("header_size", "<H", 94),
+                 ("offset_to_points", "<I", 96),
+                 ("vlr_count", "<I", 100),
+                 ("point_format", "<B", 104),
+                 ("record_length", "<H", 105),
+                 ("legacy_point_count", "<I", 107),
+                 ("scale", "<3d", 131),
+                 ("offset", "<3d", 155),
+                 ("max_x", "<d", 179),
+                 ("min_x", "<d", 187),
+                 ("max_y", "<d", 195),
+                 ("min_y", "<d", 203),
+                 ("max_z", "<d", 211),
+                 ("min_z", "<d", 219)]
+LEGACY_RETURN_COUNTS_OFFSET = 111
+# LAS 1.4 header fields
+EVLR_OFFSET = 235
+POINT_COUNT_OFFSET = 247
+RETURN_COUNTS_OFFSET = 255
+HEADER_SIZES = {0: 227, 1: 227, 2: 227, 3: 235, 4: 375}
+
+_LEGACY_FIELDS = [("X", "<i4"), ("Y", "<i4"), ("Z", "<i4"), ("intensity", "<u2"), ("return_byte", "u1"),
+                  ("classification_byte", "u1"), ("scan_angle_rank", "i1"), ("user_data", "u1"),
+                  ("point_source_id", "<u2")]
+_EXTENDED_FIELDS = [("X", "<i4"), ("Y", "<i4"), ("Z", "<i4"), ("intensity", "<u2"), ("return_byte", "u1"),
+                    ("flags_byte", "u1"), ("classification_byte", "u1"), ("user_data", "u1"), ("scan_angle", "<i2"),
+                    ("point_source_id", "<u2"), ("gps_time", "<f8")]
+_GPS_TIME = [("gps_time", "<f8")]
+_RGB = [("red", "<u2"), ("green", "<u2"), ("blue", "<u2")]
+_NIR = [("nir", "<u2")]
+_WAVE_PACKET = [("wave_packet_index", "u1"), ("wave_offset", "<u8"), ("wave_size", "<u4"),
+                ("wave_return_location", "<f4"), ("wave_x", "<f4"), ("wave_y", "<f4"), ("wave_z", "<f4")]
+
+# Fields of the point data record formats 0 - 10
+POINT_FORMAT_FIELDS = {0: _LEGACY_FIELDS,
+                       1: _LEGACY_FIELDS + _GPS_TIME,
+                       2: _LEGACY_FIELDS + _RGB,
+                       3: _LEGACY_FIELDS + _GPS_TIME + _RGB,
+                       4: _LEGACY_FIELDS + _GPS_TIME + _WAVE_PACKET,
+                       5: _LEGACY_FIELDS + _GPS_TIME + _RGB + _WAVE_PACKET,
+                       6: _EXTENDED_FIELDS,
+                       7: _EXTENDED_FIELDS + _RGB,
+                       8: _EXTENDED_FIELDS + _RGB + _NIR,
+                       9: _EXTENDED_FIELDS + _WAVE_PACKET,
+                       10: _EXTENDED_FIELDS + _RGB + _NIR + _WAVE_PACKET}
+
+DEFAULT_INDEX_CELL_SIZE = 10.0
+DEFAULT_CHUNK_SIZE = 2000000
+INDEX_SUFFIX = ".idx.npz"
+CATALOG_FILE = "las_catalog.json"
+
+
+def point_dtype(point_format, record_length=None):
+    """
+    :param point_format: Point data record format, 0 - 10
+    :param record_length: Length of a point record in bytes, longer than the format when the points have extra bytes
+    :return: NumPy structured dtype of a point record
+    :throws: Throws a ValueError for unknown formats or records shorter than the format
+    """
+    if point_format not in POINT_FORMAT_FIELDS:
+        raise ValueError("Unsupported LAS point format: " + str(point_format))
+    fields = list(POINT_FORMAT_FIELDS[point_format])
+    size = np.dtype(fields).itemsize
+    if record_length is not None and record_length < size:
+        raise ValueError("Point record length " + str(record_length) + " is too short for format " +
+                         str(point_format))
+    if record_length is not None and record_length > size:
+        fields.append(("extra_bytes", "V" + str(record_length - size)))
+    return np.dtype(fields)
+
+
+class las_header:
+    """
+    Public header block of a LAS file. The raw bytes of the header and the variable length records are kept, so
+    that subsets of the points can be written with the same metadata (see write_las).
+    """
+
+    def __init__(self, raw):
+        """
+        Constructor for las_header
+        :param raw: Bytes of the file from the start to the first point record
+        :throws: Throws a ValueError if the bytes are not a LAS header
+        """
+        if raw[:4] != b"LASF":
+            raise ValueError("Not a LAS file")
+        self.raw = raw
+        for name, field_format, offset in HEADER_FIELDS:
+            value = struct.unpack_from(field_format, raw, offset)
+            setattr(self, name, value[0] if len(value) == 1 else value)
+        # LAZ files flag the compression in the high bits of the point format
+        self.compressed = bool(self.point_format & 0xC0)
+        self.point_format &= 0x3F
+        self.point_count = self.legacy_point_count
+        if self.version_minor >= 4 and self.header_size >= HEADER_SIZES[4]:
+            self.point_count = struct.unpack_from("<Q", raw, POINT_COUNT_OFFSET)[0]
+
+    def dtype(self):
+        return point_dtype(self.point_format, self.record_length)
+
+    def bounds(self):
+        """
+        :return: Tuple of (min x, min y, max x, max y)
+        """
+        return self.min_x, self.min_y, self.max_x, self.max_y
+
+
+def read_header(las_path):
+    """
+    Read the header and the variable length records of a LAS file
+    :param las_path: Path to the LAS file
+    :return: Instance of las_header
+    """
+    with open(las_path, 'rb') as f:
+        start = f.read(HEADER_SIZES[4])
+        offset_to_points = struct.unpack_from("<I", start, 96)[0]
+        f.seek(0)
+        return las_header(f.read(offset_to_points))
+
+
+class las_file:
+    """
+    LAS file with its point records memory-mapped as a NumPy structured array. Points are read from disk only when
+    they are accessed, so selecting a few points of a large file reads only those.
+    """
+
+    def __init__(self, las_path):
+        """
+        Constructor for las_file
+        :param las_path: Path to the LAS file
+        """
+        self.path = las_path
+        self.header = read_header(las_path)
+        if self.header.compressed:
+            raise ValueError("Compressed (LAZ) files cannot be memory-mapped, read them with read_chunks: " + las_path)
+        if self.header.point_count > 0:
+            self.points = np.memmap(las_path, dtype=self.header.dtype(), mode="r",
+                                    offset=self.header.offset_to_points, shape=(self.header.point_count,))
+        else:
+            self.points = np.zeros(0, dtype=self.header.dtype())
+        self._index = None
+
+    def __len__(self):
+        return self.header.point_count
+
+    def coordinates(self, indices=None):
+        """
+        :param indices: Point indices, or None for all points
+        :return: Tuple of scaled (x, y, z) float64 arrays
+        """
+        points = self.points if indices is None else self.points[indices]
+        scale = self.header.scale
+        offset = self.header.offset
+        return (points["X"] * scale[0] + offset[0], points["Y"] * scale[1] + offset[1],
+                points["Z"] * scale[2] + offset[2])
+
+    def classification(self, indices=None):
+        """
+        :param indices: Point indices, or None for all points
+        :return: Classification of the points (the flag bits of formats 0 - 5 removed)
+        """
+        values = self.points["classification_byte"] if indices is None else \
+            self.points["classification_byte"][indices]
+        if self.header.point_format < 6:
+            return values & 0x1F
+        return values
+
+    def return_numbers(self, indices=None):
+        """
+        :param indices: Point indices, or None for all points
+        :return: Tuple of (return number, number of returns) arrays
+        """
+        values = self.points["return_byte"] if indices is None else self.points["return_byte"][indices]
+        if self.header.point_format < 6:
+            return values & 0x07, (values >> 3) & 0x07
+        return values & 0x0F, (values >> 4) & 0x0F
+
+    def index(self, cell_size=DEFAULT_INDEX_CELL_SIZE):
+        """
+        :param cell_size: Cell size of the index in map units
+        :return: The grid index of the file, loaded from its index file or built and saved on first use
+        """
+        if self._index is None or self._index.cell_size != cell_size:
+            self._index = load_or_build_index(self, cell_size)
+        return self._index
+
+    def query_bbox(self, x_min, y_min, x_max, y_max, classes=None):
+        """
+        Find the points inside a bounding box. Only the index cells overlapping the box are read.
+        :param x_min: Minimum x of the box
+        :param y_min: Minimum y of the box
+        :param x_max: Maximum x of the box
+        :param y_max: Maximum y of the box
+        :param classes: List of classifications to keep, or None for all points
+        :return: Sorted array of point indices
+        """
+        candidates = self.index().candidates(x_min, y_min, x_max, y_max)
+        if len(candidates) == 0:
+            return candidates
+        x, y, _ = self.coordinates(candidates)
+        selected = candidates[(x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max)]
+        if classes is not None and len(selected) > 0:
+            selected = selected[np.isin(self.classification(selected), classes)]
+        return selected
+
+
+class las_grid_index:
+    """
+    Grid index of the points of a LAS file. Point indices are sorted by grid cell, so the points of a cell are one
+    contiguous slice of the order array.
+    """
+
+    def __init__(self, cell_size, x_min, y_min, rows, cols, order, starts):
+        """
+        Constructor for las_grid_index
+        :param cell_size: Cell size in map units
+        :param x_min: x of the left edge of the grid
+        :param y_min: y of the bottom edge of the grid
+        :param rows: Number of rows, counted from the bottom
+        :param cols: Number of columns
+        :param order: Point indices sorted by cell
+        :param starts: Position of the first point of every cell in order, rows * cols + 1 values
+        """
+        self.cell_size = cell_size
+        self.x_min = x_min
+        self.y_min = y_min
+        self.rows = rows
+        self.cols = cols
+        self.order = order
+        self.starts = starts
+
+    def cell_ranges(self, x_min, y_min, x_max, y_max):
+        """
+        :return: Tuple of (first row, last row, first col, last col) of the cells overlapping a box, clipped to the
+        grid
+        """
+        col_min = max(int(np.floor((x_min - self.x_min) / self.cell_size)), 0)
+        col_max = min(int(np.floor((x_max - self.x_min) / self.cell_size)), self.cols - 1)
+        row_min = max(int(np.floor((y_min - self.y_min) / self.cell_size)), 0)
+        row_max = min(int(np.floor((y_max - self.y_min) / self.cell_size)), self.rows - 1)
+        return row_min, row_max, col_min, col_max
+
+    def candidates(self, x_min, y_min, x_max, y_max):
+        """
+        :return: Sorted indices of the points in the cells overlapping a box
+        """
+        row_min, row_max, col_min, col_max = self.cell_ranges(x_min, y_min, x_max, y_max)
+        if row_min > row_max or col_min > col_max:
+            return np.zeros(0, dtype=np.int64)
+        # The cells of one grid row are contiguous in the order array
+        slices = [self.order[self.starts[row * self.cols + col_min]:self.starts[row * self.cols + col_max + 1]]
+                  for row in range(row_min, row_max + 1)]
+        return np.sort(np.concatenate(slices).astype(np.int64))
+
+
+def build_index(las, cell_size=DEFAULT_INDEX_CELL_SIZE, chunk_size=5000000):
+    """
+    Build the grid index of a LAS file, computing the cells of the points chunk by chunk
+    :param las: Instance of las_file
+    :param cell_size: Cell size in map units
+    :param chunk_size: Number of points read at a time
+    :return: Instance of las_grid_index
+    """
+    header = las.header
+    cols = max(int(np.floor((header.max_x - header.min_x) / cell_size)) + 1, 1)
+    rows = max(int(np.floor((header.max_y - header.min_y) / cell_size)) + 1, 1)
+    cells = np.empty(len(las), dtype=np.int64)
+    for start in range(0, len(las), chunk_size):
+        x, y, _ = las.coordinates(slice(start, start + chunk_size))
+        col = np.clip(np.floor((x - header.min_x) / cell_size).astype(np.int64), 0, cols - 1)
+        row = np.clip(np.floor((y - header.min_y) / cell_size).astype(np.int64), 0, rows - 1)
+        cells[start:start + len(x)] = row * cols + col
+    order = np.argsort(cells, kind="mergesort")
+    order = order.astype(np.uint32 if len(las) < 2 ** 32 else np.int64)
+    starts = np.zeros(rows * cols + 1, dtype=np.int64)
+    starts[1:] = np.cumsum(np.bincount(cells, minlength=rows * cols))
+    return las_grid_index(cell_size, header.min_x, header.min_y, rows, cols, order, starts)
+
+
+def index_path(las_path):
+    return las_path + INDEX_SUFFIX
+
+
+def load_or_build_index(las, cell_size=DEFAULT_INDEX_CELL_SIZE):
+    """
+    Load the index of a LAS file from its index file, or build it and save it next to the LAS file. The index file
+    is rebuilt when the size or modification time of the LAS file or the cell size changed.
+    :param las: Instance of las_file
+    :param cell_size: Cell size in map units
+    :return: Instance of las_grid_index
+    """
+    path = index_path(las.path)
+    stat = os.stat(las.path)
+    if os.path.exists(path):
+        stored = np.load(path)
+        if (int(stored["file_size"]) == stat.st_size and float(stored["file_mtime"]) == stat.st_mtime and
+                float(stored["cell_size"]) == cell_size):
+            return las_grid_index(cell_size, float(stored["x_min"]), float(stored["y_min"]), int(stored["rows"]),
+                                  int(stored["cols"]), stored["order"], stored["starts"])
+
+    index = build_index(las, cell_size)
+    try:
+        with open(path, 'wb') as f:
+            np.savez(f, file_size=stat.st_size, file_mtime=stat.st_mtime, cell_size=cell_size, x_min=index.x_min,
+                     y_min=index.y_min, rows=index.rows, cols=index.cols, order=index.order, starts=index.starts)
+    except (IOError, OSError):
+        # Read-only data directories still work, the index is then built on every run
+        pass
+    return index
+
+
+class tile_catalog:
+    """
+    Header bounding boxes of LAS tiles, to find the tiles an area overlaps without opening the files
+    """
+
+    def __init__(self, paths, bounds):
+        """
+        Constructor for tile_catalog
+        :param paths: List of paths to the tiles
+        :param bounds: (x min, y min, x max, y max) of each tile
+        """
+        self.paths = list(paths)
+        self.bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+
+    def intersecting(self, x_min, y_min, x_max, y_max):
+        """
+        :return: Paths of the tiles overlapping the box, in catalog order
+        """
+        hits = ((self.bounds[:, 0] <= x_max) & (self.bounds[:, 2] >= x_min) &
+                (self.bounds[:, 1] <= y_max) & (self.bounds[:, 3] >= y_min))
+        return [self.paths[i] for i in np.nonzero(hits)[0]]
+
+    def near(self, x, y, distance):
+        """
+        :param x: x coordinates of points, e.g. plot centres
+        :param y: y coordinates of the points
+        :param distance: Distance from the points, e.g. the largest radius
+        :return: Paths of the tiles overlapping the square of the distance around any of the points
+        """
+        x = np.asarray(x, dtype=np.float64)[:, np.newaxis]
+        y = np.asarray(y, dtype=np.float64)[:, np.newaxis]
+        hits = ((self.bounds[:, 0] <= x + distance) & (self.bounds[:, 2] >= x - distance) &
+                (self.bounds[:, 1] <= y + distance) & (self.bounds[:, 3] >= y - distance)).any(axis=0)
+        return [self.paths[i] for i in np.nonzero(hits)[0]]
+
+
+def load_or_build_catalog(las_paths, catalog_path):
+    """
+    Load the tile catalog of LAS files from a cache file, reading the headers of only the files that are new or whose
+    size or modification time changed. The cache is rewritten when anything changed.
+    :param las_paths: List of paths to the LAS or LAZ files
+    :param catalog_path: Path to the JSON cache file
+    :return: Instance of tile_catalog
+    """
+    cached = {}
+    if os.path.exists(catalog_path):
+        with open(catalog_path, 'r') as f:
+            cached = dict((entry["path"], entry) for entry in json.load(f)["tiles"])
+
+    entries = []
+    changed = len(cached) != len(las_paths)
+    for path in las_paths:
+        stat = os.stat(path)
+        entry = cached.get(path)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+            entry = {"path": path, "size": stat.st_size, "mtime": stat.st_mtime,
+                     "bounds": list(read_header(path).bounds())}
+            changed = True
+        entries.append(entry)
+
+    if changed:
+        temporary_path = catalog_path + ".tmp"
+        try:
+            with open(temporary_path, 'w') as f:
+                json.dump({"tiles": entries}, f, indent=1)
+            if os.path.exists(catalog_path):
+                os.remove(catalog_path)
+            os.rename(temporary_path, catalog_path)
+        except (IOError, OSError):
+            # Like the point indices, a read-only data directory only means the headers are read on every run
+            pass
+    return tile_catalog([entry["path"] for entry in entries], [entry["bounds"] for entry in entries])
+
+
+class point_chunk:
+    """
+    Decoded fields of a chunk of points
+    """
+
+    def __init__(self, x, y, z, intensity, classification, return_number, number_of_returns):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.intensity = intensity
+        self.classification = classification
+        self.return_number = return_number
+        self.number_of_returns = number_of_returns
+
+    def __len__(self):
+        return len(self.x)
+
+    def select(self, indices):
+        """
+        :param indices: Point indices or boolean mask
+        :return: New point_chunk of the selected points
+        """
+        return point_chunk(self.x[indices], self.y[indices], self.z[indices], self.intensity[indices],
+                           self.classification[indices], self.return_number[indices],
+                           self.number_of_returns[indices])
+
+
+def file_chunks(las, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    :param las: Instance of las_file
+    :param chunk_size: Number of points in a chunk
+    :return: Generator of point_chunk instances, read from the memory-mapped records
+    """
+    for start in range(0, len(las), chunk_size):
+        chunk = slice(start, min(start + chunk_size, len(las)))
+        x, y, z = las.coordinates(chunk)
+        return_number, number_of_returns = las.return_numbers(chunk)
+        yield point_chunk(x, y, z, np.asarray(las.points["intensity"][chunk], dtype=np.float64),
+                          las.classification(chunk), return_number, number_of_returns)
+
+
+def read_chunks(las_path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Read the points of a LAS or LAZ file in chunks of a fixed size, so that memory use does not depend on the size of
+    the file. LAZ files are decompressed with laspy.
+    :param las_path: Path to the LAS or LAZ file
+    :param chunk_size: Number of points in a chunk
+    :return: Generator of point_chunk instances
+    :throws: Throws a ValueError for LAZ files if laspy is not installed
+    """
+    if not read_header(las_path).compressed:
+        for chunk in file_chunks(las_file(las_path), chunk_size):
+            yield chunk
+        return
+    if laspy is None:
+        raise ValueError("Reading LAZ files needs laspy (pip install laspy[lazrs]): " + las_path)
+    with laspy.open(las_path) as reader:
+        for points in reader.chunk_iterator(chunk_size):
+            yield point_chunk(np.asarray(points.x, dtype=np.float64), np.asarray(points.y, dtype=np.float64),
+                              np.asarray(points.z, dtype=np.float64),
+                              np.asarray(points.intensity, dtype=np.float64), np.asarray(points.classification),
+                              np.asarray(points.return_number), np.asarray(points.number_of_returns))
+
+
+def query_files(las_files, x_min, y_min, x_max, y_max, classes=None):
+    """
+    Find the points inside a bounding box from several LAS files, e.g. the tiles of a campaign
+    :param las_files: List of las_file instances
+    :param classes: List of classifications to keep, or None for all points
+    :return: List of (las_file, point indices) tuples of the files that have points inside the box
+    """
+    selections = []
+    for las in las_files:
+        min_x, min_y, max_x, max_y = las.header.bounds()
+        if min_x > x_max or max_x < x_min or min_y > y_max or max_y < y_min:
+            continue
+        indices = las.query_bbox(x_min, y_min, x_max, y_max, classes)
+        if len(indices) > 0:
+            selections.append((las, indices))
+    return selections
+
+
+def parse_classes(classes):
+    """
+    :param classes: Comma separated classifications as in the FUSION /class: switch, e.g. "2,3,5"
+    :return: List of classifications
+    """
+    return [int(value) for value in str(classes).split(",") if value.strip()]
+
+
+def write_las(output_path, header, points):
+    """
+    Write points to a LAS file with the header and variable length records of another file. Point count, return
+    counts and bounds are updated to the written points.
+    :param output_path: Path to the output LAS file
+    :param header: Instance of las_header, e.g. of the file the points were read from
+    :param points: Structured array of point records with the dtype of the header
+    """
+    points = np.asarray(points, dtype=header.dtype())
+    raw = bytearray(header.raw)
+    count = len(points)
+    struct.pack_into("<I", raw, 96, len(raw))
+
+    if header.point_format < 6:
+        return_numbers = points["return_byte"] & 0x07
+    else:
+        return_numbers = points["return_byte"] & 0x0F
+    return_counts = np.bincount(return_numbers, minlength=16)[1:]
+    legacy = count < 2 ** 32 and header.point_format < 6
+    struct.pack_into("<I", raw, 107, count if legacy else 0)
+    struct.pack_into("<5I", raw, LEGACY_RETURN_COUNTS_OFFSET,
+                     *[int(value) if legacy else 0 for value in return_counts[:5]])
+    if header.version_minor >= 4 and len(raw) >= HEADER_SIZES[4]:
+        # Extended variable length records after the points are not copied
+        struct.pack_into("<QI", raw, EVLR_OFFSET, 0, 0)
+        struct.pack_into("<Q", raw, POINT_COUNT_OFFSET, count)
+        struct.pack_into("<15Q", raw, RETURN_COUNTS_OFFSET, *[int(value) for value in return_counts[:15]])
+    if header.version_minor >= 3 and len(raw) >= HEADER_SIZES[3]:
+        struct.pack_into("<Q", raw, 227, 0)
+
+    if count > 0:
+        bounds = []
+        for i, name in enumerate(["X", "Y", "Z"]):
+            values = points[name]
+            bounds.append((values.max() * header.scale[i] + header.offset[i],
+                           values.min() * header.scale[i] + header.offset[i]))
+        struct.pack_into("<6d", raw, 179, bounds[0][0], bounds[0][1], bounds[1][0], bounds[1][1], bounds[2][0],
+                         bounds[2][1])
+
+    with open(output_path, 'wb') as f:
+        f.write(bytes(raw))
+        f.write(np.ascontiguousarray(points).tobytes())
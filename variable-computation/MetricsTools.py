@@ -0,0 +1,740 @@
+import csv
+import os
+import re
+
+import numpy as np
+
+import ClipTools
+import LasTools
+
+PERCENTILES = [1, 5, 10, 20, 25, 30, 40, 50, 60, 70, 75, 80, 90, 95, 99]
+MODE_BINS = 64
+MAX_RETURN_NUMBER = 9
+
+# Statistics computed for the elevations (Elev ...) and intensities (Int ...) of the points, in the FUSION order
+STATISTICS = ["minimum", "maximum", "mean", "mode", "stddev", "variance", "CV", "IQ", "skewness", "kurtosis", "AAD",
+              "MAD median", "MAD mode", "L1", "L2", "L3", "L4", "L CV", "L skewness", "L kurtosis"] + \
+             ["P" + str(percentile).zfill(2) for percentile in PERCENTILES]
+ELEVATION_ONLY = ["Canopy relief ratio", "Elev SQRT mean SQ", "Elev CURT mean CUBE"]
+
+# Placeholder of the height break in the cover column names of the metrics store
+BREAK_LABEL = "break"
+
+# Bins of the streamed quantile sketches: (lowest value, highest value, bin width)
+HEIGHT_BINS = (-10.0, 120.0, 0.05)
+INTENSITY_BINS = (0.0, 65536.0, 16.0)
+
+
+def _group_bounds(groups, group_count):
+    # Start and end of every group in an array sorted by group
+    starts = np.searchsorted(groups, np.arange(group_count))
+    ends = np.searchsorted(groups, np.arange(group_count), side="right")
+    return starts, ends
+
+
+def grouped_percentile(sorted_values, starts, counts, percentile):
+    """
+    Percentile of every group with linear interpolation between the closest ranks
+    :param sorted_values: Values sorted by group and then by value
+    :param starts: Start of every group
+    :param counts: Number of values in every group
+    :param percentile: Percentile, 0 - 100
+    :return: Percentile of every group, NaN for empty groups
+    """
+    result = np.full(len(starts), np.nan)
+    valid = counts > 0
+    position = (counts[valid] - 1) * percentile / 100.0
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, counts[valid] - 1)
+    weight = position - lower
+    result[valid] = sorted_values[starts[valid] + lower] * (1 - weight) + \
+        sorted_values[starts[valid] + upper] * weight
+    return result
+
+
+def grouped_statistics(values, groups, group_count):
+    """
+    Compute the distribution statistics of the values of every group with grouped reductions over all groups at once
+    :param values: Values of all groups
+    :param groups: Group number of each value
+    :param group_count: Number of groups
+    :return: Dictionary of statistic name (see STATISTICS) -> array of values per group, NaN for empty groups
+    """
+    values = np.asarray(values, dtype=np.float64)
+    order = np.lexsort((values, groups))
+    values = values[order]
+    groups = np.asarray(groups)[order]
+    starts, ends = _group_bounds(groups, group_count)
+    counts = ends - starts
+    rank = np.arange(len(values)) - starts[groups]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        statistics = {}
+        n = counts.astype(np.float64)
+        mean = np.bincount(groups, values, minlength=group_count) / n
+        deviation = values - mean[groups]
+        m2 = np.bincount(groups, deviation ** 2, minlength=group_count)
+        m3 = np.bincount(groups, deviation ** 3, minlength=group_count)
+        m4 = np.bincount(groups, deviation ** 4, minlength=group_count)
+        variance = m2 / (n - 1)
+        stddev = np.sqrt(variance)
+        minimum = np.full(group_count, np.nan)
+        maximum = np.full(group_count, np.nan)
+        valid = n > 0
+        minimum[valid] = values[starts[valid]]
+        maximum[valid] = values[ends[valid] - 1]
+
+        # Mode as the centre of the fullest of 64 bins between the minimum and the maximum
+        value_range = (maximum - minimum)[groups]
+        bins = np.where(value_range > 0, np.floor((values - minimum[groups]) / value_range * MODE_BINS), 0)
+        bins = np.clip(bins, 0, MODE_BINS - 1).astype(np.int64)
+        histogram = np.bincount(groups * MODE_BINS + bins, minlength=group_count * MODE_BINS)
+        fullest = histogram.reshape(group_count, MODE_BINS).argmax(axis=1)
+        mode = minimum + (fullest + 0.5) * (maximum - minimum) / MODE_BINS
+        mode = np.where(maximum > minimum, mode, minimum)
+
+        for percentile in PERCENTILES:
+            statistics["P" + str(percentile).zfill(2)] = grouped_percentile(values, starts, counts, percentile)
+        median = grouped_percentile(values, starts, counts, 50)
+
+        # Median absolute deviations need the deviations sorted within the groups
+        mad = {}
+        for name, centre in [("MAD median", median), ("MAD mode", mode)]:
+            absolute = np.abs(values - centre[groups])
+            absolute = absolute[np.lexsort((absolute, groups))]
+            mad[name] = grouped_percentile(absolute, starts, counts, 50)
+
+        # L-moments from the probability weighted moments of the sorted values
+        b0 = mean
+        b1 = np.bincount(groups, values * rank / (n - 1)[groups], minlength=group_count) / n
+        b2 = np.bincount(groups, values * rank * (rank - 1) / ((n - 1) * (n - 2))[groups], minlength=group_count) / n
+        b3 = np.bincount(groups, values * rank * (rank - 1) * (rank - 2) / ((n - 1) * (n - 2) * (n - 3))[groups],
+                         minlength=group_count) / n
+        l2 = 2 * b1 - b0
+        l3 = 6 * b2 - 6 * b1 + b0
+        l4 = 20 * b3 - 30 * b2 + 12 * b1 - b0
+
+        statistics.update({"minimum": minimum,
+                           "maximum": maximum,
+                           "mean": mean,
+                           "mode": mode,
+                           "stddev": stddev,
+                           "variance": variance,
+                           "CV": stddev / mean,
+                           "IQ": statistics["P75"] - statistics["P25"],
+                           "skewness": m3 / ((n - 1) * stddev ** 3),
+                           "kurtosis": m4 / ((n - 1) * variance ** 2),
+                           "AAD": np.bincount(groups, np.abs(deviation), minlength=group_count) / n,
+                           "MAD median": mad["MAD median"],
+                           "MAD mode": mad["MAD mode"],
+                           "L1": b0,
+                           "L2": l2,
+                           "L3": l3,
+                           "L4": l4,
+                           "L CV": l2 / b0,
+                           "L skewness": l3 / l2,
+                           "L kurtosis": l4 / l2})
+        statistics["Canopy relief ratio"] = (mean - minimum) / (maximum - minimum)
+        statistics["SQRT mean SQ"] = np.sqrt(np.bincount(groups, values ** 2, minlength=group_count) / n)
+        statistics["CURT mean CUBE"] = np.cbrt(np.bincount(groups, values ** 3, minlength=group_count) / n)
+    for name in statistics:
+        statistics[name][~valid] = np.nan
+    return statistics
+
+
+def above_columns(above):
+    """
+    :param above: Height break, as the /above: switch of cloudmetrics.exe, or BREAK_LABEL
+    :return: Names of the cover columns of the height break
+    """
+    label = BREAK_LABEL if above == BREAK_LABEL else "{0:.2f}".format(above)
+    return ["Percentage first returns above " + label,
+            "Percentage all returns above " + label,
+            "(All returns above " + label + ") / (Total first returns) * 100",
+            "First returns above " + label,
+            "All returns above " + label]
+
+
+def metric_columns(above):
+    """
+    :param above: Height break of the cover columns
+    :return: Column names of a cloudmetrics.exe /id output file, in order
+    """
+    columns = ["Identifier", "DataFile", "FileTitle", "Total return count"]
+    columns += ["Return " + str(number) + " count" for number in range(1, MAX_RETURN_NUMBER + 1)]
+    columns += ["Other return count"]
+    columns += ["Elev " + name for name in STATISTICS] + ELEVATION_ONLY
+    columns += ["Int " + name for name in STATISTICS]
+    columns += above_columns(above)
+    columns += ["Percentage first returns above mean", "Percentage first returns above mode",
+                "Percentage all returns above mean", "Percentage all returns above mode",
+                "(All returns above mean) / (Total first returns) * 100",
+                "(All returns above mode) / (Total first returns) * 100",
+                "First returns above mean", "First returns above mode", "All returns above mean",
+                "All returns above mode", "Total first returns", "Total all returns"]
+    return columns
+
+
+def _cover(heights, first, groups, group_count, thresholds, name, metrics):
+    # Cover metrics of one height break per group, thresholds as an array per group
+    above = heights > thresholds[groups]
+    first_above = np.bincount(groups, above & first, minlength=group_count)
+    all_above = np.bincount(groups, above, minlength=group_count)
+    total_first = metrics["Total first returns"]
+    total_all = metrics["Total all returns"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        metrics["Percentage first returns above " + name] = first_above / total_first * 100
+        metrics["Percentage all returns above " + name] = all_above / total_all * 100
+        metrics["(All returns above " + name + ") / (Total first returns) * 100"] = all_above / total_first * 100
+    metrics["First returns above " + name] = first_above
+    metrics["All returns above " + name] = all_above
+
+
+def compute_metrics(heights, intensities, return_numbers, groups, group_count, above_values):
+    """
+    Compute the cloudmetrics.exe metrics of many plots, for all height breaks at once. The distribution statistics
+    do not depend on the height break and are computed once.
+    :param heights: Heights above ground of the points of all plots
+    :param intensities: Intensities of the points
+    :param return_numbers: Return numbers of the points
+    :param groups: Plot number of each point
+    :param group_count: Number of plots
+    :param above_values: List of height breaks
+    :return: Dictionary of column name (see metric_columns) -> array per plot, covering all height breaks
+    """
+    heights = np.asarray(heights, dtype=np.float64)
+    groups = np.asarray(groups, dtype=np.int64)
+    return_numbers = np.asarray(return_numbers)
+    metrics = {}
+    metrics["Total return count"] = np.bincount(groups, minlength=group_count)
+    for number in range(1, MAX_RETURN_NUMBER + 1):
+        metrics["Return " + str(number) + " count"] = np.bincount(groups, return_numbers == number,
+                                                                   minlength=group_count).astype(np.int64)
+    metrics["Other return count"] = np.bincount(groups, (return_numbers < 1) | (return_numbers > MAX_RETURN_NUMBER),
+                                                minlength=group_count).astype(np.int64)
+
+    elevation = grouped_statistics(heights, groups, group_count)
+    for name in STATISTICS:
+        metrics["Elev " + name] = elevation[name]
+    metrics["Canopy relief ratio"] = elevation["Canopy relief ratio"]
+    metrics["Elev SQRT mean SQ"] = elevation["SQRT mean SQ"]
+    metrics["Elev CURT mean CUBE"] = elevation["CURT mean CUBE"]
+    intensity = grouped_statistics(intensities, groups, group_count)
+    for name in STATISTICS:
+        metrics["Int " + name] = intensity[name]
+
+    first = return_numbers == 1
+    metrics["Total first returns"] = np.bincount(groups, first, minlength=group_count).astype(np.int64)
+    metrics["Total all returns"] = metrics["Total return count"]
+    for above in above_values:
+        _cover(heights, first, groups, group_count, np.full(group_count, float(above)), "{0:.2f}".format(above),
+               metrics)
+    _cover(heights, first, groups, group_count, np.nan_to_num(elevation["mean"]), "mean", metrics)
+    _cover(heights, first, groups, group_count, np.nan_to_num(elevation["mode"]), "mode", metrics)
+    for name in list(metrics):
+        if name.startswith("First returns above") or name.startswith("All returns above"):
+            metrics[name] = metrics[name].astype(np.int64)
+    return metrics
+
+
+class moment_accumulator:
+    """
+    Running count, mean, central moments up to the fourth, minimum and maximum per group. Chunks are combined with the
+    pairwise update of Pebay, so accumulators of chunks, files or workers can be merged in any order.
+    """
+
+    def __init__(self, group_count):
+        """
+        Constructor for moment_accumulator
+        :param group_count: Number of groups (plots)
+        """
+        self.count = np.zeros(group_count)
+        self.mean = np.zeros(group_count)
+        self.m2 = np.zeros(group_count)
+        self.m3 = np.zeros(group_count)
+        self.m4 = np.zeros(group_count)
+        self.minimum = np.full(group_count, np.inf)
+        self.maximum = np.full(group_count, -np.inf)
+
+    def add(self, values, groups):
+        """
+        Add a chunk of values to the accumulator
+        :param values: Values to add
+        :param groups: Group number of each value
+        """
+        if len(values) == 0:
+            return
+        group_count = len(self.count)
+        count = np.bincount(groups, minlength=group_count).astype(np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.nan_to_num(np.bincount(groups, values, minlength=group_count) / count)
+        deviation = values - mean[groups]
+        np.minimum.at(self.minimum, groups, values)
+        np.maximum.at(self.maximum, groups, values)
+        self._combine(count, mean, np.bincount(groups, deviation ** 2, minlength=group_count),
+                      np.bincount(groups, deviation ** 3, minlength=group_count),
+                      np.bincount(groups, deviation ** 4, minlength=group_count))
+
+    def merge(self, other):
+        """
+        Merge another accumulator of the same groups to this one
+        :param other: Instance of moment_accumulator
+        """
+        self.minimum = np.minimum(self.minimum, other.minimum)
+        self.maximum = np.maximum(self.maximum, other.maximum)
+        self._combine(other.count, other.mean, other.m2, other.m3, other.m4)
+
+    def _combine(self, count, mean, m2, m3, m4):
+        n_a = self.count
+        n_b = count
+        n = n_a + n_b
+        divisor = np.where(n > 0, n, 1.0)
+        delta = mean - self.mean
+        self.m4 = self.m4 + m4 + delta ** 4 * n_a * n_b * (n_a ** 2 - n_a * n_b + n_b ** 2) / divisor ** 3 + \
+            6 * delta ** 2 * (n_a ** 2 * m2 + n_b ** 2 * self.m2) / divisor ** 2 + \
+            4 * delta * (n_a * m3 - n_b * self.m3) / divisor
+        self.m3 = self.m3 + m3 + delta ** 3 * n_a * n_b * (n_a - n_b) / divisor ** 2 + \
+            3 * delta * (n_a * m2 - n_b * self.m2) / divisor
+        self.m2 = self.m2 + m2 + delta ** 2 * n_a * n_b / divisor
+        self.mean = self.mean + delta * n_b / divisor
+        self.count = n
+
+
+class histogram_sketch:
+    """
+    Counts of the values of every group in fixed-width bins, for the order statistics of streamed values. Sketches
+    with the same bins are merged by adding the counts. The values of a bin are taken to be spread evenly over it, so
+    the error of a quantile is at most the bin width. Values outside the range are counted in the first or last bin.
+    """
+
+    def __init__(self, group_count, low, high, bin_width):
+        """
+        Constructor for histogram_sketch
+        :param group_count: Number of groups (plots)
+        :param low: Lower edge of the first bin
+        :param high: Upper edge of the last bin
+        :param bin_width: Width of the bins
+        """
+        self.low = low
+        self.bin_width = bin_width
+        self.bin_count = int(np.ceil((high - low) / bin_width))
+        self.counts = np.zeros((group_count, self.bin_count), dtype=np.int32)
+
+    def add(self, values, groups):
+        """
+        Add a chunk of values to the sketch
+        :param values: Values to add
+        :param groups: Group number of each value
+        """
+        if len(values) == 0:
+            return
+        bins = np.clip(np.floor((values - self.low) / self.bin_width).astype(np.int64), 0, self.bin_count - 1)
+        cells, inverse = np.unique(groups * self.bin_count + bins, return_inverse=True)
+        self.counts.reshape(-1)[cells] += np.bincount(inverse).astype(np.int32)
+
+    def merge(self, other):
+        """
+        :param other: Instance of histogram_sketch with the same bins
+        """
+        self.counts += other.counts
+
+    def centres(self):
+        return self.low + (np.arange(self.bin_count) + 0.5) * self.bin_width
+
+    def quantile(self, fraction):
+        """
+        :param fraction: Quantile, 0 - 1
+        :return: Quantile of every group with linear interpolation between the closest ranks like
+        grouped_percentile, NaN for empty groups
+        """
+        cumulative = np.cumsum(self.counts, axis=1)
+        n = cumulative[:, -1]
+        position = np.maximum(n - 1, 0) * fraction
+        lower = np.floor(position)
+        weight = position - lower
+        upper = np.minimum(lower + 1, np.maximum(n - 1, 0))
+        result = self._value_at_rank(cumulative, lower) * (1 - weight) + self._value_at_rank(cumulative, upper) * weight
+        result[n == 0] = np.nan
+        return result
+
+    def _value_at_rank(self, cumulative, rank):
+        # Value of the rank-th (0-based) smallest value of every group, spread evenly within its bin
+        rows = np.arange(len(rank))
+        bins = np.minimum((cumulative <= rank[:, np.newaxis]).sum(axis=1), self.bin_count - 1)
+        count = np.maximum(self.counts[rows, bins], 1)
+        within = rank - (cumulative[rows, bins] - self.counts[rows, bins])
+        return self.low + (bins + (within + 0.5) / count) * self.bin_width
+
+    def count_below(self, values, minimum, maximum):
+        """
+        Number of values of every group below the given values, with the values of a bin spread evenly over the
+        part of the bin between the minimum and the maximum of the group
+        :param values: Array of shape (groups, k)
+        :param minimum: Exact minimum of every group
+        :param maximum: Exact maximum of every group
+        :return: float64 array of shape (groups, k)
+        """
+        rows = np.arange(len(values))[:, np.newaxis]
+        bins = np.clip(np.floor((values - self.low) / self.bin_width), 0, self.bin_count - 1).astype(np.int64)
+        lower = self.low + bins * self.bin_width
+        upper = lower + self.bin_width
+        # The first and last bins also hold the values outside the range of the sketch
+        lower = np.where(bins == 0, np.fmin(lower, minimum[:, np.newaxis]), lower)
+        upper = np.where(bins == self.bin_count - 1, np.fmax(upper, maximum[:, np.newaxis]), upper)
+        lower = np.fmax(lower, minimum[:, np.newaxis])
+        upper = np.fmin(upper, maximum[:, np.newaxis])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fraction = np.where(upper > lower, np.clip((values - lower) / (upper - lower), 0.0, 1.0),
+                                (values >= upper).astype(np.float64))
+        counts = self.counts[rows, bins].astype(np.float64)
+        before = np.cumsum(self.counts, axis=1)[rows, bins] - counts
+        return before + counts * fraction
+
+    def count_above(self, thresholds):
+        """
+        :param thresholds: Threshold of every group
+        :return: Number of values above the threshold in every group, the bin of the threshold split evenly
+        """
+        upper_edges = self.low + (np.arange(self.bin_count) + 1) * self.bin_width
+        fraction = np.clip((upper_edges - thresholds[:, np.newaxis]) / self.bin_width, 0, 1)
+        return np.round((self.counts * fraction).sum(axis=1)).astype(np.int64)
+
+    def median_deviation(self, centre):
+        """
+        :param centre: Centre of every group, e.g. the median or the mode
+        :return: Median of the absolute deviations of the bin centres from the centre, weighted by the counts
+        """
+        deviation = np.abs(self.centres()[np.newaxis, :] - centre[:, np.newaxis])
+        order = np.argsort(deviation, axis=1)
+        rows = np.arange(len(centre))[:, np.newaxis]
+        deviation = deviation[rows, order]
+        cumulative = np.cumsum(self.counts[rows, order], axis=1)
+        n = cumulative[:, -1]
+        result = np.zeros(len(centre))
+        for rank in (np.floor((n - 1) / 2.0), np.ceil((n - 1) / 2.0)):
+            position = np.minimum((cumulative <= rank[:, np.newaxis]).sum(axis=1), self.bin_count - 1)
+            result += deviation[rows[:, 0], position] / 2
+        result[n == 0] = np.nan
+        return result
+
+    def probability_weighted_moments(self):
+        """
+        :return: Tuple of the probability weighted moments b1, b2, b3 of every group (see grouped_statistics) from
+        the bin centres, with the ranks of every bin summed in closed form
+        """
+        counts = self.counts.astype(np.float64)
+        n = counts.sum(axis=1)
+        ends = np.cumsum(counts, axis=1)
+        starts = ends - counts
+
+        def falling_sum(order):
+            # Sum of rank * (rank - 1) * ... over the ranks of every bin as F(end) - F(start) of the falling
+            # factorial F(m) = m * (m - 1) * ... / (order + 1)
+            def falling(m):
+                product = np.ones(m.shape)
+                for k in range(order + 1):
+                    product *= m - k
+                return product / (order + 1)
+            return falling(ends) - falling(starts)
+
+        centres = self.centres()[np.newaxis, :]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            b1 = (centres * falling_sum(1)).sum(axis=1) / (n - 1) / n
+            b2 = (centres * falling_sum(2)).sum(axis=1) / ((n - 1) * (n - 2)) / n
+            b3 = (centres * falling_sum(3)).sum(axis=1) / ((n - 1) * (n - 2) * (n - 3)) / n
+        return b1, b2, b3
+
+
+def sketch_statistics(moments, sketch):
+    """
+    Distribution statistics from streamed accumulators, with the names of grouped_statistics. Moments, minimum and
+    maximum are exact, the order statistics and L-moments are approximated from the sketch.
+    :param moments: Instance of moment_accumulator
+    :param sketch: Instance of histogram_sketch of the same values
+    :return: Dictionary of statistic name -> array of values per group, NaN for empty groups
+    """
+    n = moments.count
+    valid = n > 0
+    minimum = np.where(valid, moments.minimum, np.nan)
+    maximum = np.where(valid, moments.maximum, np.nan)
+    mean = np.where(valid, moments.mean, np.nan)
+    statistics = {}
+    for percentile in PERCENTILES:
+        statistics["P" + str(percentile).zfill(2)] = np.clip(sketch.quantile(percentile / 100.0), minimum, maximum)
+    median = np.clip(sketch.quantile(0.5), minimum, maximum)
+
+    # Mode of 64 bins between the minimum and the maximum. Every sketch bin adds its count to the mode bins in
+    # proportion to their overlap, so mode bins do not get more sketch bins than their neighbours.
+    value_range = maximum - minimum
+    edges = np.nan_to_num(minimum)[:, np.newaxis] + \
+        np.nan_to_num(value_range)[:, np.newaxis] * np.arange(MODE_BINS + 1) / float(MODE_BINS)
+    histogram = np.diff(sketch.count_below(edges, minimum, maximum), axis=1)
+    fullest = histogram.argmax(axis=1)
+    mode = np.where(value_range > 0, minimum + (fullest + 0.5) * value_range / MODE_BINS, minimum)
+
+    b1, b2, b3 = sketch.probability_weighted_moments()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = moments.m2 / (n - 1)
+        stddev = np.sqrt(variance)
+        absolute = np.abs(sketch.centres()[np.newaxis, :] - mean[:, np.newaxis])
+        l2 = 2 * b1 - mean
+        l3 = 6 * b2 - 6 * b1 + mean
+        l4 = 20 * b3 - 30 * b2 + 12 * b1 - mean
+        statistics.update({"minimum": minimum,
+                           "maximum": maximum,
+                           "mean": mean,
+                           "mode": mode,
+                           "stddev": stddev,
+                           "variance": variance,
+                           "CV": stddev / mean,
+                           "IQ": statistics["P75"] - statistics["P25"],
+                           "skewness": moments.m3 / ((n - 1) * stddev ** 3),
+                           "kurtosis": moments.m4 / ((n - 1) * variance ** 2),
+                           "AAD": (sketch.counts * absolute).sum(axis=1) / n,
+                           "MAD median": sketch.median_deviation(median),
+                           "MAD mode": sketch.median_deviation(mode),
+                           "L1": mean,
+                           "L2": l2,
+                           "L3": l3,
+                           "L4": l4,
+                           "L CV": l2 / mean,
+                           "L skewness": l3 / l2,
+                           "L kurtosis": l4 / l2})
+        statistics["Canopy relief ratio"] = (mean - minimum) / (maximum - minimum)
+        statistics["SQRT mean SQ"] = np.sqrt(mean ** 2 + moments.m2 / n)
+        statistics["CURT mean CUBE"] = np.cbrt(mean ** 3 + 3 * mean * moments.m2 / n + moments.m3 / n)
+    for name in statistics:
+        statistics[name][~valid] = np.nan
+    return statistics
+
+
+class metrics_accumulator:
+    """
+    Streamed counterpart of compute_metrics: the points of the plots are added chunk by chunk and only per plot
+    accumulators are kept, so memory use does not depend on the number of points. Accumulators of the same plots can
+    be merged, e.g. from several files.
+    """
+
+    def __init__(self, group_count, above_values, height_bins=HEIGHT_BINS, intensity_bins=INTENSITY_BINS):
+        """
+        Constructor for metrics_accumulator
+        :param group_count: Number of plots
+        :param above_values: List of height breaks
+        :param height_bins: Tuple of (lowest, highest, bin width) of the height sketches
+        :param intensity_bins: Tuple of (lowest, highest, bin width) of the intensity sketch
+        """
+        self.group_count = group_count
+        self.above_values = list(above_values)
+        self.returns = np.zeros((group_count, MAX_RETURN_NUMBER + 2), dtype=np.int64)
+        self.heights = moment_accumulator(group_count)
+        self.intensities = moment_accumulator(group_count)
+        self.all_sketch = histogram_sketch(group_count, *height_bins)
+        self.first_sketch = histogram_sketch(group_count, *height_bins)
+        self.intensity_sketch = histogram_sketch(group_count, *intensity_bins)
+        # Points above the fixed height breaks are counted exactly, the breaks at the mean and mode come from sketches
+        self.first_above = np.zeros((len(self.above_values), group_count), dtype=np.int64)
+        self.all_above = np.zeros((len(self.above_values), group_count), dtype=np.int64)
+
+    def add(self, heights, intensities, return_numbers, groups):
+        """
+        Add a chunk of points
+        :param heights: Heights above ground of the points
+        :param intensities: Intensities of the points
+        :param return_numbers: Return numbers of the points
+        :param groups: Plot number of each point
+        """
+        heights = np.asarray(heights, dtype=np.float64)
+        intensities = np.asarray(intensities, dtype=np.float64)
+        groups = np.asarray(groups, dtype=np.int64)
+        return_numbers = np.asarray(return_numbers)
+        # Return numbers 1 - 9 in their own column, others in column 0
+        columns = np.where((return_numbers >= 1) & (return_numbers <= MAX_RETURN_NUMBER), return_numbers, 0)
+        self.returns += np.bincount(groups * (MAX_RETURN_NUMBER + 2) + columns,
+                                    minlength=self.returns.size).reshape(self.returns.shape)
+        self.heights.add(heights, groups)
+        self.intensities.add(intensities, groups)
+        first = return_numbers == 1
+        self.all_sketch.add(heights, groups)
+        self.first_sketch.add(heights[first], groups[first])
+        self.intensity_sketch.add(intensities, groups)
+        for number, above in enumerate(self.above_values):
+            over = heights > above
+            self.all_above[number] += np.bincount(groups, over, minlength=self.group_count).astype(np.int64)
+            self.first_above[number] += np.bincount(groups, over & first, minlength=self.group_count).astype(np.int64)
+
+    def merge(self, other):
+        """
+        :param other: Instance of metrics_accumulator of the same plots and height breaks
+        """
+        self.returns += other.returns
+        self.heights.merge(other.heights)
+        self.intensities.merge(other.intensities)
+        self.all_sketch.merge(other.all_sketch)
+        self.first_sketch.merge(other.first_sketch)
+        self.intensity_sketch.merge(other.intensity_sketch)
+        self.first_above += other.first_above
+        self.all_above += other.all_above
+
+    def _cover(self, first_above, all_above, name, metrics):
+        total_first = metrics["Total first returns"]
+        total_all = metrics["Total all returns"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            metrics["Percentage first returns above " + name] = first_above / total_first * 100.0
+            metrics["Percentage all returns above " + name] = all_above / total_all * 100.0
+            metrics["(All returns above " + name + ") / (Total first returns) * 100"] = all_above / total_first * 100.0
+        metrics["First returns above " + name] = first_above
+        metrics["All returns above " + name] = all_above
+
+    def metrics(self):
+        """
+        :return: Dictionary of column name (see metric_columns) -> array per plot, like compute_metrics
+        """
+        metrics = {}
+        metrics["Total return count"] = self.returns.sum(axis=1)
+        for number in range(1, MAX_RETURN_NUMBER + 1):
+            metrics["Return " + str(number) + " count"] = self.returns[:, number]
+        metrics["Other return count"] = self.returns[:, 0]
+
+        elevation = sketch_statistics(self.heights, self.all_sketch)
+        for name in STATISTICS:
+            metrics["Elev " + name] = elevation[name]
+        metrics["Canopy relief ratio"] = elevation["Canopy relief ratio"]
+        metrics["Elev SQRT mean SQ"] = elevation["SQRT mean SQ"]
+        metrics["Elev CURT mean CUBE"] = elevation["CURT mean CUBE"]
+        intensity = sketch_statistics(self.intensities, self.intensity_sketch)
+        for name in STATISTICS:
+            metrics["Int " + name] = intensity[name]
+
+        metrics["Total first returns"] = self.returns[:, 1]
+        metrics["Total all returns"] = metrics["Total return count"]
+        for number, above in enumerate(self.above_values):
+            self._cover(self.first_above[number], self.all_above[number], "{0:.2f}".format(above), metrics)
+        for name in ["mean", "mode"]:
+            threshold = np.nan_to_num(elevation[name])
+            self._cover(self.first_sketch.count_above(threshold), self.all_sketch.count_above(threshold), name,
+                        metrics)
+        return metrics
+
+
+def stream_plot_metrics(las_paths, plot_x, plot_y, radii, above_values, classes=None, ground=None,
+                        chunk_size=LasTools.DEFAULT_CHUNK_SIZE):
+    """
+    Compute the cloudmetrics of all plots and radii in one streamed pass over LAS or LAZ files, without writing
+    clipped plot files. Only one chunk of points and the per plot accumulators are in memory at a time.
+    :param las_paths: List of paths to the LAS or LAZ files
+    :param plot_x: x coordinates of the plot centres
+    :param plot_y: y coordinates of the plot centres
+    :param radii: List of plot radii in map units
+    :param above_values: List of height breaks
+    :param classes: List of classifications to keep, or None for all points
+    :param ground: Instance of GroundTools.ground_model to normalize the heights, or None if the files have heights
+    :param chunk_size: Number of points read at a time
+    :return: Dictionary of radius -> metrics dictionary (like compute_metrics) of every plot
+    """
+    radii = sorted(radii)
+    lookup = ClipTools.plot_lookup(plot_x, plot_y, radii[-1])
+    accumulators = dict((radius, metrics_accumulator(len(lookup.plot_x), above_values)) for radius in radii)
+    for path in las_paths:
+        if not lookup.near(LasTools.read_header(path).bounds(), radii[-1]):
+            continue
+        for chunk in LasTools.read_chunks(path, chunk_size):
+            points, plots, distances = lookup.members(chunk, radii[-1], classes)
+            heights = chunk.z[points]
+            if ground is not None:
+                heights = ground.heights(chunk.x[points], chunk.y[points], heights)
+            valid = ~np.isnan(heights)
+            for radius in radii:
+                inside = np.nonzero(valid & (distances <= radius))[0]
+                accumulators[radius].add(heights[inside], chunk.intensity[points[inside]],
+                                         chunk.return_number[points[inside]], plots[inside])
+    return dict((radius, accumulators[radius].metrics()) for radius in radii)
+
+
+def read_plot_points(las_paths):
+    """
+    Read the points of clipped plot files (heights above ground) for compute_metrics
+    :param las_paths: List of paths to the plot .las files
+    :return: Tuple of (heights, intensities, return numbers, plot number of each point)
+    """
+    heights, intensities, return_numbers, groups = [], [], [], []
+    for number, path in enumerate(las_paths):
+        las = LasTools.las_file(path)
+        heights.append(las.coordinates()[2])
+        intensities.append(np.asarray(las.points["intensity"], dtype=np.float64))
+        return_numbers.append(las.return_numbers()[0])
+        groups.append(np.full(len(las), number, dtype=np.int64))
+    if not las_paths:
+        return np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return (np.concatenate(heights), np.concatenate(intensities), np.concatenate(return_numbers),
+            np.concatenate(groups))
+
+
+def file_identifier(path):
+    """
+    :return: Numeric identifier parsed from the file name like cloudmetrics.exe /id does, 0 if there are no digits
+    """
+    digits = re.findall(r'[0-9]+', os.path.splitext(os.path.basename(path))[0])
+    return int("".join(digits)) if digits else 0
+
+
+def _format(value):
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    if np.isnan(value):
+        return ""
+    return "{0:.6f}".format(value)
+
+
+def write_cloudmetrics_csv(output_path, las_paths, metrics, above):
+    """
+    Write the metrics of one height break as a cloudmetrics.exe /id output file, one row per plot file
+    :param output_path: Path to the output CSV file
+    :param las_paths: List of paths to the plot files, in the plot order of the metrics
+    :param metrics: Dictionary from compute_metrics
+    :param above: Height break of the file
+    """
+    columns = metric_columns(above)
+    with open(output_path, 'wb' if str is bytes else 'w') as f:
+        writer = csv.writer(f, delimiter=",", lineterminator="\n")
+        writer.writerow(columns)
+        for number, path in enumerate(las_paths):
+            row = [str(file_identifier(path)), path, os.path.splitext(os.path.basename(path))[0]]
+            row += [_format(metrics[name][number]) for name in columns[3:]]
+            writer.writerow(row)
+
+
+def compute_cloudmetrics_files(las_paths, above_values, output_paths):
+    """
+    Compute the metrics of plot files for all height breaks with one read of each file, and write one
+    cloudmetrics.exe compatible CSV per height break
+    :param las_paths: List of paths to the plot .las files
+    :param above_values: List of height breaks
+    :param output_paths: Dictionary of height break -> output CSV path
+    """
+    heights, intensities, return_numbers, groups = read_plot_points(las_paths)
+    metrics = compute_metrics(heights, intensities, return_numbers, groups, len(las_paths), above_values)
+    for above in above_values:
+        write_cloudmetrics_csv(output_paths[above], las_paths, metrics, above)
+
+
+def read_cloudmetrics_csv(path, above):
+    """
+    Read a cloudmetrics.exe /id output file, e.g. to collect it into a metrics store
+    :param path: Path to the CSV file
+    :param above: Height break of the file
+    :return: Tuple of (list of plot names (Cluster.Plot), dictionary of column name -> float64 array). The cover
+    columns of the height break are named with BREAK_LABEL (see metric_columns).
+    """
+    names = dict(zip(metric_columns(above), metric_columns(BREAK_LABEL)))
+    with open(path, 'rb' if str is bytes else 'r') as f:
+        rows = list(csv.reader(f, delimiter=","))
+    header = [name.strip() for name in rows[0]]
+    rows = [row for row in rows[1:] if row]
+    data_file = header.index("DataFile")
+    plots = [os.path.splitext(os.path.basename(row[data_file]))[0] for row in rows]
+    columns = {}
+    for position, name in enumerate(header):
+        if name in names and name not in ("Identifier", "DataFile", "FileTitle"):
+            columns[names[name]] = np.array([float(row[position]) if row[position].strip() else np.nan
+                                             for row in rows])
+    return plots, columns
@@ -0,0 +1,184 @@
+import csv
+import json
+import os
+
+import numpy as np
+
+import BlockTools
+
+FEATURES_FILE = "features.json"
+MANIFEST_FILE = "chunks.csv"
+MANIFEST_COLUMNS = ["chunk", "row_off", "col_off", "rows", "cols", "cells", "path"]
+
+
+class resampled_source:
+    """
+    Block source reading a raster on another grid of the same projection by nearest neighbour, e.g. a 250 m soil
+    predictor on a 5 m terrain grid. Cells of the grid outside the raster are NaN.
+    """
+
+    def __init__(self, source, source_grid, grid):
+        """
+        Constructor for resampled_source
+        :param source: Block source of the raster
+        :param source_grid: Instance of BlockTools.raster_grid of the raster
+        :param grid: Instance of BlockTools.raster_grid to read the raster on
+        """
+        self.source = source
+        self.source_grid = source_grid
+        self.grid = grid
+        self.rows = grid.rows
+        self.cols = grid.cols
+
+    def read_block(self, row_off, col_off, rows, cols):
+        transform = self.grid.geotransform
+        source_transform = self.source_grid.geotransform
+        # Source cell of the centre of every column and row of the block, both are monotonic
+        x = transform[0] + (col_off + np.arange(cols) + 0.5) * transform[1]
+        y = transform[3] + (row_off + np.arange(rows) + 0.5) * transform[5]
+        source_cols = np.floor((x - source_transform[0]) / source_transform[1]).astype(np.int64)
+        source_rows = np.floor((y - source_transform[3]) / source_transform[5]).astype(np.int64)
+        valid_cols = (source_cols >= 0) & (source_cols < self.source_grid.cols)
+        valid_rows = (source_rows >= 0) & (source_rows < self.source_grid.rows)
+
+        block = np.full((rows, cols), np.nan)
+        if not valid_cols.any() or not valid_rows.any():
+            return block
+        first_row = source_rows[valid_rows].min()
+        first_col = source_cols[valid_cols].min()
+        window = self.source.read_block(first_row, first_col, source_rows[valid_rows].max() + 1 - first_row,
+                                        source_cols[valid_cols].max() + 1 - first_col)
+        block[np.ix_(valid_rows, valid_cols)] = window[np.ix_(source_rows[valid_rows] - first_row,
+                                                              source_cols[valid_cols] - first_col)]
+        return block
+
+
+def read_legend(legend_path):
+    """
+    Read the legend written by compute-raster-variables.py
+    :param legend_path: Path to legend.csv
+    :return: Dictionary of short name (e.g. T5SLO) -> (raster path, band number)
+    """
+    with open(legend_path, 'rb' if str is bytes else 'r') as f:
+        reader = csv.reader(f, delimiter=';', quotechar='|')
+        header = next(reader)
+        name_column = header.index("Short Name")
+        path_column = header.index("Input")
+        # Legends written before the band column have single band rasters only
+        band_column = header.index("Band") if "Band" in header else None
+        return dict((row[name_column], (row[path_column], int(row[band_column]) if band_column is not None else 1))
+                    for row in reader if row)
+
+
+def chunk_path(directory, chunk):
+    return os.path.join(directory, "chunk_" + str(chunk).zfill(6) + ".npz")
+
+
+def extract_features(sources, names, grid, output_directory, tile_size=512):
+    """
+    Extract the predictors of every cell of a grid tile by tile to a chunked feature store: one .npz file per tile
+    with the flat cell indices (row * cols + col) and a float32 matrix of the features of the cells where all
+    predictors have a value. Only one tile of all predictors is in memory at a time.
+    :param sources: Dictionary of short name -> block source on the grid (e.g. resampled_source)
+    :param names: List of short names, the order of the feature columns
+    :param grid: Instance of BlockTools.raster_grid of the study area
+    :param output_directory: Directory of the chunks (Will be created)
+    :param tile_size: Size of the tile side in cells
+    :return: Number of cells with features
+    """
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+    features_path = os.path.join(output_directory, FEATURES_FILE)
+    if os.path.exists(features_path):
+        os.remove(features_path)
+    manifest = []
+    total = 0
+    for chunk, window in enumerate(BlockTools.generate_windows(grid.rows, grid.cols, tile_size)):
+        stack = np.stack([sources[name].read_block(window.row_off, window.col_off, window.rows, window.cols)
+                          for name in names])
+        valid = ~np.isnan(stack).any(axis=0)
+        rows, cols = np.nonzero(valid)
+        cells = (rows + window.row_off).astype(np.int64) * grid.cols + cols + window.col_off
+        features = stack[:, rows, cols].T.astype(np.float32)
+        path = chunk_path(output_directory, chunk)
+        with open(path, 'wb') as f:
+            np.savez(f, cells=cells, features=features)
+        manifest.append([chunk, window.row_off, window.col_off, window.rows, window.cols, len(cells),
+                         os.path.basename(path)])
+        total += len(cells)
+
+    with open(os.path.join(output_directory, MANIFEST_FILE), 'wb' if str is bytes else 'w') as f:
+        writer = csv.writer(f, delimiter=';', lineterminator="\n")
+        writer.writerow(MANIFEST_COLUMNS)
+        writer.writerows(manifest)
+    # Written last, so an interrupted extraction is not mistaken for a complete one
+    with open(features_path, 'w') as f:
+        json.dump({"names": list(names), "geotransform": list(grid.geotransform), "projection": grid.projection,
+                   "rows": grid.rows, "cols": grid.cols, "cells": total}, f, indent=1)
+    return total
+
+
+class feature_chunks:
+    """
+    Chunked feature store written by extract_features, read one chunk at a time
+    """
+
+    def __init__(self, directory):
+        """
+        Constructor for feature_chunks
+        :param directory: Directory of the chunks
+        :throws: Throws a ValueError if the directory does not contain a complete extraction
+        """
+        features_path = os.path.join(directory, FEATURES_FILE)
+        if not os.path.exists(features_path):
+            raise ValueError("Not a complete feature extraction: " + directory)
+        with open(features_path, 'r') as f:
+            self.metadata = json.load(f)
+        self.directory = directory
+        self.names = self.metadata["names"]
+        self.grid = BlockTools.raster_grid(self.metadata["geotransform"], self.metadata["projection"],
+                                           self.metadata["rows"], self.metadata["cols"])
+        with open(os.path.join(directory, MANIFEST_FILE), 'rb' if str is bytes else 'r') as f:
+            rows = list(csv.reader(f, delimiter=';'))[1:]
+        self.windows = [BlockTools.raster_window(int(row[1]), int(row[2]), int(row[3]), int(row[4])) for row in rows]
+        self.paths = [os.path.join(directory, row[6]) for row in rows]
+
+    def __iter__(self):
+        """
+        :return: Generator of (raster_window, flat cell indices, float32 feature matrix) tuples, one per tile
+        """
+        for window, path in zip(self.windows, self.paths):
+            with np.load(path) as chunk:
+                yield window, chunk["cells"], chunk["features"]
+
+
+def write_feature_csv(chunks, output_path):
+    """
+    Write a chunked feature store as the SelectedVariablesForWholeStudyArea table of predict-for-whole-study-area.R,
+    one chunk at a time: the flat cell index followed by the features of the cell
+    :param chunks: Instance of feature_chunks
+    :param output_path: Path to the output CSV
+    """
+    with open(output_path, 'wb' if str is bytes else 'w') as f:
+        writer = csv.writer(f, delimiter=';', lineterminator="\n")
+        writer.writerow(["Cell"] + list(chunks.names))
+        for window, cells, features in chunks:
+            writer.writerows([str(cell)] + ["%.9g" % value for value in row]
+                             for cell, row in zip(cells, features))
+
+
+def write_predictions(chunks, predict, sink):
+    """
+    Predict the cells of a chunked feature store tile by tile and write the predictions to a raster on the grid of
+    the store. Cells without features are nodata.
+    :param chunks: Instance of feature_chunks
+    :param predict: Function taking a feature matrix and returning one value per row, e.g. the predict method of a
+    fitted model
+    :param sink: Block sink on the grid of the store, e.g. RasterTools.gdal_band_sink (a tiled GeoTIFF)
+    """
+    cols = chunks.grid.cols
+    for window, cells, features in chunks:
+        block = np.full((window.rows, window.cols), np.nan)
+        if len(cells) > 0:
+            block[cells // cols - window.row_off, cells % cols - window.col_off] = np.asarray(predict(features))
+        sink.write_block(window, block)
@@ -0,0 +1,210 @@
+import os
+import sys
+
+import numpy as np
+
+import BlockTools
+import RasterTools
+
+# Resampling methods, named like in resample-rasters.R (raster::resample)
+PYRAMID_METHODS = ["bilinear", "ngb"]
+
+PYRAMID_RESOLUTIONS = [5, 10, 25, 50, 100]
+
+
+def pyramid_file_name(prefix, resolution, method):
+    """
+    Name of a pyramid level, as written by resample-rasters.R and parsed by construct_shortened_name
+    :param prefix: DTM or DSM
+    :param resolution: Resolution of the level in metres
+    :param method: Resampling method (see PYRAMID_METHODS)
+    :return: File name, e.g. DTM_5m_bilinear.tif
+    """
+    return prefix + "_" + str(int(resolution)) + "m_" + method + ".tif"
+
+
+def level_size(source_size, factor):
+    """
+    :param source_size: Number of rows or columns of the source
+    :param factor: Ratio of the level cell size to the source cell size
+    :return: Number of rows or columns of the level, which covers the extent of the source like raster::resample
+    """
+    return max(int(source_size / factor), 1)
+
+
+def axis_plan(source_size, target_size, method):
+    """
+    Find the source cells and weights of every target cell along one axis. Target cells have the same extent as the
+    source, so target cell j is centred on source position (j + 0.5) * source_size / target_size.
+    :param source_size: Number of source cells along the axis
+    :param target_size: Number of target cells along the axis
+    :param method: bilinear or ngb
+    :return: Tuple of (lower cell, upper cell, weight of the upper cell) arrays
+    """
+    centres = (np.arange(target_size) + 0.5) * (float(source_size) / target_size)
+    if method == "ngb":
+        lower = np.clip(np.floor(centres).astype(np.int64), 0, source_size - 1)
+        return lower, lower, np.zeros(target_size)
+    if method != "bilinear":
+        raise ValueError("Unknown resampling method: " + str(method))
+
+    # Pixel centres are at half cell positions, cells beyond the edge take the edge value
+    positions = np.clip(centres - 0.5, 0, source_size - 1)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.minimum(lower + 1, source_size - 1)
+    return lower, upper, positions - lower
+
+
+def resample_block(block, row_plan, col_plan):
+    """
+    Resample the rows of a block that the row plan refers to. Nodata cells are left out of the interpolation.
+    :param block: Source rows, NaN for nodata
+    :param row_plan: Tuple of (lower, upper, weight) of the target rows, the cells relative to the first row of block
+    :param col_plan: Tuple of (lower, upper, weight) of the target columns
+    :return: Resampled rows
+    """
+    row_lower, row_upper, row_weight = row_plan
+    col_lower, col_upper, col_weight = col_plan
+    total = np.zeros((len(row_lower), len(col_lower)))
+    weights = np.zeros(total.shape)
+    for rows, row_factor in ((row_lower, 1 - row_weight), (row_upper, row_weight)):
+        for cols, col_factor in ((col_lower, 1 - col_weight), (col_upper, col_weight)):
+            values = block[rows][:, cols]
+            weight = np.where(np.isnan(values), 0.0, row_factor[:, None] * col_factor[None, :])
+            total += weight * np.nan_to_num(values)
+            weights += weight
+    with np.errstate(divide="ignore", invalid="ignore"):
+        resampled = total / weights
+    resampled[weights == 0] = np.nan
+    return resampled
+
+
+def nested_parent(resolution, computed, source_resolution, source_rows, source_cols):
+    """
+    Find a computed level from which a level can be derived exactly. Resampling level k from level f gives the same
+    cells as resampling from the source when k / f is an odd integer, as the centre of every level k cell is then the
+    centre of a level f cell (e.g. 25 m from 5 m and 50 m from 10 m), and the level grids nest.
+    :param resolution: Resolution of the level
+    :param computed: List of resolutions already computed
+    :param source_resolution: Resolution of the source
+    :param source_rows: Number of rows of the source
+    :param source_cols: Number of columns of the source
+    :return: Resolution of the coarsest suitable parent, or None to resample from the source
+    """
+    parents = []
+    for parent in computed:
+        ratio = float(resolution) / parent
+        if ratio <= 1 or abs(ratio - round(ratio)) > 1e-9 or int(round(ratio)) % 2 == 0:
+            continue
+        ratio = int(round(ratio))
+        for size in (source_rows, source_cols):
+            parent_size = level_size(size, float(parent) / source_resolution)
+            if parent_size != level_size(size, float(resolution) / source_resolution) * ratio:
+                break
+        else:
+            parents.append(parent)
+    return max(parents) if parents else None
+
+
+def build_pyramid(source, source_resolution, resolutions=PYRAMID_RESOLUTIONS, methods=PYRAMID_METHODS,
+                  strip_rows=512):
+    """
+    Build all levels of a resolution pyramid with one streamed read of the source. Levels that nest in a finer level
+    (see nested_parent) are resampled from that level instead of the source.
+    :param source: Block source of the source raster (RasterTools.gdal_band_source, BlockTools.array_source)
+    :param source_resolution: Cell size of the source
+    :param resolutions: Resolutions of the levels
+    :param methods: Resampling methods (see PYRAMID_METHODS)
+    :param strip_rows: Number of source rows read at a time
+    :return: Dictionary of (resolution, method) -> array of the level, NaN for nodata
+    """
+    parents = {}
+    for resolution in sorted(resolutions):
+        parents[resolution] = nested_parent(resolution, sorted(parents), source_resolution, source.rows, source.cols)
+
+    # Levels resampled from the source: the plans of their rows and columns, and the next row to compute
+    direct = [resolution for resolution in sorted(resolutions) if parents[resolution] is None]
+    plans = {}
+    levels = {}
+    next_row = {}
+    for resolution in direct:
+        factor = float(resolution) / source_resolution
+        rows = level_size(source.rows, factor)
+        cols = level_size(source.cols, factor)
+        for method in methods:
+            plans[(resolution, method)] = (axis_plan(source.rows, rows, method), axis_plan(source.cols, cols, method))
+            levels[(resolution, method)] = np.empty((rows, cols))
+            next_row[(resolution, method)] = 0
+
+    # Stream the source with one row of overlap, computing the level rows whose source rows are all read
+    previous_row = None
+    for strip_start in range(0, source.rows, strip_rows):
+        strip_end = min(strip_start + strip_rows, source.rows)
+        block = source.read_block(strip_start, 0, strip_end - strip_start, source.cols)
+        block_start = strip_start
+        if previous_row is not None:
+            block = np.vstack([previous_row, block])
+            block_start -= 1
+        previous_row = block[-1:]
+        for key in plans:
+            (row_lower, row_upper, row_weight), col_plan = plans[key]
+            first = next_row[key]
+            last = np.searchsorted(row_upper, strip_end, side="left")
+            if last <= first:
+                continue
+            row_plan = (row_lower[first:last] - block_start, row_upper[first:last] - block_start,
+                        row_weight[first:last])
+            levels[key][first:last] = resample_block(block, row_plan, col_plan)
+            next_row[key] = last
+
+    # Nested levels from their parents, finest first so that parents are ready
+    for resolution in sorted(resolutions):
+        parent = parents[resolution]
+        if parent is None:
+            continue
+        factor = float(resolution) / source_resolution
+        for method in methods:
+            parent_level = levels[(parent, method)]
+            rows = level_size(source.rows, factor)
+            cols = level_size(source.cols, factor)
+            levels[(resolution, method)] = resample_block(parent_level, axis_plan(parent_level.shape[0], rows, method),
+                                                          axis_plan(parent_level.shape[1], cols, method))
+    return levels
+
+
+def level_grid(grid, rows, cols):
+    """
+    :param grid: Instance of BlockTools.raster_grid of the source
+    :param rows: Number of rows of the level
+    :param cols: Number of columns of the level
+    :return: Instance of BlockTools.raster_grid of the level, covering the extent of the source
+    """
+    x_min, cell_x, rotation_x, y_max, rotation_y, cell_y = grid.geotransform
+    return BlockTools.raster_grid((x_min, cell_x * grid.cols / float(cols), rotation_x, y_max, rotation_y,
+                                   cell_y * grid.rows / float(rows)), grid.projection, rows, cols)
+
+
+def write_pyramid(input_path, output_directory, prefix, resolutions=PYRAMID_RESOLUTIONS, methods=PYRAMID_METHODS):
+    """
+    Build the pyramid of a DTM or DSM and write every level to a GeoTIFF named like resample-rasters.R does
+    :param input_path: Path to the source raster (e.g. the 1 m DTM)
+    :param output_directory: Directory where to write the levels
+    :param prefix: DTM or DSM
+    :return: Dictionary of (resolution, method) -> path of the level
+    """
+    source = RasterTools.gdal_band_source(input_path)
+    levels = build_pyramid(source, source.grid.cell_size_x(), resolutions, methods)
+    paths = {}
+    for key in sorted(levels):
+        paths[key] = os.path.join(output_directory, pyramid_file_name(prefix, key[0], key[1]))
+        RasterTools.write_raster(levels[key], level_grid(source.grid, levels[key].shape[0], levels[key].shape[1]),
+                                 paths[key])
+    return paths
+
+
+if __name__ == "__main__":
+    # Build a pyramid: python PyramidTools.py <DTM or DSM> <input raster> <output directory>
+    if len(sys.argv) != 4:
+        sys.exit("Usage: python PyramidTools.py <DTM or DSM> <input raster> <output directory>")
+    for path in sorted(write_pyramid(sys.argv[2], sys.argv[3], sys.argv[1]).values()):
+        print(path)
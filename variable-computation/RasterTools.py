@@ -0,0 +1,193 @@
+import numpy as np
+from osgeo import gdal, osr
+
+import TraceTools
+from BlockTools import raster_grid
+
+DEFAULT_NODATA = -9999.0
+
+
+def grid_centre_latitude(grid):
+    """
+    Method for finding the latitude of the centre of a grid
+    :param grid: Instance of raster_grid
+    :return: Latitude in degrees (WGS84)
+    """
+    source = osr.SpatialReference()
+    source.ImportFromWkt(grid.projection)
+    target = osr.SpatialReference()
+    target.ImportFromEPSG(4326)
+    if hasattr(target, "SetAxisMappingStrategy"):
+        target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    x = grid.geotransform[0] + grid.geotransform[1] * grid.cols / 2.0
+    y = grid.geotransform[3] + grid.geotransform[5] * grid.rows / 2.0
+    return osr.CoordinateTransformation(source, target).TransformPoint(x, y)[1]
+
+
+def open_grid(raster_path):
+    """
+    Method for reading the grid of a raster without reading the cell values
+    :param raster_path: Path to the raster
+    :return: Instance of raster_grid
+    :throws: Throws a ValueError if cannot open the raster
+    """
+    dataset = gdal.Open(raster_path)
+    if dataset is None:
+        raise ValueError("Cannot open raster: " + raster_path)
+    return raster_grid(dataset.GetGeoTransform(), dataset.GetProjection(), dataset.RasterYSize, dataset.RasterXSize)
+
+
+@TraceTools.traced("io", path_argument=0)
+def read_raster(raster_path, band_number=1):
+    """
+    Method for reading a raster band to a NumPy array. Nodata cells are set to NaN.
+    :param raster_path: Path to the raster
+    :param band_number: Band to read (starting from 1)
+    :return: Tuple of (float64 array, raster_grid)
+    :throws: Throws a ValueError if cannot open the raster
+    """
+    dataset = gdal.Open(raster_path)
+    if dataset is None:
+        raise ValueError("Cannot open raster: " + raster_path)
+    band = dataset.GetRasterBand(band_number)
+    array = band.ReadAsArray().astype(np.float64)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        array[array == nodata] = np.nan
+
+    grid = raster_grid(dataset.GetGeoTransform(), dataset.GetProjection(), dataset.RasterYSize, dataset.RasterXSize)
+    return array, grid
+
+
+@TraceTools.traced("io", path_argument=0)
+def read_bands(raster_path):
+    """
+    Method for reading all bands of a raster to a NumPy array. Nodata cells are set to NaN.
+    :param raster_path: Path to the raster
+    :return: Tuple of (float64 array of shape (bands, rows, cols), raster_grid)
+    :throws: Throws a ValueError if cannot open the raster
+    """
+    dataset = gdal.Open(raster_path)
+    if dataset is None:
+        raise ValueError("Cannot open raster: " + raster_path)
+    bands = np.empty((dataset.RasterCount, dataset.RasterYSize, dataset.RasterXSize))
+    for i in range(dataset.RasterCount):
+        band = dataset.GetRasterBand(i + 1)
+        bands[i] = band.ReadAsArray()
+        nodata = band.GetNoDataValue()
+        if nodata is not None:
+            bands[i][bands[i] == nodata] = np.nan
+
+    grid = raster_grid(dataset.GetGeoTransform(), dataset.GetProjection(), dataset.RasterYSize, dataset.RasterXSize)
+    return bands, grid
+
+
+@TraceTools.traced("io", path_argument=2)
+def write_raster(array, grid, output_path, nodata=DEFAULT_NODATA):
+    """
+    Method for writing a NumPy array to a Float32 GeoTIFF. NaN cells are written as nodata.
+    :param array: Array to write, either of the shape of the grid or of shape (bands, rows, cols) for a multiband raster
+    :param grid: Instance of raster_grid describing the output
+    :param output_path: Path to the output GeoTIFF (Will be created)
+    :param nodata: Nodata value of the output
+    """
+    bands = array.reshape((-1, grid.rows, grid.cols))
+    driver = gdal.GetDriverByName("GTiff")
+    dataset = driver.Create(output_path, grid.cols, grid.rows, bands.shape[0], gdal.GDT_Float32)
+    dataset.SetGeoTransform(grid.geotransform)
+    dataset.SetProjection(grid.projection)
+    for i in range(bands.shape[0]):
+        band = dataset.GetRasterBand(i + 1)
+        band.SetNoDataValue(nodata)
+        band.WriteArray(np.where(np.isnan(bands[i]), nodata, bands[i]).astype(np.float32))
+        band.FlushCache()
+    dataset = None
+
+
+class gdal_band_source:
+    """
+    Block source reading windows of a raster band through GDAL. Only the requested window is read to memory.
+    """
+
+    def __init__(self, raster_path, band_number=1):
+        """
+        Constructor for gdal_band_source
+        :param raster_path: Path to the raster
+        :param band_number: Band to read (starting from 1)
+        :throws: Throws a ValueError if cannot open the raster
+        """
+        self.dataset = gdal.Open(raster_path)
+        if self.dataset is None:
+            raise ValueError("Cannot open raster: " + raster_path)
+        self.band = self.dataset.GetRasterBand(band_number)
+        self.nodata = self.band.GetNoDataValue()
+        self.rows = self.dataset.RasterYSize
+        self.cols = self.dataset.RasterXSize
+        self.grid = raster_grid(self.dataset.GetGeoTransform(), self.dataset.GetProjection(), self.rows, self.cols)
+
+    def read_block(self, row_off, col_off, rows, cols):
+        block = self.band.ReadAsArray(col_off, row_off, cols, rows).astype(np.float64)
+        if self.nodata is not None:
+            block[block == self.nodata] = np.nan
+        return block
+
+
+class gdal_band_sink:
+    """
+    Block sink writing windows to a new single band Float32 GeoTIFF. NaN cells are written as nodata.
+    """
+
+    def __init__(self, output_path, grid, nodata=DEFAULT_NODATA):
+        """
+        Constructor for gdal_band_sink. Creates the output raster.
+        :param output_path: Path to the output GeoTIFF (Will be created)
+        :param grid: Instance of raster_grid describing the output
+        :param nodata: Nodata value of the output
+        """
+        driver = gdal.GetDriverByName("GTiff")
+        self.dataset = driver.Create(output_path, grid.cols, grid.rows, 1, gdal.GDT_Float32, ["TILED=YES"])
+        self.dataset.SetGeoTransform(grid.geotransform)
+        self.dataset.SetProjection(grid.projection)
+        self.band = self.dataset.GetRasterBand(1)
+        self.band.SetNoDataValue(nodata)
+        self.nodata = nodata
+
+    def write_block(self, window, block):
+        self.band.WriteArray(np.where(np.isnan(block), self.nodata, block).astype(np.float32), window.col_off,
+                             window.row_off)
+
+    def close(self):
+        self.band.FlushCache()
+        self.band = None
+        self.dataset = None
+
+
+class gdal_band_updater:
+    """
+    Block sink writing windows into an existing single band GeoTIFF, leaving the rest of the raster as it is
+    """
+
+    def __init__(self, raster_path, band_number=1):
+        """
+        Constructor for gdal_band_updater. Opens the raster for updating.
+        :param raster_path: Path to the existing raster
+        :param band_number: Band to update (starting from 1)
+        :throws: Throws a ValueError if cannot open the raster
+        """
+        self.dataset = gdal.Open(raster_path, gdal.GA_Update)
+        if self.dataset is None:
+            raise ValueError("Cannot open raster for updating: " + raster_path)
+        self.band = self.dataset.GetRasterBand(band_number)
+        self.nodata = self.band.GetNoDataValue()
+        if self.nodata is None:
+            self.nodata = DEFAULT_NODATA
+            self.band.SetNoDataValue(self.nodata)
+
+    def write_block(self, window, block):
+        self.band.WriteArray(np.where(np.isnan(block), self.nodata, block).astype(np.float32), window.col_off,
+                             window.row_off)
+
+    def close(self):
+        self.band.FlushCache()
+        self.band = None
+        self.dataset = None
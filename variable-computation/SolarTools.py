@@ -0,0 +1,289 @@
+import math
+from multiprocessing import Pool
+
+import numpy as np
+
+import BlockTools
+
+# Clear-sky model constants of r.sun (Suri & Hofierka 2004)
+SOLAR_CONSTANT = 1367.0
+DEFAULT_LINKE_TURBIDITY = 3.0
+DEFAULT_ALBEDO = 0.2
+SHADOWED_DIFFUSE_N = 0.25227
+
+# Horizon search distances grow geometrically by this factor, one cell at a time near the cell
+HORIZON_STEP_GROWTH = 1.05
+
+# Names of the outputs, matching the grass7:r.sun outputs
+RADIATION_OUTPUTS = ["beam", "insolation_time", "diffuse", "reflected", "global"]
+
+
+def horizon_distances(max_cells):
+    """
+    Distances (in cells) at which the horizon is searched. Every cell is tested near the centre and the steps grow
+    geometrically further away.
+    :param max_cells: Maximum search distance in cells
+    :return: Sorted list of distinct distances
+    """
+    distances = set()
+    distance = 1.0
+    while distance <= max_cells:
+        distances.add(int(round(distance)))
+        distance = max(distance * HORIZON_STEP_GROWTH, distance + 1.0)
+    return sorted(distances)
+
+
+def sector_horizon(padded, halo, cell_size, azimuth, max_cells, raster_shape):
+    """
+    Compute the horizon angle of every cell of a window towards one azimuth
+    :param padded: DEM window padded with halo cells on each side (see BlockTools.read_padded_window), NaN for nodata
+    and outside the raster
+    :param halo: Number of halo cells, enough for the longest shift inside the raster (see horizon_halo)
+    :param cell_size: Cell size in map units
+    :param azimuth: Azimuth in radians clockwise from north
+    :param max_cells: Maximum search distance in cells
+    :param raster_shape: Tuple of (rows, cols) of the whole raster, shifts beyond it only find cells outside the raster
+    :return: Horizon angle in radians (0 when nothing rises above the cell), the shape of the unpadded window
+    """
+    rows = padded.shape[0] - 2 * halo
+    cols = padded.shape[1] - 2 * halo
+    centre = padded[halo:halo + rows, halo:halo + cols]
+    horizon_tangent = np.zeros(centre.shape)
+    for distance in horizon_distances(max_cells):
+        row_shift = int(round(-distance * math.cos(azimuth)))
+        col_shift = int(round(distance * math.sin(azimuth)))
+        if abs(row_shift) >= raster_shape[0] or abs(col_shift) >= raster_shape[1]:
+            break
+        shifted = padded[halo + row_shift:halo + row_shift + rows, halo + col_shift:halo + col_shift + cols]
+        with np.errstate(invalid="ignore"):
+            tangent = (shifted - centre) / (math.hypot(row_shift, col_shift) * cell_size)
+        horizon_tangent = np.fmax(horizon_tangent, tangent)
+    return np.arctan(horizon_tangent)
+
+
+def horizon_halo(max_cells, rows, cols):
+    """
+    :return: Number of halo cells the horizon search needs around a window of a raster of rows x cols cells
+    """
+    return min(max_cells, max(rows, cols))
+
+
+# Block source of the DEM in a worker process, opened once per worker so the DEM is not sent with every task
+_worker_source = None
+
+
+def _open_worker_source(opener, arguments):
+    global _worker_source
+    _worker_source = opener(*arguments)
+
+
+def _horizon_task(arguments):
+    # Horizon angles of one window for some of the azimuths, read from the DEM of the worker
+    window, cell_size, azimuths, max_cells = arguments
+    halo = horizon_halo(max_cells, _worker_source.rows, _worker_source.cols)
+    padded = BlockTools.read_padded_window(_worker_source, window, halo)
+    return np.array([sector_horizon(padded, halo, cell_size, azimuth, max_cells,
+                                    (_worker_source.rows, _worker_source.cols)) for azimuth in azimuths],
+                    dtype=np.float32)
+
+
+def horizon_blocks(opener, arguments, cell_size, windows, sectors=16, max_distance=5000.0, processes=1):
+    """
+    Compute the horizon angles window by window for evenly spaced azimuth sectors. Each window is read with the halo
+    of the search distance, so memory depends on the window size and the search distance instead of the raster
+    size. Worker processes open the DEM once, in the pool initializer, and compute whole windows, or single sectors
+    if there are fewer windows than processes.
+    :param opener: Picklable function returning the block source of the DEM, e.g. RasterTools.gdal_band_source
+    :param arguments: Tuple of arguments of opener, e.g. (dem_path,)
+    :param cell_size: Cell size in map units
+    :param windows: List of BlockTools.raster_window instances to compute
+    :param sectors: Number of azimuth sectors, the first one towards north
+    :param max_distance: Maximum search distance in map units
+    :param processes: Number of worker processes
+    :return: Generator of (window, float32 array of shape (sectors, rows, cols) with horizon angles in radians), in
+    the order of windows
+    """
+    windows = list(windows)
+    azimuths = [2 * math.pi * sector / sectors for sector in range(sectors)]
+    max_cells = horizon_cells(max_distance, cell_size)
+    split = processes > 1 and len(windows) < processes
+    parts = sectors if split else 1
+    tasks = [(window, cell_size, [azimuth] if split else azimuths, max_cells)
+             for window in windows for azimuth in (azimuths if split else azimuths[:1])]
+    if processes > 1:
+        pool = Pool(processes, _open_worker_source, (opener, arguments))
+        results = pool.imap(_horizon_task, tasks)
+    else:
+        pool = None
+        _open_worker_source(opener, arguments)
+        results = (_horizon_task(task) for task in tasks)
+    try:
+        for window in windows:
+            yield window, np.concatenate([next(results) for _ in range(parts)])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def compute_horizon_angles(dem, cell_size, sectors=16, max_distance=5000.0, processes=1, window=None):
+    """
+    Compute the horizon angles of every cell for evenly spaced azimuth sectors. The result depends only on the DEM, so
+    it can be computed once per DEM and cached.
+    :param dem: DEM as 2D array, NaN for nodata
+    :param cell_size: Cell size in map units
+    :param sectors: Number of azimuth sectors, the first one towards north
+    :param max_distance: Maximum search distance in map units
+    :param processes: Number of worker processes to spread the sectors over
+    :param window: Cells to compute as (row_off, col_off, rows, cols), None for the whole DEM
+    :return: float32 array of shape (sectors, rows, cols) with horizon angles in radians
+    """
+    if window is None:
+        window = (0, 0, dem.shape[0], dem.shape[1])
+    windows = [BlockTools.raster_window(*window)]
+    return list(horizon_blocks(BlockTools.array_source, (dem,), cell_size, windows, sectors, max_distance,
+                               processes))[0][1]
+
+
+def horizon_cells(max_distance, cell_size):
+    """
+    :return: Maximum horizon search distance in cells
+    """
+    return max(int(max_distance / cell_size), 1)
+
+
+def solar_declination(day):
+    """
+    :param day: Day of the year
+    :return: Solar declination in radians
+    """
+    day_angle = 2 * math.pi * day / 365.25
+    return math.asin(0.3978 * math.sin(day_angle - 1.4 + 0.0355 * math.sin(day_angle - 0.0489)))
+
+
+def solar_position(day, times, latitude):
+    """
+    Compute the solar altitude and azimuth for a batch of solar times
+    :param day: Day of the year
+    :param times: Array of local solar times in hours
+    :param latitude: Latitude in degrees
+    :return: Tuple of (altitude, azimuth clockwise from north) arrays in radians
+    """
+    declination = solar_declination(day)
+    latitude = math.radians(latitude)
+    hour_angle = 0.261799 * (np.asarray(times, dtype=np.float64) - 12.0)
+    sin_altitude = math.cos(latitude) * math.cos(declination) * np.cos(hour_angle) + \
+        math.sin(latitude) * math.sin(declination)
+    altitude = np.arcsin(np.clip(sin_altitude, -1.0, 1.0))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cos_azimuth = (math.sin(declination) - np.sin(altitude) * math.sin(latitude)) / \
+            (np.cos(altitude) * math.cos(latitude))
+    azimuth = np.arccos(np.clip(np.nan_to_num(cos_azimuth), -1.0, 1.0))
+    azimuth = np.where(hour_angle > 0, 2 * math.pi - azimuth, azimuth)
+    return altitude, azimuth
+
+
+def _beam_normal_irradiance(extraterrestrial, altitude, elevation, linke):
+    # ESRA clear-sky beam irradiance normal to the sun, with the refraction corrected relative optical air mass
+    altitude_degrees = np.degrees(altitude)
+    refraction = 0.061359 * (0.1594 + 1.123 * altitude_degrees + 0.065656 * altitude_degrees ** 2) / \
+        (1 + 28.9344 * altitude_degrees + 277.3971 * altitude_degrees ** 2)
+    corrected = altitude_degrees + refraction
+    air_mass = np.exp(-elevation / 8434.5) / (np.sin(np.radians(corrected)) +
+                                              0.50572 * (corrected + 6.07995) ** -1.6364)
+    rayleigh = np.where(air_mass <= 20,
+                        1 / (6.6296 + 1.7513 * air_mass - 0.1202 * air_mass ** 2 + 0.0065 * air_mass ** 3 -
+                             0.00013 * air_mass ** 4),
+                        1 / (10.4 + 0.718 * air_mass))
+    return extraterrestrial * np.exp(-0.8662 * linke * air_mass * rayleigh)
+
+
+def _diffuse_horizontal_irradiance(extraterrestrial, altitude, linke):
+    # ESRA clear-sky diffuse irradiance on a horizontal surface
+    transmission = -0.015843 + 0.030543 * linke + 0.0003797 * linke ** 2
+    a1 = 0.26463 - 0.061581 * linke + 0.0031408 * linke ** 2
+    if a1 * transmission < 0.0022:
+        a1 = 0.0022 / transmission
+    a2 = 2.04020 + 0.018945 * linke - 0.011161 * linke ** 2
+    a3 = -1.3025 + 0.039231 * linke + 0.0085079 * linke ** 2
+    sin_altitude = math.sin(altitude)
+    return extraterrestrial * transmission * (a1 + a2 * sin_altitude + a3 * sin_altitude ** 2)
+
+
+def compute_daily_radiation(dem, slope, aspect, horizons, day, latitude, step=0.5, linke=DEFAULT_LINKE_TURBIDITY,
+                            albedo=DEFAULT_ALBEDO, batch_size=4):
+    """
+    Compute the clear-sky daily radiation like grass7:r.sun in mode 2 (daily sums). The time steps of the day are
+    evaluated in batches as array operations, and terrain shading is looked up from precomputed horizon angles.
+    :param dem: DEM as 2D array, NaN for nodata
+    :param slope: Slope in degrees
+    :param aspect: Aspect in degrees counterclockwise from east, as computed by TerrainTools (0 = flat)
+    :param horizons: Horizon angles from compute_horizon_angles
+    :param day: Day of the year
+    :param latitude: Latitude of the area in degrees
+    :param step: Time step in hours
+    :param linke: Linke atmospheric turbidity
+    :param albedo: Ground albedo
+    :param batch_size: Number of time steps evaluated at once
+    :return: Dictionary of output name (see RADIATION_OUTPUTS) -> array. Irradiation in Wh/m2/day, insolation time
+    in hours.
+    """
+    sectors = horizons.shape[0]
+    slope = np.radians(slope)
+    surface_azimuth = np.radians((90.0 - aspect) % 360.0)
+    cos_slope = np.cos(slope)
+    sin_slope = np.sin(slope)
+    sky_view = (1 + cos_slope) / 2
+    ground_view = (1 - cos_slope) / 2
+    muneer_term = sin_slope - slope * cos_slope - math.pi * np.sin(slope / 2) ** 2
+    elevation = np.nan_to_num(dem)
+
+    day_angle = 2 * math.pi * day / 365.25
+    extraterrestrial = SOLAR_CONSTANT * (1 + 0.03344 * math.cos(day_angle - 0.048869))
+
+    times = np.arange(step / 2, 24.0, step)
+    altitudes, azimuths = solar_position(day, times, latitude)
+    daytime = altitudes > 0
+    altitudes = altitudes[daytime]
+    azimuths = azimuths[daytime]
+
+    totals = {}
+    for name in RADIATION_OUTPUTS:
+        totals[name] = np.zeros(dem.shape)
+
+    for batch_start in range(0, len(altitudes), batch_size):
+        altitude = altitudes[batch_start:batch_start + batch_size][:, None, None]
+        azimuth = azimuths[batch_start:batch_start + batch_size][:, None, None]
+
+        sector = np.round(azimuth[:, 0, 0] / (2 * math.pi) * sectors).astype(np.int64) % sectors
+        cos_incidence = cos_slope * np.sin(altitude) + sin_slope * np.cos(altitude) * np.cos(azimuth - surface_azimuth)
+        sunlit = (altitude > horizons[sector]) & (cos_incidence > 0)
+
+        beam_normal = _beam_normal_irradiance(extraterrestrial, altitude, elevation, linke)
+        beam = np.where(sunlit, beam_normal * cos_incidence, 0.0)
+
+        diffuse_horizontal = np.array([_diffuse_horizontal_irradiance(extraterrestrial, a, linke)
+                                       for a in altitude[:, 0, 0]])[:, None, None]
+        beam_ratio = beam_normal / extraterrestrial
+        lit_n = 0.00263 - 0.712 * beam_ratio - 0.6883 * beam_ratio ** 2
+        lit_fx = sky_view + muneer_term * lit_n
+        high_sun = (1 - beam_ratio) * lit_fx + beam_ratio * cos_incidence / np.sin(altitude)
+        low_sun = (1 - beam_ratio) * lit_fx + beam_ratio * sin_slope * np.cos(azimuth - surface_azimuth) / \
+            (0.1 - 0.008 * altitude)
+        diffuse = diffuse_horizontal * np.where(sunlit, np.where(altitude >= 0.1, high_sun, low_sun),
+                                                sky_view + muneer_term * SHADOWED_DIFFUSE_N)
+        diffuse = np.where(slope == 0, diffuse_horizontal, diffuse)
+
+        global_horizontal = beam_normal * np.sin(altitude) + diffuse_horizontal
+        reflected = albedo * global_horizontal * ground_view
+
+        totals["beam"] += beam.sum(axis=0) * step
+        totals["insolation_time"] += sunlit.sum(axis=0) * step
+        totals["diffuse"] += diffuse.sum(axis=0) * step
+        totals["reflected"] += reflected.sum(axis=0) * step
+
+    totals["global"] = totals["beam"] + totals["diffuse"] + totals["reflected"]
+    nodata = np.isnan(dem) | np.isnan(slope) | np.isnan(aspect)
+    for name in totals:
+        totals[name][nodata] = np.nan
+    return totals
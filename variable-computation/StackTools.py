@@ -0,0 +1,150 @@
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import BlockTools
+
+REDUCERS = ["mean", "nanmean", "weighted_mean", "min", "max", "std"]
+
+
+class aligned_source:
+    """
+    Block source reading a raster on another grid with the same cell size, e.g. coverages of slightly different
+    extents on the grid of the first one. Cells of the grid outside the raster are NaN.
+    """
+
+    def __init__(self, source, source_grid, grid):
+        """
+        Constructor for aligned_source
+        :param source: Block source of the raster
+        :param source_grid: Instance of BlockTools.raster_grid of the raster
+        :param grid: Instance of BlockTools.raster_grid to read the raster on
+        :throws: Throws a ValueError if the cell sizes differ or the grids are shifted by a fraction of a cell
+        """
+        if not (np.isclose(source_grid.cell_size_x(), grid.cell_size_x()) and
+                np.isclose(source_grid.cell_size_y(), grid.cell_size_y())):
+            raise ValueError("The rasters of a stack need the same cell size, warp them first (see WarpTools)")
+        row_shift = (source_grid.geotransform[3] - grid.geotransform[3]) / grid.cell_size_y()
+        col_shift = (grid.geotransform[0] - source_grid.geotransform[0]) / grid.cell_size_x()
+        if abs(row_shift - round(row_shift)) > 0.01 or abs(col_shift - round(col_shift)) > 0.01:
+            raise ValueError("The rasters of a stack need aligned cells, warp them first (see WarpTools)")
+        self.source = source
+        # Row and column of the raster at the first row and column of the grid
+        self.row_shift = int(round(row_shift))
+        self.col_shift = int(round(col_shift))
+        self.source_rows = source_grid.rows
+        self.source_cols = source_grid.cols
+        self.rows = grid.rows
+        self.cols = grid.cols
+
+    def read_block(self, row_off, col_off, rows, cols):
+        block = np.full((rows, cols), np.nan)
+        first_row = max(row_off + self.row_shift, 0)
+        first_col = max(col_off + self.col_shift, 0)
+        last_row = min(row_off + rows + self.row_shift, self.source_rows)
+        last_col = min(col_off + cols + self.col_shift, self.source_cols)
+        if last_row > first_row and last_col > first_col:
+            row_start = first_row - self.row_shift - row_off
+            col_start = first_col - self.col_shift - col_off
+            block[row_start:row_start + last_row - first_row, col_start:col_start + last_col - first_col] = \
+                self.source.read_block(first_row, first_col, last_row - first_row, last_col - first_col)
+        return block
+
+
+def depth_weights(depths):
+    """
+    Weights of soil layers for a depth-weighted mean over the whole depth range
+    :param depths: List of (top, bottom) depths of the layers, equal for values at a point depth (e.g. SoilGrids
+    content at 0.00, 0.05, 0.15 m) and an interval for values of a depth interval (e.g. stocks of 0.00 - 0.05 m)
+    :return: Array of weights summing to 1: the thickness of the intervals, or the trapezoidal rule over point depths
+    """
+    depths = np.asarray(depths, dtype=np.float64).reshape(-1, 2)
+    thickness = depths[:, 1] - depths[:, 0]
+    if np.all(thickness > 0):
+        weights = thickness
+    elif len(depths) == 1:
+        weights = np.ones(1)
+    else:
+        points = depths[:, 0]
+        order = np.argsort(points)
+        edges = np.concatenate([[points[order[0]]], (points[order[1:]] + points[order[:-1]]) / 2.0,
+                                [points[order[-1]]]])
+        weights = np.empty(len(points))
+        weights[order] = np.diff(edges)
+    if weights.sum() <= 0:
+        raise ValueError("Depth weights need layers of different depths: " + str(depths.tolist()))
+    return weights / weights.sum()
+
+
+def reduce_stack(stack, method, weights=None):
+    """
+    Reduce a stack of aligned blocks cell by cell
+    :param stack: float64 array of shape (layers, rows, cols), NaN for nodata
+    :param method: One of REDUCERS. mean is NaN where any layer is nodata, the others use the valid layers only:
+    nanmean, weighted_mean (weights normalized over the valid layers of each cell), min, max and std (population)
+    :param weights: Weight of each layer for weighted_mean, e.g. from depth_weights
+    :return: float64 array of shape (rows, cols), NaN where no layer (any layer for mean) has a value
+    """
+    if method == "mean":
+        return stack.mean(axis=0)
+    if method == "min":
+        return np.fmin.reduce(stack, axis=0)
+    if method == "max":
+        return np.fmax.reduce(stack, axis=0)
+
+    valid = ~np.isnan(stack)
+    values = np.where(valid, stack, 0.0)
+    if method == "weighted_mean":
+        if weights is None or len(weights) != len(stack):
+            raise ValueError("weighted_mean needs one weight per layer")
+        layer_weights = np.asarray(weights, dtype=np.float64).reshape(-1, 1, 1) * valid
+    elif method in ("nanmean", "std"):
+        layer_weights = valid.astype(np.float64)
+    else:
+        raise ValueError("Unknown reducer: " + str(method))
+    total = layer_weights.sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = (layer_weights * values).sum(axis=0) / total
+        if method == "std":
+            result = np.sqrt((layer_weights * (values - mean) ** 2).sum(axis=0) / total)
+        else:
+            result = mean
+    result[total == 0] = np.nan
+    return result
+
+
+def reduce_blocks(sources, sinks, weights=None, tile_size=512):
+    """
+    Reduce N rasters on the same grid block by block, so that peak memory depends on the tile size and the number of
+    rasters instead of the raster size. Every block of the inputs is read once for all reducers.
+    :param sources: List of block sources on the same grid (e.g. aligned_source)
+    :param sinks: Dictionary of reducer name (see REDUCERS) -> block sink
+    :param weights: Weight of each source for weighted_mean
+    :param tile_size: Size of the tile side in cells
+    """
+    for method in sinks:
+        if method not in REDUCERS:
+            raise ValueError("Unknown reducer: " + str(method))
+    for window in BlockTools.generate_windows(sources[0].rows, sources[0].cols, tile_size):
+        stack = np.stack([source.read_block(window.row_off, window.col_off, window.rows, window.cols)
+                          for source in sources])
+        for method in sinks:
+            sinks[method].write_block(window, reduce_stack(stack, method, weights))
+
+
+def run_parallel(tasks, workers):
+    """
+    Run independent tasks, e.g. one reduction per raster group, in a pool of threads. GDAL reads and writes and the
+    NumPy reductions release the interpreter lock, so the groups use several cores.
+    :param tasks: List of functions without arguments
+    :param workers: Number of tasks run at the same time
+    :return: List of the results of the tasks, in order
+    """
+    if not tasks:
+        return []
+    pool = ThreadPool(min(workers, len(tasks)))
+    try:
+        return pool.map(lambda task: task(), tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,116 @@
+import numpy as np
+
+# Number of cells each derivative needs around the computed cell (3x3 kernels)
+TERRAIN_HALO = 1
+
+# Names of the computed derivatives, in the order r.slope.aspect outputs them, plus the Zevenbergen & Thorne slope
+TERRAIN_DERIVATIVES = ["slope", "aspect", "profile_curvature", "tangential_curvature", "dx", "dy", "dxx", "dyy", "dxy",
+                       "saga_slope"]
+
+
+def pad_with_nodata(array, halo):
+    """
+    Pad an array with NaN cells on each side, so edge cells get nodata like in GRASS
+    :param array: 2D array to pad
+    :param halo: Number of cells to add on each side
+    :return: Padded float64 array
+    """
+    return np.pad(array.astype(np.float64), halo, mode="constant", constant_values=np.nan)
+
+
+def neighbourhood(padded):
+    """
+    Split a padded array into the nine shifted views of the 3x3 neighbourhood. No data is copied.
+        c1 c2 c3
+        c4 c5 c6
+        c7 c8 c9
+    :param padded: Array padded with one cell on each side
+    :return: List of the nine views [c1, ..., c9], each the size of the unpadded array
+    """
+    rows = padded.shape[0] - 2
+    cols = padded.shape[1] - 2
+    return [padded[r:r + rows, c:c + cols] for r in range(3) for c in range(3)]
+
+
+def derivatives_from_padded(padded, ew_res, ns_res):
+    """
+    Compute all terrain derivatives from a DEM window that already contains a one cell halo. Derivatives follow the
+    conventions of grass:r.slope.aspect:
+        - slope in degrees, aspect in degrees counterclockwise from east (90 = north, 360 = east, 0 = flat)
+        - dx and dy are the Horn first order derivatives, positive towards east and north
+        - dxx, dyy and dxy are the second order derivatives of the 3x3 quadratic surface
+    saga_slope is the slope of saga:slopeaspectcurvature with the Zevenbergen & Thorne method, in degrees.
+    :param padded: DEM array with one cell halo on each side. NaN for nodata.
+    :param ew_res: Cell size in east-west direction
+    :param ns_res: Cell size in north-south direction
+    :return: Dictionary of derivative name -> array, each the size of the unpadded window
+    """
+    c1, c2, c3, c4, c5, c6, c7, c8, c9 = neighbourhood(padded)
+
+    dx = ((c3 + 2 * c6 + c9) - (c1 + 2 * c4 + c7)) / (8.0 * ew_res)
+    dy = ((c1 + 2 * c2 + c3) - (c7 + 2 * c8 + c9)) / (8.0 * ns_res)
+    dxx = ((c1 + c3 + c4 + c6 + c7 + c9) - 2 * (c2 + c5 + c8)) / (3.0 * ew_res * ew_res)
+    dyy = ((c1 + c2 + c3 + c7 + c8 + c9) - 2 * (c4 + c5 + c6)) / (3.0 * ns_res * ns_res)
+    dxy = ((c3 + c7) - (c1 + c9)) / (4.0 * ew_res * ns_res)
+
+    gradient = dx * dx + dy * dy
+    slope = np.degrees(np.arctan(np.sqrt(gradient)))
+
+    # Aspect is the direction of steepest descent, measured counterclockwise from east
+    aspect = np.degrees(np.arctan2(-dy, -dx))
+    aspect[aspect <= 0] += 360.0
+    aspect[gradient == 0] = 0.0
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        profile_curvature = (dxx * dx * dx + 2 * dxy * dx * dy + dyy * dy * dy) / (gradient * (gradient + 1) ** 1.5)
+        tangential_curvature = (dxx * dy * dy - 2 * dxy * dx * dy + dyy * dx * dx) / (gradient * np.sqrt(gradient + 1))
+    profile_curvature[gradient == 0] = 0.0
+    tangential_curvature[gradient == 0] = 0.0
+
+    return {"slope": slope,
+            "aspect": aspect,
+            "profile_curvature": profile_curvature,
+            "tangential_curvature": tangential_curvature,
+            "dx": dx,
+            "dy": dy,
+            "dxx": dxx,
+            "dyy": dyy,
+            "dxy": dxy,
+            "saga_slope": saga_slope_from_padded(padded, ew_res, ns_res)}
+
+
+def saga_slope_from_padded(padded, ew_res, ns_res):
+    """
+    Compute the slope of saga:slopeaspectcurvature with the Zevenbergen & Thorne method from a DEM window that already
+    contains a one cell halo.
+    :param padded: DEM array with one cell halo on each side. NaN for nodata.
+    :param ew_res: Cell size in east-west direction
+    :param ns_res: Cell size in north-south direction
+    :return: Slope in degrees, the size of the unpadded window
+    """
+    c1, c2, c3, c4, c5, c6, c7, c8, c9 = neighbourhood(padded)
+    zt_dx = (c6 - c4) / (2.0 * ew_res)
+    zt_dy = (c2 - c8) / (2.0 * ns_res)
+    return np.degrees(np.arctan(np.sqrt(zt_dx * zt_dx + zt_dy * zt_dy)))
+
+
+def compute_terrain_derivatives(dem, ew_res, ns_res):
+    """
+    Compute all terrain derivatives of a whole DEM. Cells on the raster edge and next to nodata get nodata (NaN).
+    :param dem: DEM as 2D array, NaN for nodata
+    :param ew_res: Cell size in east-west direction
+    :param ns_res: Cell size in north-south direction
+    :return: Dictionary of derivative name -> array (see derivatives_from_padded)
+    """
+    return derivatives_from_padded(pad_with_nodata(dem, TERRAIN_HALO), ew_res, ns_res)
+
+
+def compute_saga_slope(dem, ew_res, ns_res):
+    """
+    Compute the Zevenbergen & Thorne slope of a whole DEM
+    :param dem: DEM as 2D array, NaN for nodata
+    :param ew_res: Cell size in east-west direction
+    :param ns_res: Cell size in north-south direction
+    :return: Slope in degrees, NaN for nodata
+    """
+    return saga_slope_from_padded(pad_with_nodata(dem, TERRAIN_HALO), ew_res, ns_res)
@@ -0,0 +1,303 @@
+import functools
+import json
+import os
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Arguments that child spans inherit from their parents, used to group the summary
+INHERITED_ARGUMENTS = ["resolution"]
+
+
+def cpu_time():
+    """
+    :return: CPU time (user + system) used by the process and its finished child processes in seconds
+    """
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def current_rss(pid=None):
+    """
+    :param pid: Process id, None for this process
+    :return: Resident set size of the process in bytes, or None if it cannot be measured or the process has exited
+    """
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return None
+    try:
+        with open("/proc/" + (str(pid) if pid is not None else "self") + "/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+class rss_sampler:
+    """
+    Thread sampling the resident set size of this process and of the watched child processes while spans are open,
+    so every span gets its own peak instead of the peak of the whole process lifetime. Peaks shorter than the sampling
+    interval can be missed.
+    """
+
+    def __init__(self, interval=0.05):
+        """
+        Constructor for rss_sampler
+        :param interval: Seconds between samples
+        """
+        self.interval = interval
+        self.spans = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, span):
+        with self._lock:
+            self.spans.add(span)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        self.sample([span])
+
+    def remove(self, span):
+        self.sample([span])
+        with self._lock:
+            self.spans.discard(span)
+
+    def sample(self, spans):
+        rss = current_rss()
+        for span in spans:
+            span.observe(rss)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                spans = list(self.spans)
+                if not spans:
+                    # Started again by the next span
+                    self._thread = None
+                    return
+            self.sample(spans)
+
+
+def io_counters():
+    """
+    :return: Tuple of (bytes read, bytes written) by the process from storage, or None if it cannot be measured
+    """
+    if psutil is not None:
+        try:
+            counters = psutil.Process().io_counters()
+            return counters.read_bytes, counters.write_bytes
+        except (AttributeError, NotImplementedError):
+            pass
+    try:
+        with open("/proc/self/io", 'r') as f:
+            fields = dict(line.split(":") for line in f if ":" in line)
+        return int(fields["read_bytes"]), int(fields["write_bytes"])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+class trace_span:
+    """
+    Context manager measuring one call: wall time, CPU time, peak RSS and bytes read and written. The peak RSS of spans
+    of the subprocess category is the peak of the child processes watched during the span.
+    """
+
+    def __init__(self, recorder, name, category, arguments):
+        self.recorder = recorder
+        self.name = name
+        self.category = category
+        self.arguments = arguments
+        self.children = []
+        self.peak = None
+
+    def observe(self, rss):
+        """
+        Update the peak RSS of the span with a sample
+        :param rss: Resident set size of this process in bytes, or None
+        """
+        if self.category == "subprocess":
+            sizes = [size for size in (current_rss(pid) for pid in self.children) if size is not None]
+            rss = sum(sizes) if sizes else None
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def __enter__(self):
+        stack = self.recorder._stack()
+        for key in INHERITED_ARGUMENTS:
+            if key not in self.arguments:
+                for parent in reversed(stack):
+                    if key in parent.arguments:
+                        self.arguments[key] = parent.arguments[key]
+                        break
+        stack.append(self)
+        self.recorder.sampler.add(self)
+        self.start_io = io_counters()
+        self.start_cpu = cpu_time()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        end = time.time()
+        end_cpu = cpu_time()
+        end_io = io_counters()
+        self.recorder.sampler.remove(self)
+        self.recorder._stack().pop()
+        event = {"name": self.name,
+                 "category": self.category,
+                 "arguments": self.arguments,
+                 "start": self.start,
+                 "wall_time": end - self.start,
+                 "cpu_time": end_cpu - self.start_cpu,
+                 "peak_rss": self.peak,
+                 "bytes_read": None,
+                 "bytes_written": None,
+                 "failed": exception_type is not None,
+                 "thread": threading.current_thread().ident}
+        if self.start_io is not None and end_io is not None:
+            event["bytes_read"] = end_io[0] - self.start_io[0]
+            event["bytes_written"] = end_io[1] - self.start_io[1]
+        self.recorder._add(event)
+        return False
+
+
+class trace_recorder:
+    """
+    Collects the spans of a run. CPU time (including finished child processes) and IO are measured for the whole
+    process, so spans running in parallel threads include each other's work.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.created = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.sampler = rss_sampler()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _add(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def span(self, name, category="step", **arguments):
+        """
+        :param name: Name of the traced call, e.g. the tool name
+        :param category: Kind of call, e.g. tool, subprocess, io or zonal
+        :param arguments: JSON serializable details of the call, e.g. resolution or input path
+        :return: Context manager recording the span
+        """
+        return trace_span(self, name, category, arguments)
+
+    def watch_process(self, pid):
+        """
+        Add a child process to the peak RSS of the innermost span of the calling thread
+        :param pid: Process id of the child, e.g. the pid of a subprocess.Popen
+        """
+        stack = self._stack()
+        if stack:
+            stack[-1].children.append(pid)
+
+    def write_chrome_trace(self, output_path):
+        """
+        Write the spans in the Chrome trace event format, viewable in chrome://tracing or Perfetto
+        :param output_path: Path to the output JSON file
+        """
+        trace_events = []
+        for event in self.events:
+            arguments = dict(event["arguments"])
+            for key in ["cpu_time", "peak_rss", "bytes_read", "bytes_written", "failed"]:
+                arguments[key] = event[key]
+            trace_events.append({"name": event["name"],
+                                 "cat": event["category"],
+                                 "ph": "X",
+                                 "ts": int((event["start"] - self.created) * 1e6),
+                                 "dur": int(event["wall_time"] * 1e6),
+                                 "pid": os.getpid(),
+                                 "tid": event["thread"],
+                                 "args": arguments})
+        with open(output_path, 'w') as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+    def summary(self):
+        """
+        Aggregate the spans by category, name and resolution
+        :return: List of dictionaries sorted by total wall time, slowest first
+        """
+        groups = {}
+        for event in self.events:
+            key = (event["category"], event["name"], event["arguments"].get("resolution"))
+            if key not in groups:
+                groups[key] = {"category": key[0], "name": key[1], "resolution": key[2], "calls": 0,
+                               "wall_time": 0.0, "cpu_time": 0.0, "max_wall_time": 0.0, "peak_rss": 0,
+                               "bytes_read": 0, "bytes_written": 0}
+            group = groups[key]
+            group["calls"] += 1
+            group["wall_time"] += event["wall_time"]
+            group["cpu_time"] += event["cpu_time"]
+            group["max_wall_time"] = max(group["max_wall_time"], event["wall_time"])
+            group["peak_rss"] = max(group["peak_rss"], event["peak_rss"] or 0)
+            group["bytes_read"] += event["bytes_read"] or 0
+            group["bytes_written"] += event["bytes_written"] or 0
+        return sorted(groups.values(), key=lambda group: group["wall_time"], reverse=True)
+
+    def print_summary(self):
+        """
+        Print the summary table of the spans
+        """
+        print("{0:<10} {1:<40} {2:>6} {3:>6} {4:>10} {5:>10} {6:>10} {7:>9} {8:>9} {9:>9}".format(
+            "Category", "Name", "Res", "Calls", "Wall s", "CPU s", "Max s", "Peak MB", "Read MB", "Write MB"))
+        for group in self.summary():
+            print("{0:<10} {1:<40} {2:>6} {3:>6} {4:>10.2f} {5:>10.2f} {6:>10.2f} {7:>9.0f} {8:>9.1f} {9:>9.1f}".format(
+                group["category"][:10], group["name"][:40], str(group["resolution"] or "")[:6], group["calls"],
+                group["wall_time"], group["cpu_time"], group["max_wall_time"], group["peak_rss"] / 1e6,
+                group["bytes_read"] / 1e6, group["bytes_written"] / 1e6))
+
+
+# Recorder shared by the modules of a run
+recorder = trace_recorder()
+
+
+def span(name, category="step", **arguments):
+    """
+    Trace a call with the shared recorder:
+        with TraceTools.span("saga:catchmentarea", "tool", resolution=5):
+            ...
+    """
+    return recorder.span(name, category, **arguments)
+
+
+def watch_process(pid):
+    """
+    Add a child process to the peak RSS of the innermost span of the calling thread, see trace_recorder.watch_process
+    """
+    recorder.watch_process(pid)
+
+
+def traced(category, name=None, path_argument=None):
+    """
+    Decorator tracing every call of a function with the shared recorder
+    :param category: Kind of call
+    :param name: Name of the span, the function name by default
+    :param path_argument: Position of a path argument to record as the file name of the call, or None
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            arguments = {}
+            if path_argument is not None and len(args) > path_argument:
+                arguments["file"] = os.path.basename(str(args[path_argument]))
+            with recorder.span(name or function.__name__, category, **arguments):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,216 @@
+import numpy as np
+from osgeo import osr
+
+import RasterTools
+
+# Resampling methods, in the order of the METHOD choices of gdalogr:warpreproject
+WARP_METHODS = ["nearest", "bilinear"]
+
+# The coordinate transformation is computed exactly every this many cells and interpolated in between, like the
+# approximate transformer of gdalwarp
+LATTICE_STEP = 16
+
+# Number of points along each edge of the source raster used to find the extent of the target grid
+EDGE_POINTS = 21
+
+# Warp plans computed so far, keyed by source grid, target grid and resampling method
+_plans = {}
+
+
+def spatial_reference(definition):
+    """
+    :param definition: Spatial reference as "EPSG:<code>" or WKT
+    :return: osr.SpatialReference with x/y (longitude/latitude) axis order
+    """
+    reference = osr.SpatialReference()
+    if definition.upper().startswith("EPSG:"):
+        reference.ImportFromEPSG(int(definition.split(":")[1]))
+    else:
+        reference.ImportFromWkt(definition)
+    if hasattr(reference, "SetAxisMappingStrategy"):
+        reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return reference
+
+
+def transform_points(transformation, x, y):
+    """
+    Transform arrays of coordinates
+    :param transformation: osr.CoordinateTransformation
+    :param x: Array of x coordinates
+    :param y: Array of y coordinates, the shape of x
+    :return: Tuple of (x, y) arrays in the target spatial reference, the shape of x
+    """
+    points = transformation.TransformPoints(list(zip(np.ravel(x).tolist(), np.ravel(y).tolist())))
+    transformed = np.array(points, dtype=np.float64)[:, :2]
+    return transformed[:, 0].reshape(np.shape(x)), transformed[:, 1].reshape(np.shape(x))
+
+
+def target_grid(source_grid, source_srs, target_srs, resolution):
+    """
+    Find the grid covering a source grid in the target spatial reference, like gdalwarp with a target resolution
+    :param source_grid: Instance of RasterTools.raster_grid
+    :param source_srs: Spatial reference of the source ("EPSG:<code>" or WKT)
+    :param target_srs: Spatial reference of the target ("EPSG:<code>" or WKT)
+    :param resolution: Cell size of the target grid in target units
+    :return: Instance of RasterTools.raster_grid
+    """
+    transformation = osr.CoordinateTransformation(spatial_reference(source_srs), spatial_reference(target_srs))
+    x_min, cell_x, _, y_max, _, cell_y = source_grid.geotransform
+    x_max = x_min + cell_x * source_grid.cols
+    y_min = y_max + cell_y * source_grid.rows
+
+    along = np.linspace(0.0, 1.0, EDGE_POINTS)
+    edge_x = np.concatenate([x_min + along * (x_max - x_min), x_min + along * (x_max - x_min),
+                             np.full(EDGE_POINTS, x_min), np.full(EDGE_POINTS, x_max)])
+    edge_y = np.concatenate([np.full(EDGE_POINTS, y_min), np.full(EDGE_POINTS, y_max),
+                             y_min + along * (y_max - y_min), y_min + along * (y_max - y_min)])
+    x, y = transform_points(transformation, edge_x, edge_y)
+
+    cols = max(int((x.max() - x.min()) / resolution + 0.5), 1)
+    rows = max(int((y.max() - y.min()) / resolution + 0.5), 1)
+    return RasterTools.raster_grid((x.min(), resolution, 0.0, y.max(), 0.0, -resolution),
+                                   spatial_reference(target_srs).ExportToWkt(), rows, cols)
+
+
+def _lattice_positions(size):
+    # Cell positions where the transformation is computed exactly, always including the last cell
+    return np.unique(np.append(np.arange(0, size, LATTICE_STEP), size - 1))
+
+
+def _interpolate_lattice(values, positions, size, axis):
+    # Linear interpolation of lattice values to all cells along one axis
+    if len(positions) == 1:
+        return np.repeat(values, size, axis=axis)
+    cells = np.arange(size)
+    lower = np.clip(np.searchsorted(positions, cells, side="right") - 1, 0, len(positions) - 2)
+    fraction = (cells - positions[lower]).astype(np.float64) / (positions[lower + 1] - positions[lower])
+    if axis == 0:
+        return values[lower] * (1 - fraction[:, None]) + values[lower + 1] * fraction[:, None]
+    return values[:, lower] * (1 - fraction) + values[:, lower + 1] * fraction
+
+
+def source_coordinates(source_grid, grid):
+    """
+    Find the position of every target cell centre on the source grid
+    :param source_grid: Instance of RasterTools.raster_grid with the source projection
+    :param grid: Target instance of RasterTools.raster_grid
+    :return: Tuple of (column, row) arrays of fractional source pixel coordinates, the shape of the target grid
+    """
+    transformation = osr.CoordinateTransformation(spatial_reference(grid.projection),
+                                                  spatial_reference(source_grid.projection))
+    lattice_rows = _lattice_positions(grid.rows)
+    lattice_cols = _lattice_positions(grid.cols)
+    x = grid.geotransform[0] + (lattice_cols[None, :] + 0.5) * grid.geotransform[1]
+    y = grid.geotransform[3] + (lattice_rows[:, None] + 0.5) * grid.geotransform[5]
+    x, y = transform_points(transformation, np.broadcast_to(x, (len(lattice_rows), len(lattice_cols))),
+                            np.broadcast_to(y, (len(lattice_rows), len(lattice_cols))))
+
+    coordinates = []
+    for values, origin, cell in ((x, source_grid.geotransform[0], source_grid.geotransform[1]),
+                                 (y, source_grid.geotransform[3], source_grid.geotransform[5])):
+        values = _interpolate_lattice(values, lattice_cols, grid.cols, 1)
+        values = _interpolate_lattice(values, lattice_rows, grid.rows, 0)
+        coordinates.append((values - origin) / cell)
+    return coordinates[0], coordinates[1]
+
+
+class warp_plan:
+    """
+    Source to target cell mapping of one (source grid, target grid) pair. Applying the plan to a band is a vectorized
+    gather and weighted sum, so the mapping is computed once for all bands and files on the same source grid.
+    """
+
+    def __init__(self, source_grid, grid, method):
+        """
+        Constructor for warp_plan. Computes the mapping.
+        :param source_grid: Instance of RasterTools.raster_grid of the source rasters
+        :param grid: Instance of RasterTools.raster_grid of the target rasters
+        :param method: Resampling method (see WARP_METHODS)
+        """
+        self.source_grid = source_grid
+        self.grid = grid
+        self.method = method
+        col, row = source_coordinates(source_grid, grid)
+
+        if method == "nearest":
+            corners = [(np.floor(row), np.floor(col), np.ones(col.shape))]
+        elif method == "bilinear":
+            # Pixel centres are at half cell positions
+            row = row - 0.5
+            col = col - 0.5
+            top = np.floor(row)
+            left = np.floor(col)
+            down = row - top
+            right = col - left
+            corners = [(top, left, (1 - down) * (1 - right)),
+                       (top, left + 1, (1 - down) * right),
+                       (top + 1, left, down * (1 - right)),
+                       (top + 1, left + 1, down * right)]
+        else:
+            raise ValueError("Unknown resampling method: " + str(method))
+
+        index_type = np.int32 if source_grid.rows * source_grid.cols < 2 ** 31 else np.int64
+        self.indices = np.zeros((len(corners), grid.rows * grid.cols), dtype=index_type)
+        self.weights = np.zeros((len(corners), grid.rows * grid.cols), dtype=np.float32)
+        for k, (corner_row, corner_col, weight) in enumerate(corners):
+            inside = ((corner_row >= 0) & (corner_row < source_grid.rows) &
+                      (corner_col >= 0) & (corner_col < source_grid.cols)).ravel()
+            flat = corner_row.ravel()[inside].astype(np.int64) * source_grid.cols + \
+                corner_col.ravel()[inside].astype(np.int64)
+            self.indices[k][inside] = flat
+            self.weights[k][inside] = weight.ravel()[inside]
+
+    def apply(self, array):
+        """
+        Warp a band to the target grid. Weights of nodata source cells are left out.
+        :param array: Band on the source grid, NaN for nodata
+        :return: float64 array of the shape of the target grid, NaN for nodata
+        """
+        values = array.ravel()[self.indices]
+        weights = np.where(np.isnan(values), 0.0, self.weights.astype(np.float64))
+        total = weights.sum(axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            warped = (weights * np.nan_to_num(values)).sum(axis=0) / total
+        warped[total == 0] = np.nan
+        return warped.reshape(self.grid.rows, self.grid.cols)
+
+
+def get_plan(source_grid, target_srs, resolution, method):
+    """
+    Find the warp plan of a source grid, computing it only the first time the grid is warped
+    :param source_grid: Instance of RasterTools.raster_grid with the source projection
+    :param target_srs: Spatial reference of the target ("EPSG:<code>" or WKT)
+    :param resolution: Cell size of the target grid in target units
+    :param method: Resampling method (see WARP_METHODS)
+    :return: Instance of warp_plan
+    """
+    key = (source_grid.geotransform, source_grid.projection, source_grid.rows, source_grid.cols, target_srs,
+           float(resolution), method)
+    if key not in _plans:
+        grid = target_grid(source_grid, source_grid.projection, target_srs, resolution)
+        _plans[key] = warp_plan(source_grid, grid, method)
+    return _plans[key]
+
+
+def _read_source(input_path, source_srs):
+    bands, grid = RasterTools.read_bands(input_path)
+    if source_srs is not None:
+        grid.projection = spatial_reference(source_srs).ExportToWkt()
+    elif not grid.projection:
+        raise ValueError("Raster has no projection, give source_srs: " + input_path)
+    return bands, grid
+
+
+def warp_raster(input_path, output_path, target_srs, resolution, method, source_srs=None):
+    """
+    Warp all bands of a raster to the target spatial reference, like gdalogr:warpreproject
+    :param input_path: Path to the input raster
+    :param output_path: Path to the output GeoTIFF (Will be created, multiband if the input is)
+    :param target_srs: Spatial reference of the output ("EPSG:<code>" or WKT)
+    :param resolution: Cell size of the output in target units
+    :param method: Resampling method (see WARP_METHODS)
+    :param source_srs: Spatial reference of the input, None to use the projection of the raster
+    """
+    bands, grid = _read_source(input_path, source_srs)
+    plan = get_plan(grid, target_srs, resolution, method)
+    RasterTools.write_raster(np.array([plan.apply(band) for band in bands]), plan.grid, output_path)
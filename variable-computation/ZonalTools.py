@@ -0,0 +1,175 @@
+import numpy as np
+
+# Statistics in the order and with the names QgsZonalStatistics uses for the attribute columns
+STATISTICS = ["mean", "min", "max", "range", "stdev"]
+
+
+def cell_centres_within(centres_x, centres_y, radius, grid):
+    """
+    Find the cells whose centre lies within radius of each centre point, like the middle point test of
+    QgsZonalStatistics. Cells outside the grid are left out.
+    :param centres_x: X coordinates of the centre points
+    :param centres_y: Y coordinates of the centre points
+    :param radius: Radius of the circles in map units
+    :param grid: Instance of RasterTools.raster_grid
+    :return: Tuple of (point number, row, column, distance) arrays of the cells
+    """
+    x_min, cell_x, y_max, cell_y = grid.geotransform[0], grid.cell_size_x(), grid.geotransform[3], grid.cell_size_y()
+    centres_x = np.asarray(centres_x, dtype=np.float64)
+    centres_y = np.asarray(centres_y, dtype=np.float64)
+
+    # Test the same stencil of cells around the cell of every centre point
+    reach_x = int(np.ceil(radius / cell_x)) + 1
+    reach_y = int(np.ceil(radius / cell_y)) + 1
+    stencil_rows, stencil_cols = np.mgrid[-reach_y:reach_y + 1, -reach_x:reach_x + 1]
+    centre_rows = np.floor((y_max - centres_y) / cell_y).astype(np.int64)
+    centre_cols = np.floor((centres_x - x_min) / cell_x).astype(np.int64)
+    rows = centre_rows[:, None] + stencil_rows.ravel()[None, :]
+    cols = centre_cols[:, None] + stencil_cols.ravel()[None, :]
+    distance = np.hypot(x_min + (cols + 0.5) * cell_x - centres_x[:, None],
+                        y_max - (rows + 0.5) * cell_y - centres_y[:, None])
+
+    inside = (distance <= radius) & (rows >= 0) & (rows < grid.rows) & (cols >= 0) & (cols < grid.cols)
+    points = np.nonzero(inside)[0]
+    return points, rows[inside], cols[inside], distance[inside]
+
+
+class nested_zone_index:
+    """
+    Cells of concentric circular zones on a raster grid. The cells within the largest radius are stored once per zone,
+    sorted by distance from the centre, so every smaller radius is a prefix of the same cell list.
+    """
+
+    def __init__(self, cells, zones, distances, centre_cells, radii, cols):
+        """
+        Constructor for nested_zone_index
+        :param cells: Flat (row * cols + col) indices of the cells within the largest radius
+        :param zones: Zone number of each cell
+        :param distances: Distance of each cell centre from the zone centre
+        :param centre_cells: Flat index of the cell under each zone centre, -1 if outside the grid
+        :param radii: List of radii
+        :param cols: Number of columns in the grid
+        """
+        order = np.lexsort((distances, zones))
+        self.cells = cells[order]
+        self.zones = zones[order]
+        self.centre_cells = centre_cells
+        self.radii = list(radii)
+        self.zone_count = len(centre_cells)
+        self.cols = cols
+
+        # Start of each zone in the cell list, and the end of each radius within the zone
+        self.starts = np.searchsorted(self.zones, np.arange(self.zone_count))
+        self.ends = {}
+        zone_ends = np.searchsorted(self.zones, np.arange(self.zone_count), side="right")
+        distances = distances[order]
+        for radius in self.radii:
+            inside = np.concatenate([[0], np.cumsum(distances <= radius)])
+            self.ends[radius] = self.starts + (inside[zone_ends] - inside[self.starts])
+
+
+def rasterize_nested_circles(centres_x, centres_y, radii, grid):
+    """
+    Rasterize concentric circular plot buffers to a nested_zone_index, visiting the cells of the largest circle once
+    :param centres_x: X coordinates of the plot centres
+    :param centres_y: Y coordinates of the plot centres
+    :param radii: List of buffer radii in map units
+    :param grid: Instance of RasterTools.raster_grid
+    :return: Instance of nested_zone_index
+    """
+    zones, rows, cols, distances = cell_centres_within(centres_x, centres_y, max(radii), grid)
+
+    centre_rows = np.floor((grid.geotransform[3] - np.asarray(centres_y, dtype=np.float64)) /
+                           grid.cell_size_y()).astype(np.int64)
+    centre_cols = np.floor((np.asarray(centres_x, dtype=np.float64) - grid.geotransform[0]) /
+                           grid.cell_size_x()).astype(np.int64)
+    on_grid = (centre_rows >= 0) & (centre_rows < grid.rows) & (centre_cols >= 0) & (centre_cols < grid.cols)
+    centre_cells = np.where(on_grid, centre_rows * grid.cols + centre_cols, -1)
+
+    return nested_zone_index(rows * grid.cols + cols, zones, distances, centre_cells, radii, grid.cols)
+
+
+def gather_cells(sources, cells, cols, strip_rows=256):
+    """
+    Read the values of the given cells from several rasters sharing the same grid. Only the rows and columns
+    containing the cells are read, strip by strip, and each strip is read once per raster.
+    :param sources: Dictionary of name -> block source
+    :param cells: Flat (row * cols + col) indices of the cells, in any order
+    :param cols: Number of columns in the grid
+    :param strip_rows: Number of rows to read at a time
+    :return: Dictionary of name -> array of cell values in the order of cells
+    """
+    values = {}
+    for name in sources:
+        values[name] = np.full(len(cells), np.nan)
+    if len(cells) == 0:
+        return values
+
+    order = np.argsort(cells, kind="mergesort")
+    sorted_cells = cells[order]
+    row_start, row_end = int(sorted_cells[0] // cols), int(sorted_cells[-1] // cols) + 1
+    col_start, col_end = int((cells % cols).min()), int((cells % cols).max()) + 1
+    for strip_start in range(row_start, row_end, strip_rows):
+        strip_end = min(strip_start + strip_rows, row_end)
+        start, end = np.searchsorted(sorted_cells, [strip_start * cols, strip_end * cols])
+        if start == end:
+            continue
+        strip_cells = sorted_cells[start:end]
+        positions = (strip_cells // cols - strip_start) * (col_end - col_start) + strip_cells % cols - col_start
+        for name in sources:
+            block = sources[name].read_block(strip_start, col_start, strip_end - strip_start, col_end - col_start)
+            values[name][order[start:end]] = block.ravel()[positions]
+    return values
+
+
+def nested_statistics(values, centre_values, zones):
+    """
+    Compute the zonal statistics of every radius from one list of cell values sorted by distance. Sums and sums of
+    squares are taken from cumulative sums over the list, and minimum and maximum from reductions over the prefix of
+    each zone. Zones whose circle does not contain any cell centre get the value of the cell under the centre.
+    :param values: Cell values in the order of zones.cells, NaN for nodata
+    :param centre_values: Value of the cell under each zone centre, NaN for nodata or outside the grid
+    :param zones: Instance of nested_zone_index
+    :return: Dictionary of radius -> dictionary of statistic name (see STATISTICS) -> array of values per zone
+    """
+    valid = ~np.isnan(values)
+
+    # Moments are computed around the first valid value of each zone to keep the sums of squares accurate
+    first_valid = np.full(zones.zone_count, len(values))
+    np.minimum.at(first_valid, zones.zones[valid], np.nonzero(valid)[0])
+    reference = np.where(first_valid < len(values), np.append(values, np.nan)[first_valid], 0.0)
+    shifted = np.where(valid, values - reference[zones.zones], 0.0)
+
+    cumulative_count = np.concatenate([[0], np.cumsum(valid)])
+    cumulative_sum = np.concatenate([[0.0], np.cumsum(shifted)])
+    cumulative_squares = np.concatenate([[0.0], np.cumsum(shifted * shifted)])
+    padded_values = np.append(values, np.nan)
+
+    results = {}
+    for radius in zones.radii:
+        starts = zones.starts
+        ends = zones.ends[radius]
+        count = (cumulative_count[ends] - cumulative_count[starts]).astype(np.float64)
+        total = cumulative_sum[ends] - cumulative_sum[starts]
+        squares = cumulative_squares[ends] - cumulative_squares[starts]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = total / count
+            stdev = np.sqrt(np.maximum(squares / count - mean * mean, 0.0))
+        mean = mean + reference
+
+        # reduceat reduces over [starts[i], ends[i]) when the range is not empty
+        bounds = np.column_stack([starts, ends]).ravel()
+        minimum = np.fmin.reduceat(padded_values, bounds)[::2]
+        maximum = np.fmax.reduceat(padded_values, bounds)[::2]
+
+        statistics = {"mean": mean, "min": minimum, "max": maximum, "range": maximum - minimum, "stdev": stdev}
+        for name in statistics:
+            statistics[name][count == 0] = np.nan
+
+        no_cells = ends == starts
+        for name in ["mean", "min", "max"]:
+            statistics[name][no_cells] = centre_values[no_cells]
+        for name in ["range", "stdev"]:
+            statistics[name][no_cells] = np.where(np.isnan(centre_values[no_cells]), np.nan, 0.0)
+        results[radius] = statistics
+    return results
@@ -1,5 +1,13 @@
 # Import packages
 import os, subprocess, glob, logging, csv
+import numpy as np
+import ClipTools
+import FeatureTools
+import GroundTools
+import JobTools
+import LasTools
+import MetricsTools
+import TraceTools
 
 
 class cloudmetrics_file:
@@ -16,24 +24,27 @@ class cloudmetrics_file:
         self.above = above
 
 
-class study_plot:
+class study_plot(object):
     """
     Class to represent study plot
     """
+    __slots__ = ("cluster", "plot", "long_x", "lat_y", "plot_paths", "path", "clip_data_call")
 
     def __init__(self, cluster, plot, long_x, lat_y):
         """
         Constructor for study plot
         :param cluster: number of the cluster
         :param plot: number of the plot
-        :param long_x: longitude of plot
-        :param lat_y: latitude of plot
+        :param long_x: longitude of plot, float
+        :param lat_y: latitude of plot, float
         """
         self.cluster = cluster
         self.plot = plot
         self.long_x = long_x
         self.lat_y = lat_y
         self.plot_paths = {}
+        self.path = None
+        self.clip_data_call = None
 
     def add_plot_path(self, radius, path):
         """
@@ -67,6 +78,35 @@ class study_cluster:
         self.plots.append(plot)
 
 
+class plot_registry(object):
+    """
+    All study plots in one list ordered by cluster, with the coordinates in float64 arrays of the same order for
+    vectorized lookups
+    """
+    __slots__ = ("plots", "x", "y")
+
+    def __init__(self, clusters):
+        """
+        Constructor for plot_registry
+        :param clusters: Dictionary of cluster number -> study_cluster
+        """
+        self.plots = [plot for cluster in sorted(clusters) for plot in clusters[cluster].plots]
+        self.x = np.array([plot.long_x for plot in self.plots], dtype=np.float64)
+        self.y = np.array([plot.lat_y for plot in self.plots], dtype=np.float64)
+
+    def __len__(self):
+        return len(self.plots)
+
+    def bounding_box(self, number, plot_width):
+        """
+        :param number: Position of the plot in the registry
+        :param plot_width: Plot width used for calculating the bounding box
+        :return: Tuple of (x min, y min, x max, y max)
+        """
+        return (self.x[number] - plot_width, self.y[number] - plot_width, self.x[number] + plot_width,
+                self.y[number] + plot_width)
+
+
 class study_area:
     """
     Class to represent study_area. Study area is made from clusters.
@@ -79,6 +119,7 @@ class study_area:
         """
         self.study_area_name = study_area_name
         self.clusters = []
+        self.registry = plot_registry({})
         self.cloudmetric_files = {}
 
     def add_clusters(self, clusters):
@@ -87,6 +128,7 @@ class study_area:
         :param clusters: List of Clusters.
         """
         self.clusters = clusters
+        self.registry = plot_registry(clusters)
 
     def add_cloudmetrics_file(self, radius, path):
         """
@@ -116,7 +158,7 @@ def create_fusion_dem(fusion_folder, output_path, list_of_input_files, resolutio
     """
     method_call = fusion_folder + "gridsurfacecreate.exe /class:" + classes_to_use + " " + output_path + " " + \
                   resolution + " M M 1 " + utm_zone + " 0 0 " + list_of_input_files
-    subprocess.call(method_call)
+    execute_subprocess(method_call)
 
     if os.path.isfile(output_path):
         logging.info("Fusion (plans) DTM Created succesfully: " + output_path)
@@ -126,44 +168,187 @@ def create_fusion_dem(fusion_folder, output_path, list_of_input_files, resolutio
 
 def execute_subprocess(method_call):
     """
-    Method for calling the subprocess (call command line tools)
+    Method for calling the subprocess (call command line tools). Every call is traced under the executable name.
     :param method_call: Method call as String
     """
-    subprocess.call(method_call)
+    executable = os.path.basename(method_call.split(" ")[0])
+    with TraceTools.span(executable, "subprocess", command=method_call):
+        process = subprocess.Popen(method_call)
+        TraceTools.watch_process(process.pid)
+        process.wait()
 
 
-def create_clipdata_call(fusion_folder, classes, dtm_path, las_files, output_path, studyarea, plot_length):
-    for cluster in studyarea.clusters:
-        for plot in studyarea.clusters[cluster].plots:
-            clipped_file_path = os.path.join(output_path, plot.cluster + "." + plot.plot + ".las")
-            call = fusion_folder + "clipdata.exe /height /shape:1 /class:" + classes + " /dtm:" + dtm_path + \
-                   " " + las_files + " " + clipped_file_path + " " + make_bounding_box(plot, plot_length)
-            plot.clip_data_call = call
-            plot.add_plot_path(plot_length, clipped_file_path)
+def create_clipdata_call(fusion_folder, classes, dtm_path, catalog, output_path, studyarea, plot_length,
+                         executor):
+    """
+    Run clipdata.exe for all plots of one radius. Every call reads only the tiles the plot overlaps: one tile is
+    passed directly, several in a list file of the plot.
+    :param fusion_folder: Path to the folder containing Fusion executables
+    :param classes: Las classes, comma separated string
+    :param dtm_path: Path to the FUSION DTM
+    :param catalog: Instance of LasTools.tile_catalog of the input .las files
+    :param output_path: Folder of the radius
+    :param studyarea: Instance of study_area
+    :param plot_length: Plot radius
+    :param executor: Instance of JobTools.job_executor
+    """
+    jobs = []
+    list_folder = os.path.join(output_path, "tiles")
+    for number, plot in enumerate(studyarea.registry.plots):
+        name = plot.cluster + "." + plot.plot
+        clipped_file_path = os.path.join(output_path, name + ".las")
+        plot.add_plot_path(plot_length, clipped_file_path)
+        plot.path = clipped_file_path
+        bounds = studyarea.registry.bounding_box(number, plot_length)
+        tiles = catalog.intersecting(*bounds)
+        if not tiles:
+            print(name + " does not overlap any las file")
+            continue
+        if len(tiles) == 1:
+            las_files = tiles[0]
+        else:
+            if not os.path.exists(list_folder):
+                os.makedirs(list_folder)
+            las_files = os.path.join(list_folder, name + ".txt")
+            write_to_file(las_files, tiles)
+        call = fusion_folder + "clipdata.exe /height /shape:1 /class:" + classes + " /dtm:" + dtm_path + \
+            " " + las_files + " " + clipped_file_path + " " + make_bounding_box(bounds)
+        plot.clip_data_call = call
+        jobs.append(JobTools.command_job(name, call, clipped_file_path))
+    executor.run(jobs)
+
+
+def convert_fusion_dtm(fusion_folder, dtm_path):
+    """
+    Convert a FUSION DTM to an ESRI ASCII grid with DTM2ASCII.exe, once
+    :param fusion_folder: Path to the folder containing Fusion executables
+    :param dtm_path: Path to the FUSION .dtm file
+    :return: Path to the ASCII grid
+    """
+    ascii_path = os.path.splitext(dtm_path)[0] + ".asc"
+    if not os.path.exists(ascii_path):
+        execute_subprocess(fusion_folder + "DTM2ASCII.exe " + dtm_path + " " + ascii_path)
+    return ascii_path
+
+
+def create_native_clips(classes, ground, catalog, output_path, studyarea, radii):
+    """
+    Clip the study plots of all radii with one pass over the LAS files, writing the same files as
+    create_clipdata_call: heights above the DTM, circles of each radius, only the given classes
+    :param classes: Las classes, comma separated string
+    :param ground: Function without arguments returning the GroundTools.ground_model, called only if a plot is
+    missing
+    :param catalog: Instance of LasTools.tile_catalog of the input .las files
+    :param output_path: Folder with a sub folder for every radius
+    :param studyarea: Instance of study_area
+    :param radii: List of plot radii
+    """
+    registry = studyarea.registry
+    paths = {}
+    for number, plot in enumerate(registry.plots):
+        for radius in radii:
+            clipped_file_path = os.path.join(output_path, str(radius), plot.cluster + "." + plot.plot + ".las")
+            plot.add_plot_path(radius, clipped_file_path)
             plot.path = clipped_file_path
             if not os.path.exists(clipped_file_path):
-                execute_subprocess(call)
+                paths[(number, radius)] = clipped_file_path
+    if not paths:
+        return
 
+    clip = ClipTools.clip_plots([LasTools.las_file(path) for path in catalog.near(registry.x, registry.y, max(radii))],
+                                registry.x, registry.y, radii, LasTools.parse_classes(classes))
+    clip.write(paths, ground())
 
-def create_cloudmetrics(fusion_folder, above, plot_path, output_path):
-    call = fusion_folder + "cloudmetrics.exe" + " /id /above:" + str(above) + " " + plot_path + " " + output_path
-    if os.path.exists(plot_path):
-        execute_subprocess(call)
-    else:
-        print(plot_path + " plot not found")
 
-def make_bounding_box(plot, plot_width):
+def create_cloudmetrics_parallel(fusion_folder, above, studyarea, radius, output_path, executor):
     """
-    Generate a bounding box string out of the Plot instance.
-    :param plot: Instance of study plot
-    :param plot_width: Plot width used for calculating the bounding box
+    Run cloudmetrics.exe for all plots of one radius in parallel. Every plot writes its own shard, and the shards are
+    merged to the output file in plot order, so the result does not depend on the order the jobs finish in.
+    :param fusion_folder: Path to the folder containing Fusion executables
+    :param above: Height break
+    :param studyarea: Instance of study_area
+    :param radius: Plot radius
+    :param output_path: Path to the merged cloudmetrics file
+    :param executor: Instance of JobTools.job_executor
+    """
+    jobs = []
+    for plot in studyarea.registry.plots:
+        plot_path = plot.plot_paths[radius]
+        if not os.path.exists(plot_path):
+            print(plot_path + " plot not found")
+            continue
+        name = plot.cluster + "." + plot.plot
+        shard_path = JobTools.shard_path(output_path, name)
+        call = fusion_folder + "cloudmetrics.exe" + " /id /above:" + str(above) + " " + plot_path + " " + shard_path
+        jobs.append(JobTools.command_job(name, call, shard_path))
+    shard_folder = os.path.dirname(JobTools.shard_path(output_path, "shard"))
+    if not os.path.exists(shard_folder):
+        os.makedirs(shard_folder)
+    executor.run(jobs)
+    JobTools.merge_shards([job.output_path for job in sorted(jobs, key=lambda job: job.name)], output_path)
+
+
+def create_native_cloudmetrics(above_values, output_path, studyarea, radius):
+    """
+    Compute the cloudmetrics of all plots of one radius for all above values, reading each plot file once. Writes
+    the same <above>h_cloudmetrics_result.csv files as cloudmetrics.exe.
+    :param above_values: List of height breaks
+    :param output_path: Folder of the radius
+    :param studyarea: Instance of study_area
+    :param radius: Plot radius
+    """
+    plot_paths = []
+    for plot in studyarea.registry.plots:
+        if os.path.exists(plot.plot_paths[radius]):
+            plot_paths.append(plot.plot_paths[radius])
+        else:
+            print(plot.plot_paths[radius] + " plot not found")
+    output_paths = dict((above, os.path.join(output_path, str(above) + "h_cloudmetrics_result.csv"))
+                        for above in above_values)
+    MetricsTools.compute_cloudmetrics_files(plot_paths, above_values, output_paths)
+
+
+def create_streamed_cloudmetrics(classes, ground, catalog, output_path, studyarea, radii, above_values):
+    """
+    Compute the cloudmetrics of all plots, radii and above values straight from chunks of the LAS/LAZ files, without
+    writing plot files. Memory use does not depend on the size of the files. Writes the same
+    <above>h_cloudmetrics_result.csv files as create_native_cloudmetrics, the DataFile column names the plot file
+    create_native_clips would have written. Plots without points are left out, like missing plot files.
+    :param classes: Las classes, comma separated string
+    :param ground: Function without arguments returning the GroundTools.ground_model
+    :param catalog: Instance of LasTools.tile_catalog of the input .las/.laz files
+    :param output_path: Folder with a sub folder for every radius
+    :param studyarea: Instance of study_area
+    :param radii: List of plot radii
+    :param above_values: List of height breaks
+    """
+    output_paths = dict(((radius, above), os.path.join(output_path, str(radius), str(above) +
+                                                       "h_cloudmetrics_result.csv"))
+                        for radius in radii for above in above_values)
+    if all(os.path.exists(path) for path in output_paths.values()):
+        return
+
+    registry = studyarea.registry
+    plots = registry.plots
+    metrics = MetricsTools.stream_plot_metrics(catalog.near(registry.x, registry.y, max(radii)), registry.x,
+                                               registry.y, radii, above_values, LasTools.parse_classes(classes),
+                                               ground())
+    for radius in radii:
+        found = [number for number, count in enumerate(metrics[radius]["Total return count"]) if count > 0]
+        plot_paths = [os.path.join(output_path, str(radius), plots[number].cluster + "." + plots[number].plot + ".las")
+                      for number in found]
+        radius_metrics = dict((name, values[found]) for name, values in metrics[radius].items())
+        for above in above_values:
+            MetricsTools.write_cloudmetrics_csv(output_paths[(radius, above)], plot_paths, radius_metrics, above)
+
+
+def make_bounding_box(bounds):
+    """
+    Generate a bounding box string for the command line of clipdata.exe.
+    :param bounds: Tuple of (x min, y min, x max, y max), see plot_registry.bounding_box
     :return: Generated bounding box as string
     """
-    x1 = str(float(plot.long_x) - plot_width)
-    x2 = str(float(plot.long_x) + plot_width)
-    y1 = str(float(plot.lat_y) - plot_width)
-    y2 = str(float(plot.lat_y) + plot_width)
-    return x1 + " " + y1 + " " + x2 + " " + y2
+    return " ".join(str(value) for value in bounds)
 
 
 def list_files_in_directory(folder_path, file_extension):
@@ -211,8 +396,9 @@ def read_plots_from_csv(path):
         for row in csv_reader:
             cluster = row[0]
             plot = row[1]
-            long_x = row[2]
-            long_y = row[3]
+            # Coordinates are parsed once here, everything else uses the floats
+            long_x = float(row[2])
+            long_y = float(row[3])
 
             # Create a cluster instance if it no already exists - otherwise add the study plot there
             if cluster not in clusters:
@@ -242,6 +428,37 @@ def write_helper_file(output_path, sarea):
             for cm_file2 in sarea.cloudmetric_files[cm_file]:
                 csvwriter.writerow([str(cm_file)] + [str(cm_file2.above)] + [cm_file2.path])
 
+def write_metrics_store(output_path, sarea):
+    """
+    Collect the cloudmetrics files of all radiuses and above values to one columnar table keyed by Cluster, Plot,
+    Radius and Above, so that the feature matrix of a radius is read with FeatureTools.metrics_table.wide_matrix
+    instead of parsing and merging the CSV files again
+    :param output_path: Directory of the table (Will be created)
+    :param sarea: Instance of study area object
+    :return: Instance of FeatureTools.metrics_table
+    """
+    plots = dict((plot.cluster + "." + plot.plot, plot) for plot in sarea.registry.plots)
+    keys = dict((key, []) for key in FeatureTools.METRIC_KEYS)
+    parts = []
+    for radius in sorted(sarea.cloudmetric_files):
+        for cm_file in sarea.cloudmetric_files[radius]:
+            if not os.path.exists(cm_file.path):
+                continue
+            names, columns = MetricsTools.read_cloudmetrics_csv(cm_file.path, cm_file.above)
+            found = [number for number, name in enumerate(names) if name in plots]
+            keys["Cluster"] += [plots[names[number]].cluster for number in found]
+            keys["Plot"] += [plots[names[number]].plot for number in found]
+            keys["Radius"] += [float(radius)] * len(found)
+            keys["Above"] += [float(cm_file.above)] * len(found)
+            parts.append(dict((name, values[found]) for name, values in columns.items()))
+
+    names = [name for name in MetricsTools.metric_columns(MetricsTools.BREAK_LABEL)[3:]
+             if all(name in part for part in parts)]
+    columns = [(name, np.concatenate([part[name] for part in parts]) if parts else np.zeros(0)) for name in names]
+    break_columns = [name for name in MetricsTools.above_columns(MetricsTools.BREAK_LABEL) if name in names]
+    return FeatureTools.write_metrics_table(output_path, keys, columns, break_columns, MetricsTools.BREAK_LABEL)
+
+
 def main():
     #################################################################################################
     # Input Variables & Settings
@@ -252,8 +469,15 @@ def main():
     fusion_folder = "F:/FUSION/"  # Path to directory containing FUSION executables'
     radius_to_process = [17.84, 25.23, 35.68, 50.46, 71.37]  # Radiuses to used for clipping (in meters)
     classes_to_select = "2,3,5"  # What Lidar Class files to select from las files
+    dtm_method = "native"  # native: grid the ground points in Python, fusion: gridsurfacecreate.exe
+    clip_method = "native"  # native: one pass over the las files for all plots and radiuses, fusion: clipdata.exe
+    metrics_method = "native"  # native: all above values from one read of each plot, fusion: cloudmetrics.exe
+    streaming = False  # True: metrics straight from chunks of the .las/.laz files, no plot files (needs native dtm)
     plot_csv_path = "F:/Gradu/FinalCalculations/AllPlots_Fixed.csv"
     above_values = [0, 2, 4]
+    fusion_workers = 8  # Number of FUSION executables run at the same time
+    fusion_retries = 2  # Number of times a failed FUSION call is run again
+    fusion_timeout = 3600  # Maximum run time of one FUSION call in seconds
 
     # Setup logging to output to stdout and file
     logFormatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
@@ -276,6 +500,8 @@ def main():
     logging.info("  Fusion Folder: " + fusion_folder)
     logging.info("  Input Las Files: ")
     las_files = list_files_in_directory(las_data_dir, ".las")
+    if streaming:
+        las_files += list_files_in_directory(las_data_dir, ".laz")
     for las_file in las_files:
         logging.info("      " + las_file)
     logging.info("********************")
@@ -283,27 +509,50 @@ def main():
     # Write list of files to directory
     las_file_list_path = os.path.join(las_data_dir, "las_list.txt")
     write_to_file(las_file_list_path, las_files)
+    catalog = LasTools.load_or_build_catalog(las_files, os.path.join(las_data_dir, LasTools.CATALOG_FILE))
 
-    # Create DTM only if it does not exist
+    # Create DTM only if it does not exist. clipdata.exe needs the FUSION DTM.
     dem_path = os.path.join(output_folder, "Sentinel_1m.dtm")
-    if not os.path.exists(dem_path):
-        create_fusion_dem(fusion_folder, dem_path, las_file_list_path, "1", "37S", "2")
-    else:
-        print "DEM EXITS"
+    ground_path = os.path.join(output_folder, "Sentinel_1m_ground.npy")
+    if dtm_method == "native":
+        if not GroundTools.ground_model_exists(ground_path):
+            with TraceTools.span("create_ground_model", "dtm"):
+                GroundTools.create_ground_model(las_files, ground_path, 1.0, [2])
+    if dtm_method != "native" or (clip_method != "native" and not streaming):
+        if not os.path.exists(dem_path):
+            create_fusion_dem(fusion_folder, dem_path, las_file_list_path, "1", "37S", "2")
+        else:
+            print "DEM EXITS"
+
+    def load_ground():
+        # The DTM stays memory-mapped for the height normalization of all plots
+        if dtm_method == "native":
+            return GroundTools.load_ground_model(ground_path)
+        return GroundTools.read_ascii_grid(convert_fusion_dtm(fusion_folder, dem_path))
 
     logging.info("********************")
 
+    executor = JobTools.job_executor(fusion_workers, fusion_retries, fusion_timeout)
     sarea = study_area("Sentinel")
     sarea.add_clusters(read_plots_from_csv(plot_csv_path))
 
     # Clip the study plots
     for radius in radius_to_process:
-        logging.info("Clipping data with " + str(radius) + " m radius")
         radius_directory = os.path.join(output_folder, str(radius))
         if not os.path.exists(radius_directory):
             os.mkdir(radius_directory)
-        create_clipdata_call(fusion_folder, classes_to_select, dem_path, las_file_list_path,
-                             os.path.join(output_folder, str(radius)), sarea, radius)
+    if streaming:
+        logging.info("Streaming the las files, no plots are clipped")
+    elif clip_method == "native":
+        logging.info("Clipping data with all radiuses in one pass")
+        with TraceTools.span("clip_plots_native", "radius"):
+            create_native_clips(classes_to_select, load_ground, catalog, output_folder, sarea, radius_to_process)
+    else:
+        for radius in radius_to_process:
+            logging.info("Clipping data with " + str(radius) + " m radius")
+            with TraceTools.span("clip_plots", "radius", resolution=str(radius)):
+                create_clipdata_call(fusion_folder, classes_to_select, dem_path, catalog,
+                                     os.path.join(output_folder, str(radius)), sarea, radius, executor)
 
 
 
@@ -314,12 +563,27 @@ def main():
             output_path = os.path.join(radius_directory,
                                        str(above_value) + "h_cloudmetrics_result.csv")
             sarea.add_cloudmetrics_file(radius, cloudmetrics_file(output_path, above_value, above_value))
-            for cluster in sarea.clusters:
-                for plot in sarea.clusters[cluster].plots:
-                    create_cloudmetrics(fusion_folder, above_value, plot.plot_paths[radius], output_path)
+            if metrics_method == "native" or streaming:
+                continue
+            with TraceTools.span("cloudmetrics", "radius", resolution=str(radius), above=above_value):
+                create_cloudmetrics_parallel(fusion_folder, above_value, sarea, radius, output_path, executor)
+    if streaming:
+        with TraceTools.span("cloudmetrics_streamed", "radius"):
+            create_streamed_cloudmetrics(classes_to_select, load_ground, catalog, output_folder, sarea,
+                                         radius_to_process, above_values)
+    elif metrics_method == "native":
+        for radius in radius_to_process:
+            with TraceTools.span("cloudmetrics_native", "radius", resolution=str(radius)):
+                create_native_cloudmetrics(above_values, os.path.join(output_folder, str(radius)), sarea, radius)
 
     # Write a CSV file that can be read by other scripts
     write_helper_file(os.path.join(output_folder, "CloudMetricFiles.csv"), sarea)
+    with TraceTools.span("write_metrics_store", "metrics"):
+        write_metrics_store(os.path.join(output_folder, "CloudMetrics"), sarea)
+
+    # Trace of every FUSION call, open in chrome://tracing or Perfetto
+    TraceTools.recorder.write_chrome_trace(os.path.join(output_folder, "trace.json"))
+    TraceTools.recorder.print_summary()
 
     # Return the instance of Study Area, in case some other process wants to use it.
     return sarea
@@ -0,0 +1,289 @@
+"""
+Benchmark of the raster predictor pipeline on synthetic data. Runs offline, without QGIS or GDAL.
+
+    python benchmark-raster-pipeline.py --extent 5000 --resolutions 5,10,25,50,100 --output benchmark-results.jsonl
+
+Every stage is timed on synthetic DEMs of the given extent and resolutions and a synthetic plot list with the real
+buffer radii. The results are appended as JSON lines to the output file and compared to the latest results of another
+version (git commit) in the same file, so regressions between versions are visible.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import BlockTools
+import FlowTools
+import FocalTools
+import SolarTools
+import StackTools
+import TerrainTools
+import ZonalTools
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+PLOT_BUFFERS = [17.84, 25.23, 35.68, 50.46, 71.37]
+TPI_RADII = [50, 100, 250, 500]
+STAGES = ["terrain", "terrain_tiled", "flow_d8", "flow_mfd", "tpi", "horizons", "solar", "zonal", "soil_combine"]
+# Depths of the synthetic soil layers, like the SoilGrids content layers combined by download-african-soil-grids.py
+SOIL_DEPTHS = [(0.0, 0.0), (0.05, 0.05), (0.15, 0.15), (0.30, 0.30), (0.60, 0.60)]
+
+
+def synthetic_dem(rows, cols, cell_size, seed=0):
+    """
+    Generate a fractal DEM by spectral synthesis, with realistic relief (about 300 m) and a few nodata holes
+    :param rows: Number of rows
+    :param cols: Number of columns
+    :param cell_size: Cell size in metres
+    :param seed: Seed of the random generator
+    :return: float64 array, NaN for nodata
+    """
+    random = np.random.RandomState(seed)
+    frequency_rows = np.fft.fftfreq(rows, cell_size)[:, None]
+    frequency_cols = np.fft.rfftfreq(cols, cell_size)[None, :]
+    frequency = np.hypot(frequency_rows, frequency_cols)
+    frequency[0, 0] = 1.0
+    amplitude = frequency ** -1.6
+    amplitude[0, 0] = 0.0
+    phase = random.uniform(0, 2 * math.pi, amplitude.shape)
+    dem = np.fft.irfft2(amplitude * np.exp(1j * phase), s=(rows, cols))
+    dem = 1200.0 + 300.0 * (dem - dem.min()) / max(dem.max() - dem.min(), 1e-12)
+
+    for _ in range(3):
+        row, col = random.randint(0, rows), random.randint(0, cols)
+        dem[row:row + max(rows // 50, 1), col:col + max(cols // 50, 1)] = np.nan
+    return dem
+
+
+def synthetic_plots(count, extent, seed=0):
+    """
+    Generate plot centres in clusters, like the field plots
+    :param count: Number of plots
+    :param extent: Side of the study area in metres
+    :param seed: Seed of the random generator
+    :return: Tuple of (x, y) arrays
+    """
+    random = np.random.RandomState(seed + 1)
+    clusters = random.uniform(0.1 * extent, 0.9 * extent, (max(count // 10, 1), 2))
+    members = clusters[np.arange(count) % len(clusters)] + random.normal(0, 0.02 * extent, (count, 2))
+    return np.clip(members[:, 0], 0, extent), np.clip(members[:, 1], 0, extent)
+
+
+def measure_time(function):
+    """
+    :param function: Function without arguments
+    :return: Wall time of one call in seconds
+    """
+    start = time.time()
+    function()
+    return time.time() - start
+
+
+def measure_memory(function):
+    """
+    Measure the peak memory of a call. The peak is traced per call with tracemalloc when available, otherwise the
+    peak resident set size of the whole process is reported. Tracing slows Python code down, so the call is not timed.
+    :param function: Function without arguments
+    :return: Peak memory in bytes
+    """
+    if tracemalloc is None:
+        function()
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def stage_functions(dem, cell_size, plots_x, plots_y, tile_size, horizon_sectors, horizon_distance):
+    """
+    Construct the benchmarked stages for one DEM
+    :return: Dictionary of stage name -> function without arguments
+    """
+    grid = BlockTools.raster_grid((0.0, cell_size, 0.0, dem.shape[0] * cell_size, 0.0, -cell_size), "",
+                                  dem.shape[0], dem.shape[1])
+    derivatives = TerrainTools.compute_terrain_derivatives(dem, cell_size, cell_size)
+    state = {}
+
+    def terrain_tiled():
+        outputs = dict((name, np.empty(dem.shape)) for name in TerrainTools.TERRAIN_DERIVATIVES)
+        sinks = dict((name, BlockTools.array_sink(outputs[name])) for name in outputs)
+        BlockTools.process_in_blocks(BlockTools.array_source(dem), sinks,
+                                     lambda padded: TerrainTools.derivatives_from_padded(padded, cell_size, cell_size),
+                                     TerrainTools.TERRAIN_HALO, tile_size)
+
+    def tpi():
+        radii = sorted(set([1] + [FocalTools.radius_in_cells(radius, cell_size) for radius in TPI_RADII]))
+        FocalTools.compute_focal_statistics(dem, radii, [1])
+
+    def horizons():
+        state["horizons"] = SolarTools.compute_horizon_angles(dem, cell_size, horizon_sectors, horizon_distance)
+
+    def solar():
+        if "horizons" not in state:
+            horizons()
+        SolarTools.compute_daily_radiation(dem, derivatives["slope"], derivatives["aspect"], state["horizons"], 180,
+                                           -3.4)
+
+    def zonal():
+        zones = ZonalTools.rasterize_nested_circles(plots_x, plots_y, PLOT_BUFFERS, grid)
+        sources = {"DTM": BlockTools.array_source(dem)}
+        for name in TerrainTools.TERRAIN_DERIVATIVES:
+            sources[name] = BlockTools.array_source(derivatives[name])
+        on_grid = zones.centre_cells >= 0
+        values = ZonalTools.gather_cells(sources, np.concatenate([zones.cells, zones.centre_cells[on_grid]]),
+                                         grid.cols)
+        for name in sources:
+            centre_values = np.full(zones.zone_count, np.nan)
+            centre_values[on_grid] = values[name][len(zones.cells):]
+            ZonalTools.nested_statistics(values[name][:len(zones.cells)], centre_values, zones)
+
+    def soil_combine():
+        # Layers derived from the DEM, every other one shifted by a cell like coverages of slightly different extent
+        sources = []
+        for number in range(len(SOIL_DEPTHS)):
+            shift = number % 2
+            layer = dem[shift:, shift:] * (1.0 + 0.1 * number)
+            layer_grid = BlockTools.raster_grid((shift * cell_size, cell_size, 0.0, grid.geotransform[3] - shift *
+                                                 cell_size, 0.0, -cell_size), "", layer.shape[0], layer.shape[1])
+            sources.append(StackTools.aligned_source(BlockTools.array_source(layer), layer_grid, grid))
+        weights = StackTools.depth_weights(SOIL_DEPTHS)
+        methods = ["nanmean", "weighted_mean", "min", "max", "std"]
+        outputs = dict((method, np.empty(dem.shape)) for method in methods)
+        tasks = [lambda method=method: StackTools.reduce_blocks(
+            sources, {method: BlockTools.array_sink(outputs[method])}, weights, tile_size) for method in methods]
+        StackTools.run_parallel(tasks, len(tasks))
+
+    return {"terrain": lambda: TerrainTools.compute_terrain_derivatives(dem, cell_size, cell_size),
+            "terrain_tiled": terrain_tiled,
+            "flow_d8": lambda: FlowTools.compute_catchment_area(dem, cell_size, "D8"),
+            "flow_mfd": lambda: FlowTools.compute_catchment_area(dem, cell_size, "MFD"),
+            "tpi": tpi,
+            "horizons": horizons,
+            "solar": solar,
+            "zonal": zonal,
+            "soil_combine": soil_combine}
+
+
+def current_version():
+    """
+    :return: Git commit of the working tree (with -dirty when modified), or "unknown" outside of a git repository
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=directory).decode().strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=directory)
+        return commit + ("-dirty" if dirty.strip() else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def read_results(path):
+    """
+    :param path: Path to the JSON lines results file
+    :return: List of result dictionaries, oldest first
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare_to_previous(results, previous_results, threshold):
+    """
+    Print the change of every result compared to the latest result of another version with the same stage and size
+    :param results: Results of this run
+    :param previous_results: Results read from the results file before this run
+    :param threshold: Slowdown ratio reported as a regression
+    :return: Number of regressions
+    """
+    latest = {}
+    for result in previous_results:
+        if result["version"] != results[0]["version"]:
+            latest[(result["stage"], result["resolution"], result["cells"])] = result
+
+    regressions = 0
+    for result in results:
+        previous = latest.get((result["stage"], result["resolution"], result["cells"]))
+        if previous is None:
+            continue
+        ratio = result["seconds"] / max(previous["seconds"], 1e-9)
+        status = "REGRESSION" if ratio > threshold else "ok"
+        if ratio > threshold:
+            regressions += 1
+        print("{0:<14} {1:>5} m  {2:8.3f} s -> {3:8.3f} s  x{4:5.2f}  vs {5}  {6}".format(
+            result["stage"], result["resolution"], previous["seconds"], result["seconds"], ratio, previous["version"],
+            status))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the raster predictor pipeline on synthetic data")
+    parser.add_argument("--extent", type=float, default=5000.0, help="Side of the synthetic study area in metres")
+    parser.add_argument("--resolutions", default="5,10,25,50,100", help="Comma separated DEM resolutions in metres")
+    parser.add_argument("--plots", type=int, default=500, help="Number of synthetic plots")
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma separated stages to run")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs of each stage, the fastest one is reported")
+    parser.add_argument("--tile-size", type=int, default=512, help="Tile size of the tiled stages in cells")
+    parser.add_argument("--horizon-sectors", type=int, default=16, help="Azimuth sectors of the horizon angles")
+    parser.add_argument("--horizon-distance", type=float, default=1000.0, help="Horizon search distance in metres")
+    parser.add_argument("--output", default="benchmark-results.jsonl", help="JSON lines file for the results")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Slowdown ratio reported as a regression")
+    arguments = parser.parse_args()
+
+    stages = arguments.stages.split(",")
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error("Unknown stage: " + stage)
+
+    version = current_version()
+    previous_results = read_results(arguments.output)
+    plots_x, plots_y = synthetic_plots(arguments.plots, arguments.extent)
+    results = []
+    for resolution in [float(value) for value in arguments.resolutions.split(",")]:
+        cells_per_side = int(arguments.extent / resolution)
+        dem = synthetic_dem(cells_per_side, cells_per_side, resolution)
+        functions = stage_functions(dem, resolution, plots_x, plots_y, arguments.tile_size,
+                                    arguments.horizon_sectors, arguments.horizon_distance)
+        for stage in stages:
+            seconds = min(measure_time(functions[stage]) for _ in range(arguments.repeat))
+            peak_memory = measure_memory(functions[stage])
+            result = {"version": version,
+                      "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                      "python": platform.python_version(),
+                      "numpy": np.__version__,
+                      "stage": stage,
+                      "resolution": resolution,
+                      "cells": dem.size,
+                      "plots": arguments.plots,
+                      "seconds": seconds,
+                      "cells_per_second": dem.size / max(seconds, 1e-9),
+                      "peak_memory": peak_memory,
+                      "memory_method": "tracemalloc" if tracemalloc is not None else "ru_maxrss"}
+            results.append(result)
+            print("{0:<14} {1:>5} m  {2:>10} cells  {3:8.3f} s  {4:12.0f} cells/s  {5:8.1f} MB".format(
+                stage, resolution, dem.size, seconds, result["cells_per_second"], result["peak_memory"] / 1e6))
+
+    with open(arguments.output, 'a') as f:
+        for result in results:
+            f.write(json.dumps(result, sort_keys=True) + "\n")
+
+    if compare_to_previous(results, previous_results, arguments.threshold) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,25 @@
 import csv
+import math
+import numpy as np
 import re
 import os
-import processing
 from processing.core import Processing
-from qgis.core import QgsApplication, QgsVectorLayer, QgsMapLayerRegistry
-from qgis.analysis import QgsGeometryAnalyzer, QgsZonalStatistics
+from PyQt4.QtCore import QVariant
+from qgis.core import QgsApplication, QgsField, QgsVectorLayer, QgsMapLayerRegistry
+from qgis.analysis import QgsGeometryAnalyzer
+import BlockTools
+import CacheTools
+import FeatureTools
+import FlowTools
+import FocalTools
 import GeneralTools
-
-qgishome = "C:/OSGeo4W64/apps/qgis-ltr/"
-app = QgsApplication([], True)
-app.setPrefixPath(qgishome, True)
-app.initQgis()
-os.environ['QGIS_DEBUG'] = '1'
-Processing.initialize()
+import IncrementalTools
+import RasterTools
+import SolarTools
+import TerrainTools
+import TraceTools
+import WarpTools
+import ZonalTools
 
 class predictor_object():
     def __init__(self, short_name, full_name, path, resolution):
@@ -22,10 +29,281 @@ class predictor_object():
         self.resolution = resolution
 
 
-def compute_raster_variables(dem_path, output_folder):
+class raster_settings():
+    def __init__(self, tile_size=None, flow_method="D8", solar_day=180, solar_step=0.5, horizon_sectors=16,
+                 horizon_distance=5000.0, processes=1, tpi_radii=(), incremental=False):
+        """
+        Settings of the raster variable computation
+        :param tile_size: Size of the processing tiles in cells. None processes whole rasters at once.
+        :param flow_method: D8 or MFD flow routing for the catchment area and TWI
+        :param solar_day: Day of the year for the solar radiation
+        :param solar_step: Time step of the solar radiation in hours
+        :param horizon_sectors: Number of azimuth sectors for the horizon angles
+        :param horizon_distance: Maximum search distance of the horizon angles in map units
+        :param processes: Number of worker processes
+        :param tpi_radii: Window radii in map units of the multiscale TPI predictors
+        :param incremental: True to recompute only the parts of the outputs that changed blocks of the DEM reach
+        """
+        self.tile_size = tile_size
+        self.flow_method = flow_method
+        self.solar_day = solar_day
+        self.solar_step = solar_step
+        self.horizon_sectors = horizon_sectors
+        self.horizon_distance = horizon_distance
+        self.processes = processes
+        self.tpi_radii = list(tpi_radii)
+        self.incremental = incremental
+
+
+class dem_data():
+    """
+    DEM and its terrain derivatives, read and computed on first use and shared by all processing steps of the DEM
+    """
+
+    def __init__(self, dem_path):
+        self.dem_path = dem_path
+        self.dem = None
+        self.grid = None
+        self.derivatives = None
+
+    def load(self):
+        """
+        :return: Tuple of (DEM array, raster_grid)
+        """
+        if self.dem is None:
+            self.dem, self.grid = RasterTools.read_raster(self.dem_path)
+        return self.dem, self.grid
+
+    def load_derivatives(self):
+        """
+        :return: Dictionary of terrain derivatives (see TerrainTools.derivatives_from_padded)
+        """
+        if self.derivatives is None:
+            dem, grid = self.load()
+            self.derivatives = TerrainTools.compute_terrain_derivatives(dem, grid.cell_size_x(), grid.cell_size_y())
+        return self.derivatives
+
+
+def compute_terrain_rasters(data, derivative_paths, tile_size=None, changes=None):
+    """
+    Method for computing the terrain derivatives of a DEM and writing them to GeoTIFFs.
+    :param data: Instance of dem_data
+    :param derivative_paths: Dictionary of derivative name (see TerrainTools.TERRAIN_DERIVATIVES) -> output path
+    :param tile_size: Size of the processing tiles in cells. None processes the whole raster at once.
+    :param changes: Instance of IncrementalTools.dem_changes to update the existing outputs in the changed windows
+    only, or None to compute everything
+    """
+    if changes is not None:
+        source = RasterTools.gdal_band_source(data.dem_path)
+        grid = source.grid
+        sinks = {}
+        for name in TerrainTools.TERRAIN_DERIVATIVES:
+            sinks[name] = RasterTools.gdal_band_updater(derivative_paths[name])
+        BlockTools.process_windows(source, sinks,
+                                   lambda padded: TerrainTools.derivatives_from_padded(padded, grid.cell_size_x(),
+                                                                                       grid.cell_size_y()),
+                                   TerrainTools.TERRAIN_HALO, changes.grown_windows(TerrainTools.TERRAIN_HALO))
+        for name in sinks:
+            sinks[name].close()
+    elif tile_size is None:
+        dem, grid = data.load()
+        derivatives = data.load_derivatives()
+        for name in TerrainTools.TERRAIN_DERIVATIVES:
+            RasterTools.write_raster(derivatives[name], grid, derivative_paths[name])
+    else:
+        # Process the DEM tile by tile to keep the memory use bounded by the tile size
+        source = RasterTools.gdal_band_source(data.dem_path)
+        grid = source.grid
+        sinks = {}
+        for name in TerrainTools.TERRAIN_DERIVATIVES:
+            sinks[name] = RasterTools.gdal_band_sink(derivative_paths[name], grid)
+        BlockTools.process_in_blocks(source, sinks,
+                                     lambda padded: TerrainTools.derivatives_from_padded(padded, grid.cell_size_x(),
+                                                                                         grid.cell_size_y()),
+                                     TerrainTools.TERRAIN_HALO, tile_size)
+        for name in sinks:
+            sinks[name].close()
+
+
+def compute_horizon_file(data, horizon_path, settings, changes=None):
+    """
+    Method for computing the horizon angles of a DEM and saving them to a .npy file. With a tile size the DEM is read
+    tile by tile with the search distance as halo, and the file is written through a memory map.
+    :param data: Instance of dem_data
+    :param horizon_path: Path to the output .npy file
+    :param settings: Instance of raster_settings
+    :param changes: Instance of IncrementalTools.dem_changes to update the existing file in the changed windows only,
+    or None to compute everything
+    """
+    if settings.tile_size is None and changes is None:
+        dem, grid = data.load()
+        opener, arguments = BlockTools.array_source, (dem,)
+    else:
+        grid = RasterTools.open_grid(data.dem_path)
+        opener, arguments = RasterTools.gdal_band_source, (data.dem_path,)
+
+    if changes is not None:
+        # A changed cell can be the horizon of any cell within the search distance
+        horizons = np.load(horizon_path, mmap_mode="r+")
+        windows = changes.grown_windows(SolarTools.horizon_cells(settings.horizon_distance, grid.cell_size_x()))
+    else:
+        horizons = np.lib.format.open_memmap(horizon_path, mode="w+", dtype=np.float32,
+                                             shape=(settings.horizon_sectors, grid.rows, grid.cols))
+        windows = BlockTools.generate_windows(grid.rows, grid.cols, settings.tile_size or max(grid.rows, grid.cols))
+    for window, angles in SolarTools.horizon_blocks(opener, arguments, grid.cell_size_x(), windows,
+                                                    settings.horizon_sectors, settings.horizon_distance,
+                                                    settings.processes):
+        horizons[:, window.row_off:window.row_off + window.rows, window.col_off:window.col_off + window.cols] = angles
+    horizons.flush()
+
+
+def compute_solar_rasters(data, horizon_path, radiation_paths, settings, changes=None):
+    """
+    Method for computing the daily solar radiation of a DEM and writing it to GeoTIFFs. Slope and aspect are taken
+    from the terrain derivatives in memory and the horizon angles from the precomputed horizon file. With a tile size
+    the radiation is computed tile by tile, with slope and aspect of the tile and its horizons read from the file.
+    :param data: Instance of dem_data
+    :param horizon_path: Path to the horizon angles (.npy) from compute_horizon_file
+    :param radiation_paths: Dictionary of output name (see SolarTools.RADIATION_OUTPUTS) -> output path
+    :param settings: Instance of raster_settings
+    :param changes: Instance of IncrementalTools.dem_changes to update the existing outputs in the changed windows
+    only, or None to compute everything
+    """
+    if settings.tile_size is None and changes is None:
+        dem, grid = data.load()
+        derivatives = data.load_derivatives()
+        radiation = SolarTools.compute_daily_radiation(dem, derivatives["slope"], derivatives["aspect"],
+                                                       np.load(horizon_path), settings.solar_day,
+                                                       RasterTools.grid_centre_latitude(grid), settings.solar_step)
+        for name in SolarTools.RADIATION_OUTPUTS:
+            RasterTools.write_raster(radiation[name], grid, radiation_paths[name])
+        return
+
+    source = RasterTools.gdal_band_source(data.dem_path)
+    grid = source.grid
+    horizons = np.load(horizon_path, mmap_mode="r")
+    latitude = RasterTools.grid_centre_latitude(grid)
+    halo = TerrainTools.TERRAIN_HALO
+    if changes is not None:
+        # The radiation of a cell depends on its own slope, aspect and horizons, so the changes reach as far as the
+        # horizon search distance
+        sinks = dict((name, RasterTools.gdal_band_updater(radiation_paths[name])) for name in radiation_paths)
+        windows = changes.grown_windows(max(SolarTools.horizon_cells(settings.horizon_distance, grid.cell_size_x()),
+                                            halo))
+    else:
+        sinks = dict((name, RasterTools.gdal_band_sink(radiation_paths[name], grid)) for name in radiation_paths)
+        windows = BlockTools.generate_windows(grid.rows, grid.cols, settings.tile_size)
+    for window in windows:
+        padded = BlockTools.read_padded_window(source, window, halo)
+        derivatives = TerrainTools.derivatives_from_padded(padded, grid.cell_size_x(), grid.cell_size_y())
+        rows = slice(window.row_off, window.row_off + window.rows)
+        cols = slice(window.col_off, window.col_off + window.cols)
+        radiation = SolarTools.compute_daily_radiation(padded[halo:halo + window.rows, halo:halo + window.cols],
+                                                       derivatives["slope"], derivatives["aspect"],
+                                                       np.array(horizons[:, rows, cols]), settings.solar_day,
+                                                       latitude, settings.solar_step)
+        for name in sinks:
+            sinks[name].write_block(window, radiation[name])
+    for name in sinks:
+        sinks[name].close()
+
+
+def compute_tpi_rasters(data, tpi_paths, tpi_radii, tile_size=None, changes=None):
+    """
+    Method for computing topographic position indices at several scales from one set of summed-area tables and
+    writing them to GeoTIFFs.
+    :param data: Instance of dem_data
+    :param tpi_paths: Dictionary of output name -> output path
+    :param tpi_radii: Dictionary of output name -> window radius in map units, None for the 3x3 window of
+    gdalogr:tpitopographicpositionindex
+    :param tile_size: Size of the processing tiles in cells. None processes the whole raster at once.
+    :param changes: Instance of IncrementalTools.dem_changes to update the existing outputs in the changed windows
+    only, or None to compute everything
+    """
+    if tile_size is None and changes is None:
+        grid = data.load()[1]
+    else:
+        source = RasterTools.gdal_band_source(data.dem_path)
+        grid = source.grid
+
+    radii_in_cells = {}
+    for name in tpi_radii:
+        if tpi_radii[name] is None:
+            radii_in_cells[name] = 1
+        else:
+            radii_in_cells[name] = FocalTools.radius_in_cells(tpi_radii[name], grid.cell_size_x())
+    complete_radii = [radii_in_cells[name] for name in tpi_radii if tpi_radii[name] is None]
+    halo = max(radii_in_cells.values())
+    # One fixed-point centring for the whole raster, so tiles and changed windows are computed like the whole raster
+    if tile_size is None and changes is None:
+        dem = data.load()[0]
+        value_range = (np.nanmin(dem), np.nanmax(dem))
+    else:
+        value_range = BlockTools.value_range(source, tile_size or IncrementalTools.DEFAULT_BLOCK_SIZE)
+    centring = FocalTools.fixed_point(value_range[0], value_range[1], halo)
+
+    def tpi_from_padded(padded):
+        statistics = FocalTools.focal_statistics_from_padded(padded, set(radii_in_cells.values()), halo,
+                                                             complete_radii, centring)
+        return dict((name, statistics[radii_in_cells[name]]["tpi"]) for name in radii_in_cells)
+
+    if changes is not None:
+        sinks = dict((name, RasterTools.gdal_band_updater(tpi_paths[name])) for name in tpi_paths)
+        BlockTools.process_windows(source, sinks, tpi_from_padded, halo, changes.grown_windows(halo))
+        for name in sinks:
+            sinks[name].close()
+    elif tile_size is None:
+        results = tpi_from_padded(np.pad(dem, halo, mode="constant", constant_values=np.nan))
+        for name in tpi_paths:
+            RasterTools.write_raster(results[name], grid, tpi_paths[name])
+    else:
+        sinks = {}
+        for name in tpi_paths:
+            sinks[name] = RasterTools.gdal_band_sink(tpi_paths[name], grid)
+        BlockTools.process_in_blocks(source, sinks, tpi_from_padded, halo, tile_size)
+        for name in sinks:
+            sinks[name].close()
+
+
+def compute_flow_rasters(data, catchment_area_path, twi_path, flow_method="D8", state_path=None, changes=None):
+    """
+    Method for computing the catchment area and topographic wetness index of a DEM and writing them to GeoTIFFs.
+    The slope for the TWI is computed from the same read of the DEM.
+    :param data: Instance of dem_data
+    :param catchment_area_path: Path to the output catchment area raster
+    :param twi_path: Path to the output TWI raster
+    :param flow_method: D8 or MFD flow routing
+    :param state_path: Path to the .npz file of the filled DEM and catchment area kept for incremental updates, or
+    None
+    :param changes: Instance of IncrementalTools.dem_changes to accumulate the flow again only downstream of the
+    changes, using the state of the previous run, or None to compute everything
+    """
+    dem, grid = data.load()
+    if changes is not None:
+        state = np.load(state_path)
+        catchment_area, filled, updated_cells = FlowTools.update_catchment_area(
+            dem, grid.cell_size_x(), flow_method, state["filled"], state["catchment_area"])
+        print("Flow accumulated again in " + str(updated_cells) + " of " + str(dem.size) + " cells")
+    else:
+        filled = FlowTools.fill_depressions(dem)
+        catchment_area = FlowTools.compute_catchment_area(dem, grid.cell_size_x(), flow_method, filled)
+    if state_path is not None:
+        np.savez(state_path, filled=filled, catchment_area=catchment_area)
+    if data.derivatives is not None:
+        slope = data.derivatives["saga_slope"]
+    else:
+        slope = TerrainTools.compute_saga_slope(dem, grid.cell_size_x(), grid.cell_size_y())
+    RasterTools.write_raster(catchment_area, grid, catchment_area_path)
+    RasterTools.write_raster(FlowTools.compute_twi(catchment_area, slope, grid.cell_size_x()), grid, twi_path)
+
+
+def compute_raster_variables(dem_path, output_folder, settings, cache=None):
     """
     Method for creating Topographic variables.
     :param dem_path: Path to the input dem
+    :param output_folder: Folder where to store the computed variables
+    :param settings: Instance of raster_settings
+    :param cache: Instance of CacheTools.raster_cache to reuse unchanged outputs, or None to compute everything
     :return: object containing the computed variables
     """
 
@@ -37,15 +315,6 @@ def compute_raster_variables(dem_path, output_folder):
 
     resol = int(re.findall(r'[0-9]+', dem_path)[0])
 
-    input_raster = GeneralTools.load_raster(dem_path)
-
-    ##Calculate extend and combine proper string
-    ymax = input_raster.extent().yMaximum()
-    ymin = input_raster.extent().yMinimum()
-    xmax = input_raster.extent().xMaximum()
-    xmin = input_raster.extent().xMinimum()
-    extent_string = str(int(xmin)) + "," + str(int(xmax)) + "," + str(int(ymin)) + "," + str(int(ymax))
-
     ##Create names for the new files - stores to new folder
     slope_path = os.path.join(output_folder, new_folder, new_file_prefix + "_Slope.tif")
     aspect_path = os.path.join(output_folder, new_folder, new_file_prefix + "_Aspect.tif")
@@ -79,34 +348,88 @@ def compute_raster_variables(dem_path, output_folder):
     twi_path = os.path.join(output_folder, new_folder, new_file_prefix + "_TWI.tif")
     tpi_path = os.path.join(output_folder, new_folder, new_file_prefix + "_TPI.tif")
 
-    # Call the processing algorithm
-    processing.runalg("grass:r.slope.aspect", dem_path, 0, 1, False, 1, 0, extent_string, 0,
-                      slope_path,
-                      aspect_path,
-                      profice_curvature_path,
-                      tangential_curvature_path,
-                      first_order_derivative_ew_path,
-                      first_order_derivative_ns_path,
-                      second_order_derivative_dxx_path,
-                      second_order_derivative_dyy_path,
-                      second_order_derivative_dxy_path)
-
-    processing.runalg("grass7:r.sun", dem_path,
-                      aspect_path,
-                      slope_path,
-                      None, None, None, None, None, None,
-                      180, 0.5, 0, 1, False, False, extent_string, 0,
-                      irradiation_path,
-                      insilation_time_path,
-                      diffuse_radiation_path,
-                      ground_reflected_irradiation_path,
-                      global_total_output_path)
-
-    processing.runalg("saga:catchmentarea", dem_path, 0, catchment_area_path)
-    processing.runalg("saga:slopeaspectcurvature", dem_path, 6, 1, 1, slope_saga_path, None, None, None, None, None,
-                      None, None, None, None, None, None)
-    processing.runalg("saga:topographicwetnessindextwi", slope_saga_path, catchment_area_path, None, 1, 0, twi_path)
-    processing.runalg("gdalogr:tpitopographicpositionindex", dem_path, 1, False, tpi_path)
+    # Compute the terrain derivatives from one read of the DEM
+    derivative_paths = {"slope": slope_path,
+                        "aspect": aspect_path,
+                        "profile_curvature": profice_curvature_path,
+                        "tangential_curvature": tangential_curvature_path,
+                        "dx": first_order_derivative_ew_path,
+                        "dy": first_order_derivative_ns_path,
+                        "dxx": second_order_derivative_dxx_path,
+                        "dyy": second_order_derivative_dyy_path,
+                        "dxy": second_order_derivative_dxy_path,
+                        "saga_slope": slope_saga_path}
+    data = dem_data(dem_path)
+
+    # With incremental updates, the block checksums of the DEM are compared to the ones of the previous run and each
+    # output is recomputed only where the changed blocks reach, if it was computed with the same parameters
+    changes = None
+    tool_parameters = {}
+    if settings.incremental:
+        changes = IncrementalTools.dem_changes(
+            os.path.join(output_folder, new_folder, new_file_prefix + "_Blocks.json"),
+            RasterTools.gdal_band_source(dem_path))
+
+    def changes_for(tool, parameters, output_paths):
+        tool_parameters[tool] = parameters
+        if changes is not None and changes.can_update(tool, parameters, output_paths):
+            return changes
+        return None
+
+    terrain_outputs = [derivative_paths[name] for name in TerrainTools.TERRAIN_DERIVATIVES]
+    terrain_changes = changes_for("terrain_derivatives", [], terrain_outputs)
+    CacheTools.run_cached(cache, "terrain_derivatives", [dem_path], [], terrain_outputs,
+                          lambda: compute_terrain_rasters(data, derivative_paths, settings.tile_size,
+                                                          terrain_changes))
+
+    horizon_path = os.path.join(output_folder, new_folder, new_file_prefix + "_Horizons.npy")
+    horizon_parameters = [settings.horizon_sectors, settings.horizon_distance]
+    horizon_changes = changes_for("horizon_angles", horizon_parameters, [horizon_path])
+    CacheTools.run_cached(cache, "horizon_angles", [dem_path], horizon_parameters, [horizon_path],
+                          lambda: compute_horizon_file(data, horizon_path, settings, horizon_changes))
+
+    radiation_paths = {"beam": irradiation_path,
+                       "insolation_time": insilation_time_path,
+                       "diffuse": diffuse_radiation_path,
+                       "reflected": ground_reflected_irradiation_path,
+                       "global": global_total_output_path}
+    radiation_outputs = [radiation_paths[name] for name in SolarTools.RADIATION_OUTPUTS]
+    solar_parameters = [settings.solar_day, settings.solar_step]
+    solar_changes = changes_for("solar_radiation", solar_parameters + horizon_parameters, radiation_outputs)
+    CacheTools.run_cached(cache, "solar_radiation", [dem_path, horizon_path], solar_parameters, radiation_outputs,
+                          lambda: compute_solar_rasters(data, horizon_path, radiation_paths, settings, solar_changes))
+
+    # The filled DEM and the catchment area are kept next to the outputs for accumulating the flow incrementally
+    flow_outputs = [catchment_area_path, twi_path]
+    flow_state_path = None
+    if settings.incremental:
+        flow_state_path = os.path.join(output_folder, new_folder, new_file_prefix + "_FlowState.npz")
+        flow_outputs.append(flow_state_path)
+    flow_changes = changes_for("flow_routing", [settings.flow_method], flow_outputs)
+    CacheTools.run_cached(cache, "flow_routing", [dem_path], [settings.flow_method], flow_outputs,
+                          lambda: compute_flow_rasters(data, catchment_area_path, twi_path, settings.flow_method,
+                                                       flow_state_path, flow_changes))
+
+    # The 3x3 TPI and the multiscale TPIs share one set of summed-area tables
+    # Short names of the multiscale TPIs are TP1, TP2... to fit the shapefile column names to 10 characters
+    tpi_paths = {"TPI": tpi_path}
+    tpi_radii = {"TPI": None}
+    tpi_predictors = []
+    for i, radius in enumerate(settings.tpi_radii):
+        name = "TP" + str(i + 1)
+        tpi_paths[name] = os.path.join(output_folder, new_folder,
+                                       new_file_prefix + "_TPI" + str(int(radius)) + "m.tif")
+        tpi_radii[name] = radius
+        tpi_predictors.append(predictor_object(name, "Topographic Position Index " + str(int(radius)) + " m",
+                                               tpi_paths[name], resol))
+    tpi_names = sorted(tpi_paths)
+    tpi_parameters = [[name, tpi_radii[name]] for name in tpi_names]
+    tpi_outputs = [tpi_paths[name] for name in tpi_names]
+    tpi_changes = changes_for("focal_tpi", tpi_parameters, tpi_outputs)
+    CacheTools.run_cached(cache, "focal_tpi", [dem_path], tpi_parameters, tpi_outputs,
+                          lambda: compute_tpi_rasters(data, tpi_paths, tpi_radii, settings.tile_size, tpi_changes))
+    if changes is not None:
+        changes.commit(tool_parameters)
 
     predictors = []
     predictors.extend(
@@ -124,6 +447,7 @@ def compute_raster_variables(dem_path, output_folder):
          predictor_object("TPI", "Topographic Position Index", tpi_path, resol),
          predictor_object("DTM", "Digital Terrain Model", dem_path, resol)
          ])
+    predictors.extend(tpi_predictors)
 
     return predictors
 
@@ -145,12 +469,176 @@ def create_study_area_shapefile(plot_list, buffer_size, output_path):
     return shape
 
 
-def create_grass_created_raster_predictors(dem_directory, output_directory):
+def warp_cached(cache, input_path, output_path, source_srs, target_srs, resolution, method):
+    """
+    Method for reprojecting a raster with all its bands through the cache, replacing gdalogr:warpreproject
+    :param cache: Instance of CacheTools.raster_cache, or None
+    :param input_path: Path to the input raster
+    :param output_path: Path to the output raster
+    :param source_srs: Spatial reference of the input, e.g. EPSG:4326
+    :param target_srs: Spatial reference of the output, e.g. EPSG:32737
+    :param resolution: Cell size of the output
+    :param method: Resampling method (see WarpTools.WARP_METHODS)
+    """
+    with TraceTools.span("warp_raster", "dataset", resolution=str(resolution), file=os.path.basename(input_path)):
+        CacheTools.run_cached(cache, "warp", [input_path], [source_srs, target_srs, resolution, method],
+                              [output_path], lambda: WarpTools.warp_raster(input_path, output_path, target_srs,
+                                                                          resolution, method, source_srs))
+
+
+def find_plot_centres(buffered_vector):
+    """
+    Method for finding the plot centres of a buffered plot layer
+    :param buffered_vector: QgsVectorLayer of the buffered plots
+    :return: Tuple of (feature ids, x coordinates, y coordinates, dictionary of key column -> values), the key columns
+    being FeatureTools.PLOT_KEYS
+    """
+    feature_ids = []
+    centres_x = []
+    centres_y = []
+    plot_keys = dict((name, []) for name in FeatureTools.PLOT_KEYS)
+    for feature in buffered_vector.getFeatures():
+        centre = feature.geometry().centroid().asPoint()
+        feature_ids.append(feature.id())
+        centres_x.append(centre.x())
+        centres_y.append(centre.y())
+        for name in FeatureTools.PLOT_KEYS:
+            plot_keys[name].append(feature[name])
+    return feature_ids, centres_x, centres_y, plot_keys
+
+
+def group_predictor_bands_by_grid(predictors):
+    """
+    Method for grouping all predictor bands by the grid they are on, so that each grid is rasterized only once.
+    :param predictors: Dictionary of resolution -> list of predictor_object
+    :return: Dictionary of grid key -> (raster_grid, list of (column prefix, block source, statistics,
+    predictor_object))
+    """
+    grids = {}
+    for predictor_resolution, all_predictors_per_resolution in predictors.iteritems():
+        for predictor in all_predictors_per_resolution:
+            if "RS" not in predictor_resolution:
+                prefix = str(predictor_resolution + predictor.short_name)
+                source = RasterTools.gdal_band_source(predictor.path, 1)
+                statistics = ZonalTools.STATISTICS
+            else:
+                prefix = str(predictor_resolution + predictor.short_name + str(predictor.band))
+                source = RasterTools.gdal_band_source(predictor.path, int(predictor.band))
+                statistics = ["mean", "stdev"]
+            key = (source.grid.geotransform, source.rows, source.cols)
+            if key not in grids:
+                grids[key] = (source.grid, [])
+            grids[key][1].append((prefix, source, statistics, predictor))
+    return grids
+
+
+def write_attribute_columns(vector, feature_ids, columns):
+    """
+    Method for adding numeric attribute columns to a vector layer. NaN values are written as NULL.
+    :param vector: QgsVectorLayer to update
+    :param feature_ids: Feature id of each value
+    :param columns: List of (column name, array of values)
+    """
+    provider = vector.dataProvider()
+    first_index = len(provider.fields())
+    provider.addAttributes([QgsField(name, QVariant.Double, "double", 24, 15) for name, values in columns])
+    vector.updateFields()
+
+    changes = {}
+    for i, feature_id in enumerate(feature_ids):
+        changes[feature_id] = {}
+        for column_number, (name, values) in enumerate(columns):
+            value = float(values[i])
+            changes[feature_id][first_index + column_number] = None if math.isnan(value) else value
+    provider.changeAttributeValues(changes)
+
+
+def compute_plot_statistics(buffered_vectors, predictors, store_directory=None):
+    """
+    Method for computing the zonal statistics of all predictors for the concentric plot buffers. The cells within the
+    largest buffer are found and read once per grid, and the statistics of every smaller buffer are derived from the
+    same cells sorted by distance. All predictors and bands sharing a grid are read in one pass.
+    :param buffered_vectors: Dictionary of buffer radius -> QgsVectorLayer of the buffered plots. The statistics are
+    added as attribute columns.
+    :param predictors: Dictionary of resolution -> list of predictor_object
+    :param store_directory: Feature store directory where to also write the statistics as one plot table per buffer
+    radius, or None
+    :throws: Throws a ValueError if the buffered layers do not list the same plots (FeatureTools.PLOT_KEYS) in the
+    same order
+    """
+    radii = sorted(buffered_vectors)
+    feature_ids = {}
+    plot_keys = {}
+    for radius in radii:
+        feature_ids[radius], x, y, plot_keys[radius] = find_plot_centres(buffered_vectors[radius])
+        if radius == radii[0]:
+            centres_x, centres_y = x, y
+        elif plot_keys[radius] != plot_keys[radii[0]]:
+            # The statistics are written back by position, so every layer must list the same plots in the same order
+            raise ValueError("The " + str(radius) + " m plot buffers do not list the same plots in the same order as "
+                             "the " + str(radii[0]) + " m buffers")
+
+    columns = dict((radius, []) for radius in radii)
+    grids = group_predictor_bands_by_grid(predictors)
+    for key in grids:
+        grid, bands = grids[key]
+        with TraceTools.span("nested_zonal_statistics", "zonal", resolution=str(grid.cell_size_x()),
+                             bands=len(bands)):
+            zones = ZonalTools.rasterize_nested_circles(centres_x, centres_y, radii, grid)
+            sources = {}
+            for prefix, source, statistics, predictor in bands:
+                sources[prefix] = source
+            on_grid = zones.centre_cells >= 0
+            values = ZonalTools.gather_cells(sources, np.concatenate([zones.cells, zones.centre_cells[on_grid]]),
+                                             grid.cols)
+            for prefix, source, statistics, predictor in bands:
+                centre_values = np.full(zones.zone_count, np.nan)
+                centre_values[on_grid] = values[prefix][len(zones.cells):]
+                results = ZonalTools.nested_statistics(values[prefix][:len(zones.cells)], centre_values, zones)
+                for radius in radii:
+                    for name in statistics:
+                        columns[radius].append((prefix + name, results[radius][name]))
+
+    for radius in radii:
+        write_attribute_columns(buffered_vectors[radius], feature_ids[radius], columns[radius])
+        if store_directory is not None:
+            FeatureTools.write_plot_table(os.path.join(store_directory, "Plots_" + str(radius) + "m"),
+                                          plot_keys[radius], columns[radius])
+
+
+def write_predictor_cubes(predictors, store_directory):
+    """
+    Method for storing the predictors to the feature store, all predictors and bands sharing a grid as one memory-mapped
+    predictor cube with the predictor_object metadata in its index.
+    :param predictors: Dictionary of resolution -> list of predictor_object
+    :param store_directory: Feature store directory (Will be created)
+    """
+    grids = group_predictor_bands_by_grid(predictors)
+    for key in grids:
+        grid, bands = grids[key]
+        metadata = []
+        sources = {}
+        for prefix, source, statistics, predictor in bands:
+            metadata.append({"short_name": prefix,
+                             "full_name": predictor.full_name,
+                             "path": predictor.path,
+                             "resolution": predictor.resolution,
+                             "band": int(getattr(predictor, "band", 1))})
+            sources[prefix] = source
+        resolutions = sorted(set(re.match(r'[A-Z]+[0-9]+', band["short_name"]).group(0) for band in metadata))
+        cube_name = "_".join(resolutions) + "_" + str(grid.cols) + "x" + str(grid.rows)
+        cube = FeatureTools.create_cube(os.path.join(store_directory, cube_name), grid, metadata)
+        FeatureTools.fill_cube(cube, sources)
+
+
+def create_grass_created_raster_predictors(dem_directory, output_directory, settings, cache=None):
     grass_predictors = {}
     for dem_file in os.listdir(dem_directory):
         if dem_file.endswith(".tif"):
-            grass_predictors[construct_shortened_name(dem_file)] = compute_raster_variables(
-                os.path.join(dem_directory, dem_file), output_directory)
+            short_name = construct_shortened_name(dem_file)
+            with TraceTools.span("compute_raster_variables", "dem", resolution=short_name, dem=dem_file):
+                grass_predictors[short_name] = compute_raster_variables(os.path.join(dem_directory, dem_file),
+                                                                        output_directory, settings, cache)
 
     return grass_predictors
 
@@ -183,12 +671,17 @@ def write_results_file(buffered_files, output_directory):
 def write_legend_file(predictors, output_directory):
     with open(os.path.join(output_directory, 'legend.csv'), 'wb') as csvfile:
         csvwriter = csv.writer(csvfile, delimiter=';', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-        csvwriter.writerow(['Short Name'] + ['Type'] + ['Resolution'] + ['Predictor'] + ['Input'])
+        csvwriter.writerow(['Short Name'] + ['Type'] + ['Resolution'] + ['Predictor'] + ['Input'] + ['Band'])
         for predictor_resolution, all_predictors_per_resolution in predictors.iteritems():
             for predictor in all_predictors_per_resolution:
+                # Bands of a multiband file are named like their plot statistics columns, e.g. RS30B1 + band
+                short_name = predictor_resolution + predictor.short_name
+                if "RS" in predictor_resolution:
+                    short_name += str(predictor.band)
                 csvwriter.writerow(
-                    [predictor_resolution + predictor.short_name] + [resolve_type(predictor_resolution)] + [
-                        resolve_resolution(predictor_resolution)] + [predictor.full_name] + [predictor.path])
+                    [short_name] + [resolve_type(predictor_resolution)] + [
+                        resolve_resolution(predictor_resolution)] + [predictor.full_name] + [predictor.path] + [
+                        str(getattr(predictor, "band", 1))])
 
 
 def resolve_type(short_name):
@@ -215,81 +708,107 @@ def construct_rs_resolution(size):
     return "RS" + str(size)
 
 
-#####Configuration#####
-dem_directory = "F:/data/DEM"
-output_directory = "F:/data/RasterPredictors"
-plot_list_path = "F:/data/AllPlots.csv"
-soil_250m_data_list_path = "F:/data/AfricanSoilGrids/combined-soil-rasters.csv"
-rs_data_list_path = "F:/data/RS/rs-datasets.csv"
-plot_buffers = [17.84, 25.23, 35.68, 50.46, 71.37]
-buffered_studyareas = {}
-
-## Create Raster Predictors
-predictors = create_grass_created_raster_predictors(dem_directory, output_directory)
-
-### African soil Grids
-with open(soil_250m_data_list_path, 'rb') as f:
-    reader = csv.reader(f, delimiter=';')
-    headers = reader.next()
-    for row in reader:
-        resolution = row[0]
-        path = row[1]
-        description = row[2]
-        short_name = row[3]
-        soiltype = row[4]
-
-        reprojected_path = os.path.join(os.path.dirname(path), "32737_" + os.path.basename(path))
-        processing.runalg("gdalogr:warpreproject", path, "EPSG:4326", "EPSG:32737", "", 250, 1, 5, 4, 75, 6, 1,
-                          False, 0, False, "", reprojected_path)
-        if construct_soil_resolution(250) in predictors:
-            predictors[construct_soil_resolution(250)].append(
-                predictor_object(short_name, description, reprojected_path, 250))
-        else:
-            predictors[construct_soil_resolution(250)] = []
-            predictors[construct_soil_resolution(250)].append(
-                predictor_object(short_name, description, reprojected_path, 250))
-
-### Read Landsat data
-with open(rs_data_list_path, 'rb') as f:
-    reader = csv.reader(f, delimiter=';')
-    headers = reader.next()
-    for row in reader:
-        resolution = row[0]
-        path = row[1]
-        description = row[2]
-        short_name = row[3]
-        band = row[4]
-
-        scaled_path = os.path.join(os.path.dirname(path), "32737__" + os.path.basename(path))
-        processing.runalg("gdalogr:warpreproject", path, "EPSG:32637", "EPSG:32737", "", 30, 0, 5, 4, 75, 6, 1,
-                         False, 0, False, "", scaled_path)
-        predictor_rs = predictor_object(short_name, description, scaled_path, 30)
-        predictor_rs.band = band
-        if construct_rs_resolution(30) in predictors:
-            predictors[construct_rs_resolution(30)].append(predictor_rs)
-        else:
-            predictors[construct_rs_resolution(30)] = []
-            predictors[construct_rs_resolution(30)].append(predictor_rs)
-
-## Create Plot Shapefiles
-for plot_buffer_size in plot_buffers:
-    study_area_shape_path = os.path.join(output_directory, "StudyArea_" + str(plot_buffer_size) + "m.shp")
-    buffered_vector = create_study_area_shapefile(plot_list_path, plot_buffer_size, study_area_shape_path)
-    buffered_studyareas[plot_buffer_size] = study_area_shape_path
-    for predictor_resolution, all_predictors_per_resolution in predictors.iteritems():
-        for predictor in all_predictors_per_resolution:
-            if "RS" not in predictor_resolution:
-                zoneStat = QgsZonalStatistics(buffered_vector, predictor.path,
-                                              str(predictor_resolution + predictor.short_name), 1,
-                                              QgsZonalStatistics.Mean | QgsZonalStatistics.Max |
-                                              QgsZonalStatistics.Min | QgsZonalStatistics.Range | QgsZonalStatistics.StDev)
-                zoneStat.calculateStatistics(None)
+def main():
+    qgishome = "C:/OSGeo4W64/apps/qgis-ltr/"
+    app = QgsApplication([], True)
+    app.setPrefixPath(qgishome, True)
+    app.initQgis()
+    os.environ['QGIS_DEBUG'] = '1'
+    Processing.initialize()
+
+    #####Configuration#####
+    dem_directory = "F:/data/DEM"
+    output_directory = "F:/data/RasterPredictors"
+    plot_list_path = "F:/data/AllPlots.csv"
+    soil_250m_data_list_path = "F:/data/AfricanSoilGrids/combined-soil-rasters.csv"
+    rs_data_list_path = "F:/data/RS/rs-datasets.csv"
+    plot_buffers = [17.84, 25.23, 35.68, 50.46, 71.37]
+    tile_size = None  # Size of the processing tiles in cells (e.g. 2048), None processes whole rasters at once
+    cache_directory = "F:/data/RasterPredictorCache"  # Cache of derived rasters, None disables the cache
+    cache_max_size = 100 * 1024 ** 3  # Maximum size of the cache in bytes
+    flow_method = "D8"  # Flow routing for catchment area and TWI: D8 or MFD
+    solar_day = 180  # Day of the year for the solar radiation
+    solar_step = 0.5  # Time step of the solar radiation in hours
+    horizon_sectors = 16  # Number of azimuth sectors of the horizon angles
+    horizon_distance = 5000.0  # Maximum horizon search distance in metres
+    processes = 4  # Number of worker processes for the horizon angles
+    tpi_radii = [50, 100, 250, 500]  # Window radii in metres of the multiscale TPI predictors
+    incremental = True  # Recompute only the parts of the outputs that the changed blocks of an edited DEM reach
+    feature_store_directory = os.path.join(output_directory, "FeatureStore")  # None to skip the feature store
+    buffered_studyareas = {}
+
+    ## Create Raster Predictors
+    cache = CacheTools.raster_cache(cache_directory, cache_max_size) if cache_directory is not None else None
+    settings = raster_settings(tile_size, flow_method, solar_day, solar_step, horizon_sectors, horizon_distance,
+                               processes, tpi_radii, incremental)
+    predictors = create_grass_created_raster_predictors(dem_directory, output_directory, settings, cache)
+
+    ### African soil Grids
+    with open(soil_250m_data_list_path, 'rb') as f:
+        reader = csv.reader(f, delimiter=';')
+        headers = reader.next()
+        for row in reader:
+            resolution = row[0]
+            path = row[1]
+            description = row[2]
+            short_name = row[3]
+            soiltype = row[4]
+
+            # All soil grids share one source grid, so the warp plan is computed only for the first one
+            reprojected_path = os.path.join(os.path.dirname(path), "32737_" + os.path.basename(path))
+            warp_cached(cache, path, reprojected_path, "EPSG:4326", "EPSG:32737", 250, "bilinear")
+            if construct_soil_resolution(250) in predictors:
+                predictors[construct_soil_resolution(250)].append(
+                    predictor_object(short_name, description, reprojected_path, 250))
+            else:
+                predictors[construct_soil_resolution(250)] = []
+                predictors[construct_soil_resolution(250)].append(
+                    predictor_object(short_name, description, reprojected_path, 250))
+
+    ### Read Landsat data
+    warped_rs_paths = set()
+    with open(rs_data_list_path, 'rb') as f:
+        reader = csv.reader(f, delimiter=';')
+        headers = reader.next()
+        for row in reader:
+            resolution = row[0]
+            path = row[1]
+            description = row[2]
+            short_name = row[3]
+            band = row[4]
+
+            # Each row is one band of a multiband file, the file is warped with all its bands only once
+            scaled_path = os.path.join(os.path.dirname(path), "32737__" + os.path.basename(path))
+            if scaled_path not in warped_rs_paths:
+                warp_cached(cache, path, scaled_path, "EPSG:32637", "EPSG:32737", 30, "nearest")
+                warped_rs_paths.add(scaled_path)
+            predictor_rs = predictor_object(short_name, description, scaled_path, 30)
+            predictor_rs.band = band
+            if construct_rs_resolution(30) in predictors:
+                predictors[construct_rs_resolution(30)].append(predictor_rs)
             else:
-                zoneStat = QgsZonalStatistics(buffered_vector, predictor.path,
-                                              str(predictor_resolution + predictor.short_name + str(predictor.band)),
-                                              int(predictor.band),
-                                              QgsZonalStatistics.Mean | QgsZonalStatistics.StDev)
-                zoneStat.calculateStatistics(None)
-
-write_results_file(buffered_studyareas, output_directory)
-write_legend_file(predictors, output_directory)
+                predictors[construct_rs_resolution(30)] = []
+                predictors[construct_rs_resolution(30)].append(predictor_rs)
+
+    ## Create Plot Shapefiles
+    buffered_vectors = {}
+    for plot_buffer_size in plot_buffers:
+        study_area_shape_path = os.path.join(output_directory, "StudyArea_" + str(plot_buffer_size) + "m.shp")
+        buffered_vectors[plot_buffer_size] = create_study_area_shapefile(plot_list_path, plot_buffer_size,
+                                                                         study_area_shape_path)
+        buffered_studyareas[plot_buffer_size] = study_area_shape_path
+    compute_plot_statistics(buffered_vectors, predictors, feature_store_directory)
+    if feature_store_directory is not None:
+        write_predictor_cubes(predictors, feature_store_directory)
+
+    write_results_file(buffered_studyareas, output_directory)
+    write_legend_file(predictors, output_directory)
+
+    # Trace of every processing step, open in chrome://tracing or Perfetto
+    TraceTools.recorder.write_chrome_trace(os.path.join(output_directory, "trace.json"))
+    TraceTools.recorder.print_summary()
+
+
+# The guard keeps the worker processes of the solar radiation from running the pipeline again
+if __name__ == "__main__":
+    main()
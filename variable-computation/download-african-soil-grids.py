@@ -1,20 +1,12 @@
 import csv
-import urllib, os
-from processing import Processing
-from qgis._analysis import QgsRasterCalculatorEntry, QgsRasterCalculator
-from qgis._core import QgsApplication
-import GraduTools
-
-qgishome = "C:/OSGeo4W64/apps/qgis-ltr/"
-app = QgsApplication([], True)
-app.setPrefixPath(qgishome, True)
-app.initQgis()
-os.environ['QGIS_DEBUG'] = '1'
-Processing.initialize()
+import os
+import DownloadTools
+import RasterTools
+import StackTools
 
 
 class data_pair:
-    def __init__(self, download_name, real_name, short_name, folder, very_short_name, soiltype):
+    def __init__(self, download_name, real_name, short_name, folder, very_short_name, soiltype, depth):
         """
         Simple object to store information about each file we are going to download
         :param download_name: Name in the WCS Service (Look for this in the Get Capabilities Document (
@@ -24,6 +16,7 @@ class data_pair:
         :param real_name:
         :param short_name:
         :param folder:
+        :param depth: Tuple of (top, bottom) depth in metres, equal for values at a point depth
         :return:
         """
         self.download_name = download_name
@@ -32,6 +25,7 @@ class data_pair:
         self.folder = folder
         self.very_short_name = very_short_name
         self.soiltype = soiltype
+        self.depth = depth
 
 
 def write_log_file(output_directory, data_pairs):
@@ -73,36 +67,37 @@ def write_combined_log_file(output_directory, soiltypes):
                 construct_short_name(soiltype)] + [input_short_names] + [soiltype])
 
 
-def combine_rasters(rasters, raster_out):
-    entries = []
-
-    i = 1
-    calculation = "("
-    for r in rasters:
-        # Define band1
-        rast = QgsRasterCalculatorEntry()
-        rast.ref = 'r' + str(i) + '@1'
-        rast.raster = r.raster
-        rast.bandNumber = 1
-        entries.append(rast)
-
-        if i == len(rasters):
-            calculation = calculation + rast.ref
-        else:
-            calculation = calculation + rast.ref + " + "
-        i = i + 1
-
-    calculation = calculation + ")" + "/" + str(len(rasters))
-
-    # Process calculation with input extent and resolution
-    raster1 = rasters[0].raster
-    calc = QgsRasterCalculator(calculation, raster_out, 'GTiff', raster1.extent(), raster1.width(), raster1.height(),
-                               entries)
-    calc.processCalculation()
+def combine_rasters(rasters, raster_out, method, statistics):
+    """
+    Combine the downloaded layers of a soil type block by block on the grid of the first layer
+    :param rasters: List of data_pair instances with downloaded output_uri
+    :param raster_out: Path to the combined raster
+    :param method: Reducer of the combined raster (see StackTools.REDUCERS), weighted_mean weights by depth
+    :param statistics: List of further reducers, each written next to the combined raster as <name>_<reducer>.tif
+    """
+    sources = [RasterTools.gdal_band_source(r.output_uri) for r in rasters]
+    grid = sources[0].grid
+    aligned = [StackTools.aligned_source(source, source.grid, grid) for source in sources]
+    base = os.path.splitext(raster_out)[0]
+    sinks = {method: RasterTools.gdal_band_sink(raster_out, grid)}
+    for statistic in statistics:
+        sinks[statistic] = RasterTools.gdal_band_sink(base + "_" + statistic + ".tif", grid)
+    try:
+        StackTools.reduce_blocks(aligned, sinks, StackTools.depth_weights([r.depth for r in rasters]))
+    finally:
+        for sink in sinks.values():
+            sink.close()
 
 
 # Configs
 download_directory = "F:/Gradu/AfricanSoilGrids/WCS/"  # Where to download the files (In your local drive)
+wcs_url = DownloadTools.DEFAULT_WCS_URL  # OWS endpoint, e.g. a local stand-in server for testing
+study_subsets = [("Long", 38.281771435832226, 38.37234746699569), ("Lat", -3.448906634066586, -3.345927432376734)]
+download_workers = 4  # Number of coverages downloaded at the same time
+download_retries = 3  # Number of times a failed download is tried again
+combine_method = "nanmean"  # mean, nanmean (skips nodata) or weighted_mean (by depth), see StackTools.REDUCERS
+combine_statistics = []  # Further per cell statistics of the layers, e.g. ["min", "max", "std"]
+combine_workers = 4  # Number of soil types combined at the same time
 
 # Data Pair Objects to handle what we want to download - extend by creating new objects
 data_to_download = []
@@ -113,90 +108,94 @@ data_to_download.extend(
                "SOC_g_per_kg_0.00m",
                "SOC_kg",
                "SK1",
-               "TOPSOIL"),
+               "TOPSOIL",
+               (0.0, 0.0)),
      data_pair("geonode:orcdrc_m_sl2_250m",
                "Soil organic carbon content (fine earth fraction) in g per kg at depth 0.05 m",
                "SOC_g_per_kg_0.05m",
                "SOC_kg",
                "SK2",
-               "TOPSOIL"),
+               "TOPSOIL",
+               (0.05, 0.05)),
      data_pair("geonode:orcdrc_m_sl3_250m",
                "Soil organic carbon content (fine earth fraction) in g per kg at depth 0.15 m",
                "SOC_g_per_kg_0.15m",
                "SOC_kg",
                "SK3",
-               "TOPSOIL"),
+               "TOPSOIL",
+               (0.15, 0.15)),
      data_pair("geonode:orcdrc_m_sl4_250m",
                "Soil organic carbon content (fine earth fraction) in g per kg at depth 0.30 m",
                "SOC_g_per_kg_0.30m",
                "SOC_kg",
                "SK4",
-               "SUBSOIL"),
+               "SUBSOIL",
+               (0.30, 0.30)),
      data_pair("geonode:orcdrc_m_sl5_250m",
                "Soil organic carbon content (fine earth fraction) in g per kg at depth 0.60 m",
                "SOC_g_per_kg_0.60m",
                "SOC_kg",
                "SK5",
-               "SUBSOIL"),
+               "SUBSOIL",
+               (0.60, 0.60)),
      # SOC T PER HA
      data_pair("geonode:ocstha_m_sd1_250m",
                "Soil organic carbon stock in tonnes per ha for depth interval 0.00 m - 0.05 m",
                "SOC_t_per_ha_0.00-0.05m",
                "SOC_ha",
                "SC1",
-               "TOPSOIL"),
+               "TOPSOIL",
+               (0.0, 0.05)),
      data_pair("geonode:ocstha_m_sd2_250m",
                "Soil organic carbon stock in tonnes per ha for depth interval 0.05 m - 0.15 m",
                "SOC_t_per_ha_0.05-0.15m",
                "SOC_ha",
                "SC2",
-               "TOPSOIL"),
+               "TOPSOIL",
+               (0.05, 0.15)),
      data_pair("geonode:ocstha_m_sd3_250m",
                "Soil organic carbon stock in tonnes per ha for depth interval 0.15 m - 0.30 m",
                "SOC_t_per_ha_0.15m-0.30m",
                "SOC_ha",
                "SC3",
-               "SUBSOIL"),
+               "SUBSOIL",
+               (0.15, 0.30)),
      data_pair("geonode:ocstha_m_sd4_250m",
                "Soil organic carbon stock in tonnes per ha for depth interval 0.30 m - 0.60 m",
                "SOC_t_per_ha_0.30m-0.30m",
                "SOC_ha",
                "SC4",
-               "SUBSOIL")
+               "SUBSOIL",
+               (0.30, 0.60))
      ])
 
-# Loop over the downloadble files list and store to correct folder
+# Download the files to the correct folders, coverages already in the cache are not downloaded again
+requests = []
 for file in data_to_download:
-    print "Downloading: " + file.download_name + " to: " + os.path.join(download_directory, file.folder,
-                                                                        file.download_name.split(':')[1] + ".tif")
-    download_url = "http://webservices.isric.org/geoserver/ows?service=WCS&version=2.0.1" \
-                   "&request=GetCoverage" \
-                   "&CoverageId=" + file.download_name + \
-                   "&subset=Long(38.281771435832226,38.37234746699569)" \
-                   "&subset=Lat(-3.448906634066586,-3.345927432376734)"
-    dir_path = os.path.join(download_directory, file.folder)
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
-    output_uri = os.path.join(dir_path, file.download_name.split(':')[1] + ".tif")
+    output_uri = os.path.join(download_directory, file.folder, file.download_name.split(':')[1] + ".tif")
+    print "Downloading: " + file.download_name + " to: " + output_uri
     file.output_uri = output_uri
-    urllib.urlretrieve(download_url, output_uri)
+    requests.append(DownloadTools.coverage_request(file.download_name, study_subsets, output_uri))
+fetcher = DownloadTools.downloader(DownloadTools.download_cache(download_directory), wcs_url, download_workers,
+                                   download_retries)
+failures = fetcher.run(requests)
+if failures:
+    raise RuntimeError("Download failed: " + ", ".join(sorted(failures)))
 print "Download Complete!"
 
 soiltypes = {}
 for f in data_to_download:
     name = f.soiltype + "_" + f.folder
     if name in soiltypes:
-        f.raster = GraduTools.load_raster(f.output_uri)
         soiltypes[name].append(f)
     else:
         soiltypes[name] = []
-        f.raster = GraduTools.load_raster(f.output_uri)
         soiltypes[name].append(f)
 
-for key in soiltypes:
-    combined_path = os.path.join(download_directory, key + ".tif")
-    combine_rasters(soiltypes[key], combined_path)
-r1 = soiltypes["TOPSOIL_SOC_kg"]
+# Every soil type is combined by its own worker
+StackTools.run_parallel([lambda key=key: combine_rasters(soiltypes[key], os.path.join(download_directory, key + ".tif"),
+                                                         combine_method, combine_statistics)
+                         for key in sorted(soiltypes)], combine_workers)
 
 write_log_file(download_directory, data_to_download)
 write_combined_log_file(download_directory, soiltypes)
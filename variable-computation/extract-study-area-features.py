@@ -0,0 +1,71 @@
+import os
+import pickle
+
+import PredictionTools
+import RasterTools
+import TraceTools
+
+
+def open_sources(legend, names, grid):
+    """
+    Open the selected predictors on the grid of the study area
+    :param legend: Dictionary of short name -> (raster path, band number), see PredictionTools.read_legend
+    :param names: List of selected short names
+    :param grid: Instance of BlockTools.raster_grid of the study area
+    :return: Dictionary of short name -> block source on the grid
+    """
+    missing = [name for name in names if name not in legend]
+    if missing:
+        raise ValueError("Not in the legend: " + ", ".join(missing))
+    sources = {}
+    for name in names:
+        path, band = legend[name]
+        source = RasterTools.gdal_band_source(path, band)
+        sources[name] = PredictionTools.resampled_source(source, source.grid, grid)
+    return sources
+
+
+def main():
+    # Configs
+    legend_path = "F:/Gradu/Variables/legend.csv"  # Legend written by compute-raster-variables.py
+    selected_short_names = ["T5SLO", "T5TWI", "T25TPI100", "SP250SK"]  # Selected predictors, in the model's order
+    grid_short_name = "T5SLO"  # Predictor whose grid the study area is extracted on, e.g. the finest resolution
+    output_directory = "F:/Gradu/WholeStudyArea/"
+    tile_size = 512  # Size of the extraction tiles in cells, bounds the memory use
+    csv_path = None  # Path to a SelectedVariablesForWholeStudyArea CSV for predict-for-whole-study-area.R, or None
+    model_path = None  # Path to a pickled model with a predict method taking the feature matrix, or None
+    prediction_path = os.path.join(output_directory, "Predicted.tif")
+
+    legend = PredictionTools.read_legend(legend_path)
+    grid_path, grid_band = legend[grid_short_name]
+    grid = RasterTools.gdal_band_source(grid_path, grid_band).grid
+    chunks_directory = os.path.join(output_directory, "Features")
+
+    with TraceTools.span("extract_features", "prediction", predictors=len(selected_short_names), rows=grid.rows,
+                         cols=grid.cols):
+        sources = open_sources(legend, selected_short_names, grid)
+        cells = PredictionTools.extract_features(sources, selected_short_names, grid, chunks_directory, tile_size)
+    print("Extracted " + str(cells) + " cells to: " + chunks_directory)
+    chunks = PredictionTools.feature_chunks(chunks_directory)
+
+    if csv_path is not None:
+        with TraceTools.span("write_feature_csv", "prediction"):
+            PredictionTools.write_feature_csv(chunks, csv_path)
+
+    if model_path is not None:
+        with open(model_path, 'rb') as f:
+            model = pickle.load(f)
+        with TraceTools.span("write_predictions", "prediction", cells=cells):
+            sink = RasterTools.gdal_band_sink(prediction_path, chunks.grid)
+            try:
+                PredictionTools.write_predictions(chunks, model.predict, sink)
+            finally:
+                sink.close()
+        print("Predictions written to: " + prediction_path)
+
+    TraceTools.recorder.write_chrome_trace(os.path.join(output_directory, "trace.json"))
+    TraceTools.recorder.print_summary()
+
+
+if __name__ == "__main__":
+    main()